@@ -0,0 +1,1070 @@
+"""月用气监控表分析引擎
+
+不依赖 Flask 的分析核心：表头布局推断、按列读取工作簿、变化量计算和分析报告生成。
+Web 服务（marketing.py）和桌面端都通过本模块执行分析，桌面端可直接读取本地文件。
+"""
+import os
+import re
+import hashlib
+import sys
+import threading
+import time
+import zipfile
+from html import unescape
+from collections import OrderedDict
+from contextlib import ExitStack
+from functools import lru_cache
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+from openpyxl.cell.cell import ERROR_CODES
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils import get_column_letter
+from pandas.io.parsers import TextParser
+from workbook_preview import (HEADER_SCAN_ROWS, MAIN_NS, SEQUENCE_COLUMN_NAMES, column_day, normalize_column_names,
+                              locate_header, first_sheet_path, read_string_table)
+from xml.etree.ElementTree import iterparse
+
+# 已解析工作簿缓存的内存上限
+WORKBOOK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# 直接扫描工作表 XML 时每次解压的字节数（在整行边界处切分）
+SHEET_SCAN_CHUNK_SIZE = 8 * 1024 * 1024
+
+# 工作表 XML 中的单元格：引用（列字母、行号）、其余属性、内容
+SHEET_CELL_PATTERN = re.compile(rb'<c r="([A-Z]+)(\d+)"([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+CELL_TYPE_PATTERN = re.compile(rb'\bt="([^"]*)"')
+CELL_STYLE_PATTERN = re.compile(rb'\bs="(\d+)"')
+CELL_VALUE_PATTERN = re.compile(rb'<v>(.*?)</v>', re.S)
+INLINE_TEXT_PATTERN = re.compile(rb'<t(?:\s[^>]*)?>(.*?)</t>', re.S)
+PHONETIC_PATTERN = re.compile(rb'<rPh\b.*?</rPh>', re.S)
+# 工作表 XML 的根元素及其命名空间前缀（OpenXML SDK 等生成的文件使用 <x:worksheet>、<x:c>）
+SHEET_ROOT_PATTERN = re.compile(rb'<(?:([A-Za-z_][\w.-]*):)?worksheet[\s>]')
+
+# 默认异常阈值（百分比）
+DEFAULT_ABNORMAL_THRESHOLD = 10
+
+# 文件名中的年月日（如"2025年1月"、"202501"、"2025-01-31"、"1月"），计算历史库来源时去掉
+DATE_IN_FILE_NAME_PATTERN = re.compile(
+    r'(?:19|20)\d{2}(?:[-_.年]?\d{1,2}(?:[-_.月]\d{1,2}日?|月)?)?|\d{1,2}月(?:\d{1,2}日)?'
+)
+
+
+class MemoryLRUCache:
+    """线程安全的内存缓存，按占用内存上限和空闲时间淘汰
+
+    缓存总内存超过上限时按最近最少使用（LRU）顺序淘汰；
+    设置了 ttl 时，超过 ttl 秒未被访问的条目也会被清除。
+    缓存中的对象为共享对象，调用方不应在未加锁的情况下原地修改。
+    """
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (缓存对象, 占用字节数, 最近访问时间)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        """清除空闲超时的条目（调用方需持有锁）"""
+        if self.ttl is None:
+            return
+        while self._entries:
+            key, (_, size, accessed) = next(iter(self._entries.items()))
+            if now - accessed <= self.ttl:
+                break
+            del self._entries[key]
+            self._total_bytes -= size
+
+    def get(self, key):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries[key] = (entry[0], entry[1], now)
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            # 单个条目超过上限时不缓存
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, now)
+            self._total_bytes += size
+            while self._total_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_size
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            self._total_bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+
+# 已解析工作簿缓存（按文件内容哈希）
+workbook_cache = MemoryLRUCache(WORKBOOK_CACHE_MAX_BYTES)
+
+
+def history_key(row_id):
+    """历史库中的行标识：序号统一转为字符串，整数值的浮点序号去掉小数部分"""
+    if isinstance(row_id, float) and row_id.is_integer():
+        row_id = int(row_id)
+    return str(row_id)
+
+
+def extract_date_from_column_name(col_name):
+    """从列名中提取日期信息"""
+    if pd.isna(col_name):
+        return None
+    return column_day(col_name)
+
+
+def find_sequence_column(df):
+    """查找序号列"""
+    for col in df.columns:
+        if str(col).strip() in SEQUENCE_COLUMN_NAMES:
+            return col
+    return None
+
+
+def find_category_column(df):
+    """查找分类列"""
+    for col in df.columns:
+        if str(col).strip() == '分类':
+            return col
+    return None
+
+
+def find_date_columns(df):
+    """查找所有日期列，按日期先后排序"""
+    date_columns = [col for col in df.columns if extract_date_from_column_name(col) is not None]
+    return sorted(date_columns, key=lambda x: extract_date_from_column_name(x) or 0)
+
+
+def select_total_rows(df, category_col, sequence_col):
+    """获取合计行：有分类列时按分类为"合计"筛选，否则取序号为999的行"""
+    if category_col and category_col in df.columns:
+        return df[df[category_col] == '合计']
+    return df[df[sequence_col] == 999]
+
+
+class WorkbookLayout:
+    """工作簿的表头布局
+
+    记录序号、分类、客户名称列，日期到气量列的映射以及数据起始行，
+    由 infer_layout 推断，表头相同的工作簿共用同一个布局对象。
+    """
+
+    def __init__(self, columns, data_start_row):
+        self.columns = columns  # 按位置排列的列名
+        self.data_start_row = data_start_row  # 第一行数据在工作表中的行号（从0开始）
+        self.positions = {col: i for i, col in enumerate(columns)}
+
+        header = pd.DataFrame(columns=pd.Index(columns, dtype=object))
+        self.sequence_col = find_sequence_column(header)
+        self.category_col = find_category_column(header)
+        self.name_col = '客户名称' if '客户名称' in self.positions else None
+        self.date_columns = find_date_columns(header)
+
+        # 同一天有多列时取第一列
+        self.day_columns = {}
+        for col in self.date_columns:
+            self.day_columns.setdefault(extract_date_from_column_name(col), col)
+
+    def column_for_day(self, day):
+        """返回某一天的气量列，不存在时返回 None"""
+        return self.day_columns.get(day)
+
+    def select_total_rows(self, df):
+        """获取合计行"""
+        return select_total_rows(df, self.category_col, self.sequence_col)
+
+    def estimated_bytes(self):
+        return sys.getsizeof(self.columns) + sum(sys.getsizeof(c) for c in self.columns) * 3
+
+
+@lru_cache(maxsize=64)
+def build_layout(columns, data_start_row):
+    """按表头签名（列名和数据起始行）缓存布局，同一版式的工作簿只解析一次"""
+    return WorkbookLayout(columns, data_start_row)
+
+
+def infer_layout(raw):
+    """根据工作表开头若干行（不带表头读取的 DataFrame）推断表头布局，规则见 locate_header"""
+    rows = [[None if pd.isna(value) else value for value in row] for row in raw.itertuples(index=False)]
+    if not rows:
+        return build_layout((), 1)
+
+    names, data_start_row = locate_header(rows)
+    return build_layout(normalize_column_names(names), data_start_row)
+
+
+def to_numeric_array(values):
+    """将一列数据转换为浮点数组，无法解析的单元格记为 NaN"""
+    return pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+
+
+def compute_changes(current, previous, threshold):
+    """按列批量计算变化量、变化率和异常标记
+
+    current 和 previous 为等长的数值数组（缺失值为 NaN），
+    一次性返回所有行的 NumPy 结果数组，避免逐行循环
+    """
+    current = np.asarray(current, dtype=float)
+    previous = np.asarray(previous, dtype=float)
+
+    change = current - previous
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change_rate = np.where(previous != 0, change / previous * 100, np.nan)
+
+    # NaN 参与比较的结果为 False，缺失数据不会被标记为异常
+    abnormal = np.abs(change_rate) > threshold
+
+    return {
+        'current': current,
+        'previous': previous,
+        'change': change,
+        'change_rate': change_rate,
+        'abnormal': abnormal
+    }
+
+
+def nan_to_none(values):
+    """将数组或列表转换为 Python 列表，NaN 替换为 None"""
+    if isinstance(values, np.ndarray):
+        values = values.tolist()
+    return [None if value != value else value for value in values]
+
+
+def build_change_records(row_ids, row_names, day_label, changes):
+    """根据列式计算结果生成接口返回的记录列表"""
+    current = nan_to_none(changes['current'])
+    previous = nan_to_none(changes['previous'])
+    change = nan_to_none(changes['change'])
+    change_rate = nan_to_none(changes['change_rate'])
+    abnormal = changes['abnormal'].tolist()
+    row_ids = nan_to_none(row_ids)
+    row_names = nan_to_none(row_names)
+
+    records = []
+    for i, row_id in enumerate(row_ids):
+        records.append({
+            '序号': row_id,
+            '名称': row_names[i],
+            '日期': day_label,
+            '气量(万立方米)': current[i],
+            '前一天气量(万立方米)': previous[i],
+            '变化量(万立方米)': change[i],
+            '变化率(%)': f"{change_rate[i]}%" if change_rate[i] is not None else None,
+            '异常': abnormal[i]
+        })
+    return records
+
+
+class ChangeRateIndex:
+    """按变化率绝对值排序的记录索引
+
+    更新阈值时用二分查找定位异常记录的起点，返回异常记录只需 O(log n + k)；
+    同时只翻转新旧阈值之间那部分记录的"异常"标记，不再重新计算变化率。
+    变化率无法计算（前一天气量为0或缺失）的记录不进入索引，始终不视为异常。
+    """
+
+    def __init__(self, records, change_rate, threshold):
+        self.records = records
+        abs_rate = np.abs(np.asarray(change_rate, dtype=float))
+        positions = np.flatnonzero(~np.isnan(abs_rate))
+        order = np.argsort(abs_rate[positions], kind='stable')
+        self._positions = positions[order]
+        self._abs_rates = abs_rate[positions][order]
+        self.threshold = threshold
+        self._start = self._search(threshold)
+
+    def _search(self, threshold):
+        """返回第一个变化率绝对值大于阈值的位置"""
+        return int(np.searchsorted(self._abs_rates, threshold, side='right'))
+
+    def abnormal_positions(self):
+        """返回当前阈值下异常记录的位置（按变化率绝对值升序）"""
+        return self._positions[self._start:]
+
+    def abnormal_records(self):
+        """按原始顺序返回当前阈值下的异常记录"""
+        return [self.records[i] for i in np.sort(self.abnormal_positions()).tolist()]
+
+    def set_threshold(self, threshold):
+        """更新阈值，只修改状态发生变化的记录，返回新的异常记录"""
+        start = self._search(threshold)
+        if start < self._start:
+            for i in self._positions[start:self._start].tolist():
+                self.records[i]['异常'] = True
+        else:
+            for i in self._positions[self._start:start].tolist():
+                self.records[i]['异常'] = False
+
+        self.threshold = threshold
+        self._start = start
+        return self.abnormal_records()
+
+
+class ContributionIndex:
+    """合计行变化量的客户贡献分解
+
+    分析时按分类对客户行做一次分组，只保存客户行的列式数据和每个合计行对应的客户位置；
+    查询某个合计行时才对该组客户按变化量绝对值排序，主分析结果中不包含这些数据。
+    合计行按其在分析结果记录中的位置区分（999 布局中多个合计行的序号相同）。
+    """
+
+    def __init__(self, columns, groups, error=None):
+        self.columns = columns  # 客户行的列式数据：序号、名称、气量、前一天气量、变化量
+        self.groups = groups  # 合计行在结果记录中的位置 -> 客户行位置数组
+        self.error = error  # 无法取得客户行前一天气量时的原因，此时不提供贡献分解
+
+    def contributions(self, total_position, total_change, limit=None):
+        """返回合计行的客户贡献列表（按变化量绝对值从大到小）和该组客户的变化量合计；合计行不存在时返回 None
+
+        客户行没有前一天气量（如1号的前一天气量来自不含这些客户的历史数据）时无法分解，抛出 AnalysisError。
+        """
+        if self.error is not None:
+            raise AnalysisError(self.error, 409)
+        if not 0 <= total_position < len(self.groups):
+            return None
+
+        positions = self.groups[total_position]
+        previous = self.columns['前一天气量(万立方米)'][positions]
+        if len(previous) and np.isnan(previous).all():
+            raise AnalysisError('该合计行的客户没有前一天的气量，无法分解变化量', 409)
+
+        changes = self.columns['变化量(万立方米)'][positions]
+        order = np.argsort(-np.abs(np.nan_to_num(changes)), kind='stable')
+        explained = float(np.nansum(changes))
+        if limit is not None:
+            order = order[:limit]
+        ranked = positions[order]
+
+        values = {field: nan_to_none(column[ranked]) for field, column in self.columns.items()}
+        if total_change:
+            values['贡献占比(%)'] = nan_to_none(self.columns['变化量(万立方米)'][ranked] / total_change * 100)
+        else:
+            values['贡献占比(%)'] = [None] * len(ranked)
+
+        records = [dict(zip(values, row)) for row in zip(*values.values())]
+        return records, explained, len(positions)
+
+    def estimated_bytes(self):
+        return sum(values.nbytes for values in self.columns.values()) + \
+            sum(positions.nbytes for positions in self.groups)
+
+
+def total_group(name):
+    """合计行所属的分组：名称去掉"合计"后的部分，如"居民合计"对应"居民"；没有名称时为 None"""
+    return str(name).replace('合计', '').strip() if isinstance(name, str) else None
+
+
+def build_contribution_index(layout, total_rows, customers, current, previous, error=None):
+    """对客户行按分类一次分组，确定每个合计行由哪些客户行构成
+
+    合计行名称去掉"合计"后与某个分类相同时（如"居民合计"对应"居民"）取该分类的客户，
+    否则取工作表中该合计行与上一个合计行之间的客户行（小计行紧跟在本组客户之后的布局）。
+    """
+    sequence_col = layout.sequence_col
+    positions_by_category = {}
+    if layout.category_col:
+        codes, categories = pd.factorize(customers[layout.category_col])
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes[codes >= 0], minlength=len(categories))
+        # factorize 将缺失分类编为 -1，排序后位于最前面，分组时跳过
+        grouped = np.split(order[np.count_nonzero(codes < 0):], np.cumsum(counts)[:-1])
+        positions_by_category = {str(category): group for category, group in zip(categories, grouped)}
+
+    customer_index = customers.index.to_numpy()
+    total_index = total_rows.index.to_numpy()
+    total_names = total_rows[layout.name_col].tolist() if layout.name_col else [None] * len(total_rows)
+
+    groups = []
+    previous_total = -1
+    for name, index in zip(total_names, total_index.tolist()):
+        category = total_group(name)
+        if category in positions_by_category:
+            group = positions_by_category[category]
+        else:
+            start, end = np.searchsorted(customer_index, [previous_total, index], side='right')
+            group = np.arange(start, end)
+        groups.append(group)
+        previous_total = index
+
+    names = customers[layout.name_col].to_numpy() if layout.name_col else customers[sequence_col].to_numpy()
+    columns = {
+        '序号': customers[sequence_col].to_numpy(),
+        '名称': names,
+        '气量(万立方米)': current,
+        '前一天气量(万立方米)': previous,
+        '变化量(万立方米)': current - previous
+    }
+    return ContributionIndex(columns, groups, error)
+
+
+def dataframe_nbytes(df):
+    """估算 DataFrame 占用的内存字节数"""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def hash_stream(stream, chunk_size=1024 * 1024):
+    """分块计算文件流内容的 SHA-256，完成后将读取位置恢复到开头"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def excel_cell_value(value):
+    """按 pandas 读取 xlsx 时的规则转换单元格原始值：空单元格为空字符串，错误值为 NaN，整数值的浮点数转为整数"""
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        return np.nan if value in ERROR_CODES else value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def source_family(source_name):
+    """来源名称去掉目录、扩展名、年月日和分隔符后的部分（小写），同一系列的月度文件相同"""
+    stem = os.path.splitext(os.path.basename(source_name or ''))[0]
+    stem = DATE_IN_FILE_NAME_PATTERN.sub('', stem)
+    return re.sub(r'[\s_\-.()（）]+', '', stem).lower()
+
+
+class UnsupportedSheet(Exception):
+    """工作表包含直接扫描不支持的内容（日期格式的单元格、单元格引用不在首位等），需改用 openpyxl 读取"""
+
+
+def date_style_ids(archive):
+    """styles.xml 中数字格式为日期或时间的单元格样式编号"""
+    if 'xl/styles.xml' not in archive.NameToInfo:
+        return set()
+
+    formats = dict(BUILTIN_FORMATS)
+    style_formats = []
+    with archive.open('xl/styles.xml') as f:
+        in_cell_xfs = False
+        for event, elem in iterparse(f, events=('start', 'end')):
+            if elem.tag == f'{MAIN_NS}cellXfs':
+                in_cell_xfs = event == 'start'
+            elif event == 'end' and elem.tag == f'{MAIN_NS}numFmt':
+                formats[int(elem.get('numFmtId'))] = elem.get('formatCode')
+            elif event == 'end' and in_cell_xfs and elem.tag == f'{MAIN_NS}xf':
+                style_formats.append(int(elem.get('numFmtId', 0)))
+    return {i for i, format_id in enumerate(style_formats) if is_date_format(formats.get(format_id))}
+
+
+def xml_text(text):
+    """XML 中的文本（已编码的字节）转为字符串"""
+    text = text.decode('utf-8')
+    return unescape(text) if '&' in text else text
+
+
+def sheet_cell_value(attrs, body, strings, date_styles):
+    """按 openpyxl（data_only）的规则取单元格原始值，再按 excel_cell_value 转换"""
+    match = CELL_TYPE_PATTERN.search(attrs)
+    cell_type = match.group(1) if match else b'n'
+
+    if cell_type == b'inlineStr':
+        if not body:
+            return ''
+        body = PHONETIC_PATTERN.sub(b'', body)
+        return excel_cell_value(''.join(xml_text(t) for t in INLINE_TEXT_PATTERN.findall(body)))
+
+    match = CELL_VALUE_PATTERN.search(body) if body else None
+    if match is None or not match.group(1):
+        return ''
+    text = match.group(1)
+
+    if cell_type == b'n':
+        style = CELL_STYLE_PATTERN.search(attrs)
+        if style and int(style.group(1)) in date_styles:
+            raise UnsupportedSheet('日期格式的单元格')
+        # 与 openpyxl 相同：带小数点或指数的按浮点数，否则按整数
+        value = float(text) if b'.' in text or b'E' in text or b'e' in text else int(text)
+    elif cell_type == b's':
+        value = strings[int(text)]
+    elif cell_type == b'b':
+        value = bool(int(text))
+    elif cell_type in (b'str', b'e'):
+        value = xml_text(text)
+    else:
+        raise UnsupportedSheet(f'单元格类型 {cell_type.decode()}')
+    return excel_cell_value(value)
+
+
+def scan_raw_columns(source, data_start_row, positions):
+    """直接扫描 xlsx 第一个工作表的 XML，只转换指定列的单元格，结果与 read_raw_columns_openpyxl 相同
+
+    openpyxl 为每个单元格创建对象，首次解析大文件的大部分时间花在这里；
+    这里用正则逐块匹配单元格，其余列只在判断末尾空行时才取值。
+    遇到不支持的内容时抛出 UnsupportedSheet。
+    """
+    letters = {get_column_letter(position + 1).encode(): position for position in positions}
+    values = {position: [] for position in positions}
+    first_row = data_start_row + 1
+    last_content_row = 0
+
+    with zipfile.ZipFile(source) as archive:
+        sheet_path = first_sheet_path(archive)
+        strings = read_string_table(archive)
+        date_styles = date_style_ids(archive)
+        # 分类、常见数值等重复的单元格内容很多，按 (属性, 内容) 缓存转换结果
+        converted = {}
+
+        def cell_value(attrs, body):
+            key = (attrs, body)
+            value = converted.get(key)
+            if value is None:
+                value = converted[key] = sheet_cell_value(attrs, body, strings, date_styles)
+            return value
+
+        def scan(data):
+            nonlocal last_content_row
+            cells = SHEET_CELL_PATTERN.findall(data)
+            if len(cells) != data.count(b'<c ') + data.count(b'<c>'):
+                raise UnsupportedSheet('单元格引用不在首位')
+
+            for column, row, attrs, body in cells:
+                row = int(row)
+                if row < first_row:
+                    continue
+                position = letters.get(column)
+                if position is None:
+                    # 不需要的列只用于判断末尾空行，本行已确认有内容时跳过
+                    if row > last_content_row and cell_value(attrs, body) != '':
+                        last_content_row = row
+                    continue
+
+                value = cell_value(attrs, body)
+                if value != '' and row > last_content_row:
+                    last_content_row = row
+                column_values = values[position]
+                index = row - first_row
+                if len(column_values) < index:
+                    column_values.extend([''] * (index - len(column_values)))
+                column_values.append(value)
+
+        with archive.open(sheet_path) as f:
+            tail = f.read(SHEET_SCAN_CHUNK_SIZE)
+            # 单元格模式只匹配无前缀的元素，带前缀的工作表会扫描出 0 个单元格，需改用 openpyxl
+            root = SHEET_ROOT_PATTERN.search(tail)
+            if root is None or root.group(1):
+                raise UnsupportedSheet('带命名空间前缀的工作表')
+            while True:
+                chunk = f.read(SHEET_SCAN_CHUNK_SIZE)
+                if not chunk:
+                    scan(tail)
+                    break
+                data = tail + chunk
+                end = data.rfind(b'</row>')
+                if end < 0:
+                    tail = data
+                    continue
+                scan(data[:end + len(b'</row>')])
+                tail = data[end + len(b'</row>'):]
+
+    row_count = max(last_content_row - data_start_row, 0)
+    return {position: (column + [''] * (row_count - len(column)))[:row_count] for position, column in values.items()}
+
+
+def read_raw_columns(source, data_start_row, positions):
+    """一次遍历 xlsx 第一个工作表，返回数据区中指定列位置的单元格值 {列位置: 值列表}
+
+    只做单元格值转换，不做类型推断，结果用于计算列指纹和按需解析；
+    末尾的空行与 pandas.read_excel 一样被去掉。
+    优先直接扫描 XML，工作表包含不支持的内容时改用 openpyxl。
+    """
+    try:
+        return scan_raw_columns(source, data_start_row, positions)
+    except UnsupportedSheet:
+        source.seek(0)
+        return read_raw_columns_openpyxl(source, data_start_row, positions)
+
+
+def read_raw_columns_openpyxl(source, data_start_row, positions):
+    """用 openpyxl 只读模式遍历第一个工作表读取指定列，返回值与 read_raw_columns 相同"""
+    book = load_workbook(source, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = book.worksheets[0]
+        sheet.reset_dimensions()
+        values = {position: [] for position in positions}
+        row_count = 0
+        for row_number, row in enumerate(sheet.iter_rows(min_row=data_start_row + 1, values_only=True)):
+            row = [excel_cell_value(value) for value in row]
+            while row and row[-1] == '':
+                row.pop()
+            if row:
+                row_count = row_number + 1
+            for position, column in values.items():
+                column.append(row[position] if position < len(row) else '')
+    finally:
+        book.close()
+    return {position: column[:row_count] for position, column in values.items()}
+
+
+def column_fingerprint(values):
+    """列内容指纹：单元格值序列（含行数）的哈希"""
+    return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()
+
+
+def parse_raw_columns(raw_columns, names):
+    """用 pandas 读取 Excel 时相同的解析器将原始单元格值转换为 DataFrame（类型推断与 read_excel 一致）"""
+    rows = [list(row) for row in zip(*raw_columns)]
+    data = TextParser(rows, header=None, skip_blank_lines=False).read()
+    data.columns = names
+    return data
+
+
+class UploadedWorkbook:
+    """上传的Excel工作簿，分两阶段读取
+
+    第一阶段只读取开头几行推断表头布局（layout），用于查找所需列；
+    第二阶段通过 load_columns 只加载指定的列。已加载的列按文件内容哈希缓存，
+    同一文件再次分析时只需补充读取缺少的列。
+    文件直接从请求的内存缓冲区读取，不经过磁盘中转。
+
+    月度监控表每天新增一列、重新上传后内容哈希就会变化，因此 xlsx 文件的列还按
+    工作簿谱系（表头中非日期列相同的工作簿）保存列指纹和解析结果：重新上传时
+    只解析指纹不同或新增的列，其余列直接复用上一次上传的解析结果。
+    """
+
+    def __init__(self, stream, cache_key=None):
+        self.cache_key = cache_key or hash_stream(stream)
+        self._stream = stream
+        self._entry = None
+
+    @property
+    def layout(self):
+        """表头布局（WorkbookLayout），首次访问时读取"""
+        if self._entry is None:
+            entry = workbook_cache.get(self.cache_key)
+            if entry is None:
+                raw = pd.read_excel(self._source(), header=None, nrows=HEADER_SCAN_ROWS)
+                layout = infer_layout(raw)
+                entry = {'layout': layout, 'data': None}
+                workbook_cache.put(self.cache_key, entry, layout.estimated_bytes())
+            self._entry = entry
+        return self._entry['layout']
+
+    def _source(self):
+        """返回可供 pandas 读取的文件流"""
+        self._stream.seek(0)
+        return self._stream
+
+    def _is_xlsx(self):
+        """xlsx 文件是 zip 包，以 PK 开头；xls 文件走 pandas 的完整读取"""
+        self._stream.seek(0)
+        signature = self._stream.read(4)
+        self._stream.seek(0)
+        return signature == b'PK\x03\x04'
+
+    def _lineage_key(self):
+        """工作簿谱系的缓存键：表头中非日期列的位置和名称，以及数据起始行"""
+        layout = self.layout
+        date_columns = set(layout.date_columns)
+        fixed_columns = tuple((i, c) for i, c in enumerate(layout.columns) if c not in date_columns)
+        return ('lineage', fixed_columns, layout.data_start_row)
+
+    def source_id(self, source_name):
+        """工作簿的来源标识，历史库按它区分不同来源的数据
+
+        由来源名称（通常是原始文件名）去掉年月日后的部分和表头中非日期列的结构共同决定：
+        同一张月度监控表每天新增列、跨月换文件（如"A区2025年1月.xlsx"与"A区2025年2月.xlsx"）后仍相同，
+        表头结构相同的不同工作簿（如各地区的报表）只要名称不同就不同。
+        """
+        key = (source_family(source_name), self._lineage_key())
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+
+    def _read_columns(self, columns):
+        """读取指定列：xlsx 文件按列指纹复用同一谱系中未变化的列，只解析新增或变化的列"""
+        layout = self.layout
+        positions = [layout.positions[c] for c in columns]
+
+        if not self._is_xlsx():
+            # 按列位置读取，避免重名列或非字符串列名导致匹配失败
+            data = pd.read_excel(self._source(), header=None, skiprows=layout.data_start_row,
+                                 usecols=sorted(positions))
+            data.columns = [layout.columns[i] for i in sorted(positions)]
+            return data[columns]
+
+        raw = read_raw_columns(self._source(), layout.data_start_row, positions)
+        fingerprints = {c: column_fingerprint(raw[layout.positions[c]]) for c in columns}
+
+        lineage_key = self._lineage_key()
+        lineage = workbook_cache.get(lineage_key) or {'fingerprints': {}, 'data': {}}
+        changed = [c for c in columns if lineage['fingerprints'].get(c) != fingerprints[c]]
+
+        parsed = {}
+        if changed:
+            changed_data = parse_raw_columns([raw[layout.positions[c]] for c in changed], changed)
+            parsed = {c: changed_data[c] for c in changed}
+
+        # 合并到谱系缓存（复制后替换，不修改其他请求可能正在读取的条目）
+        lineage = {
+            'fingerprints': {**lineage['fingerprints'], **{c: fingerprints[c] for c in changed}},
+            'data': {**lineage['data'], **parsed}
+        }
+        workbook_cache.put(lineage_key, lineage,
+                           sum(int(s.memory_usage(index=True, deep=True)) for s in lineage['data'].values()))
+
+        return pd.DataFrame({c: lineage['data'][c] for c in columns})
+
+    def load_columns(self, columns):
+        """只加载指定的列（按布局中的列名），返回包含这些列的 DataFrame"""
+        columns = list(dict.fromkeys(c for c in columns if c is not None))
+        layout = self.layout
+        data = self._entry['data']
+        missing = [c for c in columns if data is None or c not in data.columns]
+
+        if missing:
+            new_data = self._read_columns(missing)
+            data = new_data if data is None else pd.concat([data, new_data], axis=1)
+
+            self._entry = {'layout': layout, 'data': data}
+            workbook_cache.put(self.cache_key, self._entry, layout.estimated_bytes() + dataframe_nbytes(data))
+
+        return data[columns]
+
+
+class AnalysisError(Exception):
+    """分析过程中可预期的错误，message 直接返回给客户端，status 为 HTTP 状态码"""
+
+    def __init__(self, message, status=400):
+        # 两个参数都传给父类，保证异常从工作进程传回时状态码不丢失
+        super().__init__(message, status)
+        self.message = message
+        self.status = status
+
+
+def customer_rows(layout, df):
+    """客户行：去掉合计行和没有序号的行"""
+    customers = df.drop(layout.select_total_rows(df).index)
+    return customers[customers[layout.sequence_col].notna()]
+
+
+def customer_previous_values(row_id_series, extra_workbook=None, previous_volumes=None):
+    """每月1号按序号获取客户行的前一天气量：有月度补充文件时取其最后一个日期列，否则取历史库中的数据"""
+    if extra_workbook is not None:
+        extra_layout = extra_workbook.layout
+        if extra_layout.sequence_col is None or not extra_layout.date_columns:
+            raise AnalysisError('月度补充文件无效')
+        extra_prev_col = extra_layout.date_columns[-1]
+        extra_df = extra_workbook.load_columns([extra_layout.sequence_col, extra_prev_col])
+        extra_df = extra_df.drop_duplicates(extra_layout.sequence_col)
+        prev_by_id = pd.Series(to_numeric_array(extra_df[extra_prev_col]),
+                               index=extra_df[extra_layout.sequence_col].to_numpy())
+        return to_numeric_array(row_id_series.map(prev_by_id))
+    if previous_volumes is not None:
+        values = match_previous_volumes(row_id_series, previous_volumes['customers'])
+        if len(values) and np.isnan(values).all():
+            raise AnalysisError('历史数据中没有客户行前一天的气量，请上传月度补充文件')
+        return values
+    raise AnalysisError('每月1号需要上传月度补充文件')
+
+
+def match_previous_volumes(row_id_series, previous_volumes):
+    """按序号从历史数据中取前一天的气量，没有记录的行为 NaN
+
+    previous_volumes 为 {序号（history_key）: 按工作表顺序排列的气量列表}；
+    序号重复时（如 999 布局中的多个合计行）按在工作表中出现的先后顺序一一对应。
+    """
+    keys = row_id_series.map(history_key)
+    occurrences = keys.groupby(keys.to_numpy()).cumcount().tolist()
+    values = []
+    for key, occurrence in zip(keys.tolist(), occurrences):
+        volumes = previous_volumes.get(key)
+        values.append(volumes[occurrence] if volumes is not None and occurrence < len(volumes) else np.nan)
+    return to_numeric_array(values)
+
+
+def run_analysis(main_workbook, main_filename, analysis_date, abnormal_threshold,
+                 extra_workbook=None, extra_filename=None, previous_volumes=None, source_name=None):
+    """分析月用气监控表数据
+
+    不依赖请求上下文，可在请求线程或工作进程中执行。返回分析结果字典，
+    其中 index 为记录的变化率索引；可预期的错误以 AnalysisError 抛出。
+    每月1号没有月度补充文件时，前一天的气量取自 previous_volumes（历史库中同一来源前一天的数据，
+    totals、customers 分别为合计行和客户行的 {序号: 按工作表顺序排列的气量列表}，见 match_previous_volumes）。
+    历史数据中没有客户行时仍完成合计行的分析，只是客户贡献分解不可用。
+    结果中的 source 为主文件的历史库来源标识，由 source_name（默认为 main_filename）计算，见 UploadedWorkbook.source_id。
+    """
+    current_day = datetime.strptime(analysis_date, '%Y-%m-%d').day
+    is_first_day = current_day == 1
+    last_month_data = None
+
+    try:
+        # 读取Excel文件：先只推断表头布局，确定所需列后再按列加载
+        layout = main_workbook.layout
+
+        # 查找序号列
+        sequence_col = layout.sequence_col
+        if sequence_col is None:
+            raise AnalysisError('未找到"序号"列')
+
+        # 查找分类列
+        category_col = layout.category_col
+
+        if not layout.date_columns:
+            raise AnalysisError('未找到日期列（格式应为"X日"或"气量-X日"）')
+
+        # 获取当前日期的气量列（万立方米）
+        current_col = layout.column_for_day(current_day)
+        if not current_col:
+            raise AnalysisError(f'未找到{current_day}日的气量列')
+
+        # 获取前一天的气量列
+        if is_first_day:
+            # 如果是第一天，需要处理月度补充文件
+            if extra_workbook is None:
+                if previous_volumes is None:
+                    raise AnalysisError('月度补充文件无效')
+                # 没有月度补充文件时，前一天的气量在找到合计行后从历史库中按序号取得
+                prev_col = None
+            else:
+                try:
+                    # 读取月度补充文件的表头布局
+                    extra_layout = extra_workbook.layout
+
+                    # 查找序号列
+                    extra_sequence_col = extra_layout.sequence_col
+                    if extra_sequence_col is None:
+                        raise AnalysisError('月度补充文件中未找到"序号"列')
+
+                    if not extra_layout.date_columns:
+                        raise AnalysisError('月度补充文件中未找到日期列')
+
+                    # 获取上个月最后一天的数据列（通常是31日）
+                    prev_col = extra_layout.date_columns[-1]
+
+                    # 只加载序号、分类和最后一天的数据列
+                    extra_df = extra_workbook.load_columns([extra_sequence_col, extra_layout.category_col, prev_col])
+
+                    # 获取合计行的前一天气量（没有分类列时取序号为999的行）
+                    prev_gas_rows = extra_layout.select_total_rows(extra_df)
+
+                    if prev_gas_rows.empty:
+                        raise AnalysisError('月度补充文件中未找到"合计"行')
+
+                    # 存储上个月的数据
+                    last_month_data = dict(zip(
+                        prev_gas_rows[extra_sequence_col].tolist(),
+                        nan_to_none(prev_gas_rows[prev_col].tolist())
+                    ))
+
+                except AnalysisError:
+                    raise
+                except Exception as e:
+                    raise AnalysisError(f'处理月度补充文件时出错: {str(e)}', 500)
+        else:
+            # 如果不是第一天，从主文件中获取前一天的数据列
+            prev_day = current_day - 1
+            prev_col = layout.column_for_day(prev_day)
+
+            if not prev_col:
+                raise AnalysisError(f'未找到{prev_day}日的气量列')
+
+        # 只加载分析需要的列：序号、分类、客户名称以及当前和前一天的气量列
+        df = main_workbook.load_columns([
+            sequence_col, category_col, layout.name_col, current_col,
+            None if is_first_day else prev_col
+        ])
+
+        # 获取合计行（没有分类列时取序号为999的行）
+        total_rows = layout.select_total_rows(df)
+
+        if total_rows.empty:
+            raise AnalysisError('未找到"合计"行')
+
+        # 处理数据：按列一次性计算所有合计行的变化量、变化率和异常标记
+        current_values = to_numeric_array(total_rows[current_col])
+        if is_first_day and extra_workbook is None:
+            # 如果是第一天且没有月度补充文件，从历史库中按序号获取前一天的气量，没有记录的行按0处理
+            row_id_series = total_rows[sequence_col]
+            history_values = match_previous_volumes(row_id_series, previous_volumes['totals'])
+            last_month_data = {
+                row_id: value for row_id, value in zip(row_id_series.tolist(), history_values.tolist())
+                if value == value
+            }
+            prev_values = np.nan_to_num(history_values)
+        elif is_first_day:
+            # 如果是第一天，从月度补充文件中获取前一天的气量
+            row_id_series = total_rows[sequence_col]
+            prev_values = to_numeric_array(
+                row_id_series.map(last_month_data).where(row_id_series.isin(list(last_month_data)), 0)
+            )
+        else:
+            # 如果不是第一天，从主文件中获取前一天的气量
+            prev_values = to_numeric_array(total_rows[prev_col])
+
+        changes = compute_changes(current_values, prev_values, abnormal_threshold)
+
+        # 客户行的变化量，供按合计行查询客户贡献
+        customers = customer_rows(layout, df)
+        customer_current = to_numeric_array(customers[current_col])
+        contribution_error = None
+        if is_first_day:
+            try:
+                customer_prev = customer_previous_values(customers[sequence_col], extra_workbook, previous_volumes)
+            except AnalysisError as e:
+                customer_prev = np.full(len(customers), np.nan)
+                contribution_error = e.message
+        else:
+            customer_prev = to_numeric_array(customers[prev_col])
+        contribution_index = build_contribution_index(layout, total_rows, customers,
+                                                      customer_current, customer_prev, contribution_error)
+
+        row_ids = total_rows[sequence_col].tolist()
+        if layout.name_col:
+            row_names = total_rows[layout.name_col].tolist()
+        else:
+            row_names = [f"合计行{row_id}" for row_id in row_ids]
+
+        processed_data = build_change_records(row_ids, row_names, f"{current_day}日", changes)
+        processed_index = ChangeRateIndex(processed_data, changes['change_rate'], abnormal_threshold)
+        abnormal_records = processed_index.abnormal_records()
+
+        total_current_gas = float(np.nansum(changes['current']))
+        total_prev_gas = float(np.nansum(changes['previous']))
+
+        # 生成分析报告
+        result_text = f"""=== 数据分析报告 ===
+生成时间: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
+分析参数:
+├── 异常阈值: {abnormal_threshold}%
+├── 分析日期: {analysis_date}
+├── 主文件: {main_filename}
+"""
+
+        if is_first_day and extra_workbook is not None:
+            result_text += f"└── 月度文件: {extra_filename}\n\n"
+        elif is_first_day:
+            result_text += "└── 月度文件: 使用历史数据\n\n"
+        else:
+            result_text += "└── 月度文件: 不需要\n\n"
+
+        result_text += "分析过程:\n"
+        result_text += "├── 正在读取文件数据... ✓\n"
+        result_text += "├── 正在解析数据格式... ✓\n"
+        result_text += "├── 查找合计行数据... ✓\n"
+        result_text += "├── 计算气量变化... ✓\n"
+        result_text += "└── 生成分析报告... ✓\n\n"
+
+        result_text += f"分析结果 (阈值 {abnormal_threshold}%):\n"
+        result_text += f"├── 当日总气量: {total_current_gas} 万立方米\n"
+        result_text += f"├── 前日总气量: {total_prev_gas} 万立方米\n"
+        result_text += f"├── 总变化量: {total_current_gas - total_prev_gas} 万立方米\n"
+        result_text += f"├── 总变化率: {(total_current_gas - total_prev_gas) / total_prev_gas * 100 if total_prev_gas != 0 else 0}%\n"
+        result_text += f"└── 异常数据数量: {len(abnormal_records)}\n\n"
+
+        if abnormal_records:
+            result_text += "异常数据详情:\n"
+            for record in abnormal_records:
+                result_text += f"├── {record['名称']}: {record['气量(万立方米)']} → {record['前一天气量(万立方米)']} (变化: {record['变化量(万立方米)']}, 变化率: {record['变化率(%)']})\n"
+            result_text += "\n"
+
+        result_text += "建议操作:\n"
+        result_text += "├── 查看详细报告\n"
+        result_text += "├── 导出分析结果\n"
+        result_text += "└── 调整阈值重新分析\n"
+
+        return {
+            'result_text': result_text,
+            'analysis_date': analysis_date,
+            'abnormal_threshold': abnormal_threshold,
+            'abnormal_records': abnormal_records,
+            'total_current_gas': total_current_gas,
+            'total_prev_gas': total_prev_gas,
+            'index': processed_index,
+            'contributions': contribution_index,
+            'source': main_workbook.source_id(source_name or main_filename),
+            'columns': {
+                '行号': total_rows.index.to_numpy(),
+                '序号': total_rows[sequence_col].to_numpy(),
+                '名称': np.asarray(row_names, dtype=object),
+                '分类': total_rows[category_col].to_numpy() if category_col else None,
+                '分组': np.asarray([total_group(name) for name in total_rows[layout.name_col].tolist()]
+                                 if layout.name_col else [None] * len(row_ids), dtype=object),
+                '气量(万立方米)': changes['current'],
+                '前一天气量(万立方米)': changes['previous'],
+                '变化量(万立方米)': changes['change'],
+                '变化率(%)': changes['change_rate'],
+                '异常': changes['abnormal']
+            },
+            # 客户行的气量，写入历史库供以后1号没有月度补充文件时取前一天气量
+            'customers': {
+                '行号': customers.index.to_numpy(),
+                '序号': customers[sequence_col].to_numpy(),
+                '名称': customers[layout.name_col].to_numpy() if layout.name_col else None,
+                '分类': customers[category_col].to_numpy() if category_col else None,
+                '气量(万立方米)': customer_current,
+                '前一天气量(万立方米)': customer_prev
+            },
+            'last_month_data': last_month_data
+        }
+
+    except AnalysisError:
+        raise
+    except Exception as e:
+        raise AnalysisError(f'处理文件时出错: {str(e)}', 500)
+
+
+def analysis_summary(result):
+    """分析结果中需要返回给调用方的部分（报告、异常记录、总气量和全部记录），均可直接序列化"""
+    return {
+        'result_text': result['result_text'],
+        'abnormal_threshold': result['abnormal_threshold'],
+        'abnormal_count': len(result['abnormal_records']),
+        'abnormal_records': result['abnormal_records'],
+        'total_current_gas': result['total_current_gas'],
+        'total_prev_gas': result['total_prev_gas'],
+        'source': result['source'],
+        'data': result['index'].records
+    }
+
+
+def file_cache_key(path):
+    """本地文件的缓存键：路径、大小和修改时间，不需要读取文件内容计算哈希"""
+    stat = os.stat(path)
+    return f"file:{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def run_analysis_file(main_path, analysis_date, abnormal_threshold=DEFAULT_ABNORMAL_THRESHOLD, extra_path=None):
+    """直接从磁盘读取本地文件执行分析，返回 analysis_summary 的结果
+
+    供桌面端在进程池中调用，参数和返回值都可被 pickle；可预期的错误以 AnalysisError 抛出。
+    另外返回按列存放的结果数组 columns，桌面端表格直接使用，不必再从记录列表转换。
+    """
+    with ExitStack() as stack:
+        main_workbook = UploadedWorkbook(stack.enter_context(open(main_path, 'rb')), file_cache_key(main_path))
+        extra_workbook = None
+        if extra_path:
+            extra_workbook = UploadedWorkbook(stack.enter_context(open(extra_path, 'rb')), file_cache_key(extra_path))
+
+        result = run_analysis(main_workbook, os.path.basename(main_path), analysis_date, abnormal_threshold,
+                              extra_workbook, os.path.basename(extra_path) if extra_path else None)
+        summary = analysis_summary(result)
+        summary['columns'] = result['columns']
+        return summary
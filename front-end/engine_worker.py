@@ -0,0 +1,29 @@
+# engine_worker.py
+"""在本机分析进程池的工作进程中执行的函数
+
+界面进程只需引用本模块中的函数提交给进程池，本模块不导入 pandas/numpy；
+分析引擎 analysis_engine 在工作进程中第一次调用时才导入，界面进程始终不加载它。
+"""
+from repo_path import add_root_to_path
+
+
+class EngineError(Exception):
+    """工作进程中可预期的分析错误
+
+    分析引擎的 AnalysisError 在界面进程中反序列化时需要导入分析引擎，这里转换为只带错误信息的异常。
+    """
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def run_analysis_file(main_path, analysis_date, abnormal_threshold, extra_path=None):
+    """在工作进程中调用 analysis_engine.run_analysis_file，返回值相同"""
+    add_root_to_path()
+    from analysis_engine import AnalysisError, run_analysis_file as run_engine_analysis
+
+    try:
+        return run_engine_analysis(main_path, analysis_date, abnormal_threshold, extra_path)
+    except AnalysisError as e:
+        raise EngineError(e.message) from None
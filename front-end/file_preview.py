@@ -0,0 +1,121 @@
+# file_preview.py
+from PySide6.QtCore import QObject, Signal
+from concurrent.futures import ThreadPoolExecutor
+from repo_path import add_root_to_path
+import copy
+import os
+
+add_root_to_path()
+from workbook_preview import preview_workbook, scan_total_row
+
+# 预览只读取少量数据，两个线程足够同时预览主文件和补充文件
+_preview_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='file-preview')
+
+
+def selected_file_text(file_path):
+    """已选择文件的名称和大小"""
+    file_name = os.path.basename(file_path)
+    file_size = os.path.getsize(file_path)
+
+    size_str = f"{file_size/1024:.1f} KB" if file_size > 1024 else f"{file_size} 字节"
+    return f"已选择: {file_name} ({size_str})"
+
+
+def describe_days(days):
+    """日期列的简要说明，如 "1日-31日（共31列）\""""
+    if not days:
+        return "未找到"
+    days = sorted(days)
+    if days == list(range(days[0], days[-1] + 1)):
+        return f"{days[0]}日-{days[-1]}日（共{len(days)}列）"
+    return "、".join(f"{day}日" for day in days)
+
+
+def describe_preview(preview, expected_days=(), check_dates=True, check_totals=True):
+    """预览结果的说明文字
+
+    expected_days 为本次分析需要的日期列（几日），缺少时给出提示；
+    check_dates 为 False 时按对账等非月度监控表的文件处理，不要求序号列和日期列；
+    check_totals 为 False 时不显示合计行。
+    """
+    lines = [f"表头识别: 数据从第{preview.data_start_row + 1}行开始，共{len(preview.columns)}列"]
+    lines.append(f"序号列: {preview.sequence_col or '未找到'} | 分类列: {preview.category_col or '未找到'}"
+                 f" | 名称列: {preview.name_col or '未找到'}")
+    if check_dates or preview.day_columns:
+        lines.append(f"日期列: {describe_days(preview.day_columns)}")
+
+    warnings = []
+    if check_dates and preview.sequence_col is None:
+        warnings.append('未找到"序号"列')
+    missing_days = [day for day in expected_days if day not in preview.day_columns]
+    if check_dates and not preview.day_columns:
+        warnings.append("未找到日期列")
+    elif missing_days:
+        warnings.append("缺少" + "、".join(f"{day}日" for day in missing_days) + "的气量列")
+
+    if check_totals:
+        if preview.total_row:
+            lines.append("合计行: 已找到")
+        elif preview.total_row is False:
+            lines.append("合计行: 未找到")
+            warnings.append('未找到"合计"行')
+        elif preview.category_col is not None:
+            lines.append("合计行: 正在检查...")
+        else:
+            lines.append("合计行: 将在分析时确认")
+
+    lines.extend(f"⚠ {warning}" for warning in warnings)
+    lines.append(f"（表头预览耗时 {preview.elapsed * 1000:.0f} 毫秒）")
+    return "\n".join(lines)
+
+
+def preview_text(file_path, preview, **options):
+    """已选择文件的说明：名称和大小，以及表头预览结果；preview 为错误信息时显示无法预览
+
+    options 传给 describe_preview。
+    """
+    if isinstance(preview, str):
+        detail = f"无法预览: {preview}"
+    else:
+        detail = describe_preview(preview, **options)
+    return selected_file_text(file_path) + "\n" + detail
+
+
+def show_reconcile_preview(file_path, preview, file_labels):
+    """在对账页面显示表头预览；对账文件按客户匹配，不要求日期列和合计行
+
+    file_labels 为 (已选择的文件路径, 说明标签) 序列，只更新路径与 file_path 相同的标签，
+    其余的是用户已换掉的文件的过时结果。
+    """
+    for path, label in file_labels:
+        if path == file_path:
+            label.setText(preview_text(path, preview, check_dates=False, check_totals=False))
+
+
+class FilePreviewer(QObject):
+    """在后台线程中预览选中的工作簿
+
+    先读取表头和开头几行并发出 previewed；开头几行中没有合计行时再扫描整个工作表，
+    确认后再次发出 previewed。两次之间用户可能已换了文件，页面按文件路径丢弃过时的结果。
+    """
+
+    # 文件路径、WorkbookPreview
+    previewed = Signal(str, object)
+    # 文件路径、错误信息
+    failed = Signal(str, str)
+
+    def preview(self, path, scan_totals=True):
+        _preview_executor.submit(self.run, path, scan_totals)
+
+    def run(self, path, scan_totals):
+        try:
+            preview = preview_workbook(path)
+            self.previewed.emit(path, preview)
+
+            if scan_totals and preview.total_row is None and preview.category_col is not None:
+                # 已发出的对象可能正在界面线程中使用，在副本上记录扫描结果
+                preview = copy.copy(preview)
+                scan_total_row(preview)
+                self.previewed.emit(path, preview)
+        except Exception as e:
+            self.failed.emit(path, str(e))
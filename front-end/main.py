@@ -1,13 +1,25 @@
+import time
+# 启动计时从导入 Qt 之前开始
+STARTUP_BEGIN = time.perf_counter()
+
+import importlib.util
+import json
+import os
 import sys
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QHBoxLayout,
     QVBoxLayout, QPushButton, QStackedWidget, QLabel
 )
-from PySide6.QtCore import Qt
-from step1 import HomePage
-from step2 import A8Page
-from step3 import Step3Page
-from qt_material import apply_stylesheet
+from PySide6.QtCore import Qt, QDir, QTimer
+from PySide6.QtGui import QColor, QFontDatabase, QGuiApplication, QPalette
+
+# 界面主题
+THEME = 'light_blue.xml'
+# 渲染后的主题样式表缓存目录，可通过环境变量 MARKETING_CACHE_DIR 修改
+CACHE_DIR = os.environ.get('MARKETING_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'marketing-analysis'))
+# 启动计时模式：命令行参数 --measure-startup 或环境变量 MARKETING_MEASURE_STARTUP=1，
+# 窗口第一次显示后输出各步骤耗时并退出
+MEASURE_STARTUP = '--measure-startup' in sys.argv or os.environ.get('MARKETING_MEASURE_STARTUP') == '1'
 
 class NavigationBar(QWidget):
     def __init__(self):
@@ -76,8 +88,9 @@ class MainWindow(QMainWindow):
         self.stacked_widget = QStackedWidget()
         main_layout.addWidget(self.stacked_widget)
 
-        # 创建页面和导航按钮
+        # 创建导航按钮；页面在第一次切换到时才创建
         self.pages = {}
+        self.page_creators = {}
         self.setup_pages()
 
     def setup_pages(self):
@@ -91,38 +104,131 @@ class MainWindow(QMainWindow):
         for i, (name, creator) in enumerate(page_definitions):
             # 创建导航按钮
             button = self.nav_bar.add_button(name)
-
-            # 创建页面
-            page = creator()
-            self.stacked_widget.addWidget(page)
-            self.pages[name] = page
+            self.page_creators[name] = creator
 
             # 连接按钮点击事件
-            button.clicked.connect(lambda idx=i, btn=button: self.switch_page(idx, btn))
+            button.clicked.connect(lambda checked=False, page_name=name, btn=button: self.switch_page(page_name, btn))
 
-            # 设置第一个按钮为选中状态
+            # 第一个页面启动时即显示
             if i == 0:
-                button.setChecked(True)
+                self.switch_page(name, button)
+
+    def get_page(self, name):
+        """返回页面，第一次访问时创建并加入堆叠窗口"""
+        page = self.pages.get(name)
+        if page is None:
+            page = self.page_creators[name]()
+            self.stacked_widget.addWidget(page)
+            self.pages[name] = page
+        return page
 
-    def switch_page(self, index, button):
+    def switch_page(self, name, button):
         # 切换页面
-        self.stacked_widget.setCurrentIndex(index)
+        self.stacked_widget.setCurrentWidget(self.get_page(name))
 
         # 更新按钮选中状态
         self.nav_bar.set_active_button(button)
 
+    # 各页面模块在创建页面时才导入，启动时只加载首页
     def create_home_page(self):
+        from step1 import HomePage
         return HomePage()
 
     def create_A8_page(self):
+        from step2 import A8Page
         return A8Page()
 
     def create_step3_page(self):
+        from step3 import Step3Page
         return Step3Page()
 
+
+def load_theme_cache(path, stamp):
+    """读取主题缓存，与当前主题和 qt_material 版本不一致或图标已被删除时返回 None"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cache.get('stamp') != stamp or not os.path.isdir(cache.get('icon_dir', '')):
+        return None
+    return cache
+
+
+def apply_theme(app, theme=THEME):
+    """应用 qt_material 主题
+
+    第一次运行时由 qt_material 生成图标、渲染样式表，并把结果写入缓存；之后启动直接读取缓存，
+    只做 apply_stylesheet 中注册字体、图标路径和调色板的几步，不再导入 qt_material 和渲染模板。
+    """
+    spec = importlib.util.find_spec('qt_material')
+    package_dir = os.path.dirname(spec.origin)
+    # qt_material 升级后缓存失效
+    stamp = f"{theme}:{os.path.getmtime(spec.origin)}"
+    cache_path = os.path.join(CACHE_DIR, os.path.splitext(theme)[0] + '.json')
+
+    cache = load_theme_cache(cache_path, stamp)
+    if cache is None:
+        import qt_material
+        from qt_material.resources import RESOURCES_PATH
+
+        cache = {
+            'stamp': stamp,
+            'stylesheet': qt_material.build_stylesheet(theme),
+            'text_color': qt_material.get_theme(theme)['primaryColor'],
+            'icon_dir': os.path.join(RESOURCES_PATH, 'theme'),
+        }
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+        except OSError:
+            # 缓存写不进去只影响下次启动速度
+            pass
+    else:
+        fonts_dir = os.path.join(package_dir, 'fonts', 'roboto')
+        for font in os.listdir(fonts_dir):
+            if font.endswith('.ttf'):
+                QFontDatabase.addApplicationFont(os.path.join(fonts_dir, font))
+        QDir.addSearchPath('icon', cache['icon_dir'])
+        QDir.addSearchPath('qt_material', os.path.join(package_dir, 'resources'))
+
+        palette = QGuiApplication.palette()
+        color = QColor(cache['text_color'])
+        color.setAlpha(92)
+        palette.setColor(QPalette.ColorRole.Text, color)
+        QGuiApplication.setPalette(palette)
+
+    app.setStyle('Fusion')
+    app.setStyleSheet(cache['stylesheet'])
+
+
+def report_startup(marks):
+    """输出启动各步骤的耗时和窗口第一次显示的总耗时"""
+    marks.append(("首个窗口显示", time.perf_counter()))
+    previous = STARTUP_BEGIN
+    for name, moment in marks:
+        print(f"{name}: {(moment - previous) * 1000:.1f} ms")
+        previous = moment
+    print(f"启动总耗时: {(previous - STARTUP_BEGIN) * 1000:.1f} ms")
+
+
 if __name__ == "__main__":
+    marks = [("导入模块", time.perf_counter())]
     app = QApplication(sys.argv)
+    marks.append(("创建应用", time.perf_counter()))
+
     window = MainWindow()
-    apply_stylesheet(app, theme='light_blue.xml')
+    marks.append(("创建窗口", time.perf_counter()))
+    apply_theme(app)
+    marks.append(("应用主题", time.perf_counter()))
     window.show()
+
+    # step1 已随首页导入，这里只是取退出时的清理函数
+    from step1 import shutdown_engine_pool
+    app.aboutToQuit.connect(shutdown_engine_pool)
+
+    if MEASURE_STARTUP:
+        # 事件循环处理完首次显示后再计时
+        QTimer.singleShot(0, lambda: (report_startup(marks), app.quit()))
     sys.exit(app.exec())
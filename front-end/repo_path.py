@@ -0,0 +1,15 @@
+# repo_path.py
+"""前端导入后端模块的路径设置
+
+workbook_preview.py、analysis_engine.py 等后端模块位于仓库根目录，即 front-end 的上一级。
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def add_root_to_path():
+    """将仓库根目录加入模块搜索路径，之后即可导入后端模块"""
+    if ROOT_DIR not in sys.path:
+        sys.path.append(ROOT_DIR)
@@ -0,0 +1,189 @@
+# result_table.py
+from PySide6.QtWidgets import QTableView, QAbstractItemView, QHeaderView
+from PySide6.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PySide6.QtGui import QColor
+
+# 表格显示的列：(字段名, 表头)
+RESULT_COLUMNS = [
+    ('序号', '序号'),
+    ('名称', '名称'),
+    ('气量(万立方米)', '当日气量(万立方米)'),
+    ('前一天气量(万立方米)', '前日气量(万立方米)'),
+    ('变化量(万立方米)', '变化量(万立方米)'),
+    ('变化率(%)', '变化率(%)'),
+]
+NUMERIC_FIELDS = ('气量(万立方米)', '前一天气量(万立方米)', '变化量(万立方米)', '变化率(%)')
+
+ABNORMAL_BACKGROUND = QColor('#ffebee')
+ABNORMAL_FOREGROUND = QColor('#c62828')
+
+# data() 对每个可见单元格的每种角色都会调用；与 Qt 枚举比较每次要几微秒，预先取出整数值
+DISPLAY_ROLE = Qt.DisplayRole.value
+ALIGNMENT_ROLE = Qt.TextAlignmentRole.value
+BACKGROUND_ROLE = Qt.BackgroundRole.value
+FOREGROUND_ROLE = Qt.ForegroundRole.value
+NUMERIC_ALIGNMENT = (Qt.AlignRight | Qt.AlignVCenter).value
+
+
+def columns_from_records(records):
+    """把接口返回的记录列表转换为按列存放的数组，与本机分析返回的 columns 结构相同
+
+    变化率在记录中是 "12.5%" 形式的字符串，这里转回数值。
+    """
+    # numpy 较重，只在收到结果时导入
+    import numpy as np
+
+    def numeric(field, parse=float):
+        return np.array([parse(r[field]) if r.get(field) is not None else np.nan for r in records], dtype=float)
+
+    return {
+        '序号': np.array([r.get('序号') for r in records], dtype=object),
+        '名称': np.array([r.get('名称') for r in records], dtype=object),
+        '气量(万立方米)': numeric('气量(万立方米)'),
+        '前一天气量(万立方米)': numeric('前一天气量(万立方米)'),
+        '变化量(万立方米)': numeric('变化量(万立方米)'),
+        '变化率(%)': numeric('变化率(%)', lambda value: float(str(value).rstrip('%'))),
+        '异常': np.array([bool(r.get('异常')) for r in records], dtype=bool),
+    }
+
+
+class ResultTableModel(QAbstractTableModel):
+    """按列存放的分析结果的表格模型
+
+    数据保存在每列一个数组中，视图只为可见的单元格调用 data()，不预先生成任何文本；
+    排序不移动数据，只替换行号置换 _order，各列的排序置换在第一次按该列排序时计算并缓存。
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._columns = {}
+        self._size = 0
+        self._order = None  # 显示行 -> 数据行；None 表示原始顺序
+        # 字段 -> (升序置换, 非缺失值数量)；缺失值始终排在最后
+        self._sort_orders = {}
+
+    def set_columns(self, columns):
+        """替换全部数据，columns 为 {字段名: 数组}，需包含 RESULT_COLUMNS 中的字段和"异常\""""
+        self.beginResetModel()
+        self._columns = columns
+        self._size = len(columns['序号']) if columns else 0
+        self._order = None
+        self._sort_orders = {}
+        self.endResetModel()
+
+    def clear(self):
+        self.set_columns({})
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._size
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(RESULT_COLUMNS)
+
+    def headerData(self, section, orientation, role=DISPLAY_ROLE):
+        if role == DISPLAY_ROLE and orientation == Qt.Horizontal:
+            return RESULT_COLUMNS[section][1]
+        return None
+
+    def row_position(self, row):
+        """显示行对应的数据行"""
+        return row if self._order is None else int(self._order[row])
+
+    def is_abnormal(self, row):
+        return bool(self._columns['异常'][self.row_position(row)])
+
+    def data(self, index, role=DISPLAY_ROLE):
+        if not index.isValid():
+            return None
+        field = RESULT_COLUMNS[index.column()][0]
+
+        if role == DISPLAY_ROLE:
+            return self.format_value(field, self._columns[field][self.row_position(index.row())])
+        if role == ALIGNMENT_ROLE and field in NUMERIC_FIELDS:
+            return NUMERIC_ALIGNMENT
+        if role == BACKGROUND_ROLE and self.is_abnormal(index.row()):
+            return ABNORMAL_BACKGROUND
+        if role == FOREGROUND_ROLE and self.is_abnormal(index.row()):
+            return ABNORMAL_FOREGROUND
+        return None
+
+    @staticmethod
+    def format_value(field, value):
+        if value is None or value != value:
+            return ""
+        if field == '变化率(%)':
+            return f"{value:.2f}%"
+        if field in NUMERIC_FIELDS:
+            return f"{value:,.2f}"
+        if isinstance(value, float) and value.is_integer():
+            # 序号从 Excel 读出时可能是浮点数
+            return str(int(value))
+        return str(value)
+
+    def sort_order(self, field):
+        """字段的升序置换和非缺失值数量，第一次使用时计算"""
+        if field not in self._sort_orders:
+            import numpy as np
+
+            values = self._columns[field]
+            if field in NUMERIC_FIELDS:
+                values = np.asarray(values, dtype=float)
+                valid = int(np.count_nonzero(~np.isnan(values)))
+                order = np.argsort(values, kind='stable')
+            else:
+                # 序号和名称可能混有数字、文本和空值：空值排最后，其余按 (是否文本, 值) 排序
+                keys = [(isinstance(v, str), v) for v in values if v is not None and v == v]
+                present = np.array([v is not None and v == v for v in values], dtype=bool)
+                positions = np.flatnonzero(present)
+                ranked = sorted(range(len(keys)), key=keys.__getitem__)
+                order = np.concatenate([positions[ranked], np.flatnonzero(~present)]).astype(np.intp)
+                valid = len(keys)
+            self._sort_orders[field] = (order, valid)
+        return self._sort_orders[field]
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        if not self._size:
+            return
+        self.layoutAboutToBeChanged.emit()
+        if column < 0:
+            self._order = None
+        else:
+            ascending, valid = self.sort_order(RESULT_COLUMNS[column][0])
+            if order == Qt.DescendingOrder:
+                # 降序时缺失值仍排在最后
+                import numpy as np
+                self._order = np.concatenate([ascending[:valid][::-1], ascending[valid:]])
+            else:
+                self._order = ascending
+        self.layoutChanged.emit()
+
+
+class ResultTableView(QTableView):
+    """分析结果表格：固定行高，点击表头排序，异常行高亮"""
+
+    def __init__(self, model, parent=None):
+        super().__init__(parent)
+        self.setModel(model)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.setWordWrap(False)
+
+        # 固定行高：视图不必逐行计算高度，十万行也只绘制可见的部分
+        vertical_header = self.verticalHeader()
+        vertical_header.setSectionResizeMode(QHeaderView.Fixed)
+        vertical_header.setDefaultSectionSize(self.fontMetrics().height() + 8)
+        vertical_header.hide()
+
+        horizontal_header = self.horizontalHeader()
+        horizontal_header.setSectionResizeMode(QHeaderView.Interactive)
+        horizontal_header.setStretchLastSection(True)
+        # 按内容调整列宽时只取可见行附近的少量行估算
+        horizontal_header.setResizeContentsPrecision(200)
+        horizontal_header.setSortIndicator(-1, Qt.AscendingOrder)
+        self.setSortingEnabled(True)
+
+    def show_columns(self, columns):
+        """显示新的分析结果，恢复原始顺序并按可见行调整列宽"""
+        self.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+        self.model().set_columns(columns)
+        self.resizeColumnsToContents()
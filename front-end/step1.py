@@ -2,12 +2,239 @@
 from PySide6.QtWidgets import (
     QWidget, QVBoxLayout, QLabel, QPushButton,
     QFileDialog, QMessageBox, QSpinBox, QDateEdit,
-    QHBoxLayout, QGroupBox, QTextEdit, QSizePolicy
+    QHBoxLayout, QGroupBox, QTextEdit, QSizePolicy, QComboBox
 )
-from PySide6.QtCore import Qt, QDate
+from PySide6.QtCore import Qt, QDate, QObject, QFile, QIODevice, QTimer, QElapsedTimer, QUrl, Signal
 from PySide6.QtGui import QDragEnterEvent, QDropEvent
+from PySide6.QtNetwork import QNetworkAccessManager, QNetworkRequest, QNetworkReply, QHttpMultiPart, QHttpPart
+from result_table import ResultTableModel, ResultTableView, columns_from_records
+from file_preview import FilePreviewer, selected_file_text, preview_text
+from engine_worker import run_analysis_file
+import json
 import os
 
+# 后端服务地址，可通过环境变量 MARKETING_API_URL 修改
+API_BASE_URL = os.environ.get('MARKETING_API_URL', 'http://127.0.0.1:5000')
+
+# 分析方式：embedded 在本机进程池中直接读取文件分析，remote 提交给后端服务；
+# 可通过环境变量 MARKETING_ANALYSIS_MODE 设置默认值，界面上也可以切换
+EMBEDDED_MODE = 'embedded'
+REMOTE_MODE = 'remote'
+ANALYSIS_MODE = os.environ.get('MARKETING_ANALYSIS_MODE', EMBEDDED_MODE)
+
+_engine_pool = None
+
+
+def get_engine_pool():
+    """本机分析进程池，首次使用时创建
+
+    工作进程常驻，已解析的工作簿缓存在进程内，重复分析同一文件时不必重新读取。
+    分析引擎只在工作进程中导入（见 engine_worker），界面进程不加载 pandas。
+    """
+    global _engine_pool
+    if _engine_pool is None:
+        # 进程池相关模块较重，启动时不导入
+        from concurrent.futures import ProcessPoolExecutor
+        import multiprocessing
+
+        # 界面进程已加载 Qt，工作进程统一用 spawn 启动，避免 fork 带来的问题
+        _engine_pool = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) - 1),
+                                           mp_context=multiprocessing.get_context('spawn'))
+    return _engine_pool
+
+
+def shutdown_engine_pool():
+    """退出程序时关闭本机分析进程池，未开始的任务直接丢弃"""
+    global _engine_pool
+    if _engine_pool is not None:
+        _engine_pool.shutdown(wait=False, cancel_futures=True)
+        _engine_pool = None
+
+
+class AnalysisTask(QObject):
+    """一次分析任务的公共部分：阶段计时和通知页面的信号
+
+    各阶段的开始和耗时通过信号通知页面，子类实现 start() 和 cancel()。
+    """
+
+    # 阶段名称、状态（running/done）、已用秒数
+    stage_changed = Signal(str, str, float)
+    upload_progress = Signal(int, int)
+    # 分析结果数据、各阶段耗时 {阶段名称: 秒}
+    succeeded = Signal(dict, dict)
+    failed = Signal(str)
+    cancelled = Signal()
+
+    UPLOAD_STAGE = "上传文件"
+
+    def __init__(self, fields, files, parent=None):
+        super().__init__(parent)
+        self.fields = fields  # 参数 {名称: 值}
+        self.files = files  # 文件 {字段名: 本地路径}
+        self.timings = {}
+        self.current_stage = None
+        self._cancelled = False
+        self._stage_timer = QElapsedTimer()
+
+    def elapsed(self):
+        """当前阶段已用秒数"""
+        return self._stage_timer.elapsed() / 1000
+
+    def enter_stage(self, stage):
+        """结束当前阶段并开始新阶段，记录上一阶段的耗时"""
+        if self.current_stage is not None:
+            self.timings[self.current_stage] = self.elapsed()
+            self.stage_changed.emit(self.current_stage, "done", self.timings[self.current_stage])
+        self.current_stage = stage
+        if stage is not None:
+            self._stage_timer.start()
+            self.stage_changed.emit(stage, "running", 0.0)
+
+
+class AnalysisRequest(AnalysisTask):
+    """向后端 /api/analyze 提交一次分析
+
+    通过 QNetworkAccessManager 异步发送，上传和等待服务器分析期间不阻塞界面；
+    cancel() 会中止请求。session_id 为之前分析返回的会话标识，通过 X-Session-Id 发送，
+    为空时由服务器分配，成功后更新为服务器返回的会话标识。
+    """
+
+    SERVER_STAGE = "服务器分析"
+
+    def __init__(self, manager, fields, files, parent=None, session_id=None):
+        super().__init__(fields, files, parent)
+        self.manager = manager
+        self.session_id = session_id
+        self.reply = None
+
+    def start(self):
+        multi_part = QHttpMultiPart(QHttpMultiPart.FormDataType, self)
+
+        for name, value in self.fields.items():
+            part = QHttpPart()
+            part.setHeader(QNetworkRequest.ContentDispositionHeader, f'form-data; name="{name}"')
+            part.setBody(str(value).encode('utf-8'))
+            multi_part.append(part)
+
+        for name, path in self.files.items():
+            device = QFile(path, multi_part)
+            if not device.open(QIODevice.ReadOnly):
+                self.failed.emit(f"无法读取文件: {path}")
+                return
+            part = QHttpPart()
+            file_name = os.path.basename(path).replace('"', '')
+            part.setHeader(QNetworkRequest.ContentDispositionHeader,
+                           f'form-data; name="{name}"; filename="{file_name}"')
+            part.setBodyDevice(device)
+            multi_part.append(part)
+
+        request = QNetworkRequest(QUrl(f"{API_BASE_URL}/api/analyze"))
+        # 分析大文件可能需要较长时间，不设置传输超时
+        request.setTransferTimeout(0)
+        if self.session_id:
+            request.setRawHeader(b"X-Session-Id", self.session_id.encode('utf-8'))
+        self.reply = self.manager.post(request, multi_part)
+        multi_part.setParent(self.reply)
+        self.reply.uploadProgress.connect(self.on_upload_progress)
+        self.reply.finished.connect(self.on_finished)
+        self.enter_stage(self.UPLOAD_STAGE)
+
+    def cancel(self):
+        if self.reply is not None and self.reply.isRunning():
+            self._cancelled = True
+            self.reply.abort()
+
+    def on_upload_progress(self, sent, total):
+        self.upload_progress.emit(sent, total)
+        if total > 0 and sent == total and self.current_stage == self.UPLOAD_STAGE:
+            self.enter_stage(self.SERVER_STAGE)
+
+    def on_finished(self):
+        reply = self.reply
+        reply.deleteLater()
+
+        if self._cancelled or reply.error() == QNetworkReply.OperationCanceledError:
+            self.cancelled.emit()
+            return
+
+        body = bytes(reply.readAll())
+        if self.current_stage == self.UPLOAD_STAGE:
+            # 没有收到上传进度（如文件很小）时，上传阶段到此结束
+            self.enter_stage(self.SERVER_STAGE)
+        self.enter_stage(None)
+
+        try:
+            data = json.loads(body.decode('utf-8')) if body else {}
+        except ValueError:
+            data = {}
+
+        if reply.error() != QNetworkReply.NoError and not data.get('error'):
+            self.failed.emit(f"无法连接分析服务: {reply.errorString()}")
+        elif data.get('error') or 'result_text' not in data:
+            self.failed.emit(data.get('error') or "分析服务返回的数据无效")
+        else:
+            self.session_id = data.get('session_id') or self.session_id
+            self.succeeded.emit(data, self.timings)
+
+
+class EmbeddedAnalysis(AnalysisTask):
+    """在本机进程池中执行一次分析
+
+    直接从磁盘读取文件，不经过上传和 HTTP；分析在工作进程中进行，不阻塞界面。
+    已开始执行的任务无法中断，cancel() 之后其结果会被丢弃。
+    """
+
+    ANALYSIS_STAGE = "本机分析"
+
+    # 工作进程结束后由进程池的回调线程发出，经队列连接回到界面线程处理
+    _future_done = Signal(object)
+
+    def __init__(self, fields, files, parent=None):
+        super().__init__(fields, files, parent)
+        self.future = None
+        self._future_done.connect(self.on_finished)
+
+    def start(self):
+        self.enter_stage(self.ANALYSIS_STAGE)
+        self.future = get_engine_pool().submit(
+            run_analysis_file,
+            self.files["main_file"],
+            self.fields["analysis_date"],
+            float(self.fields["threshold"]),
+            self.files.get("extra_file")
+        )
+        self.future.add_done_callback(self.notify_finished)
+
+    def notify_finished(self, future):
+        try:
+            self._future_done.emit(future)
+        except RuntimeError:
+            # 取消后页面已释放本对象，结果无人接收
+            pass
+
+    def cancel(self):
+        if self.future is not None and not self.future.done():
+            self._cancelled = True
+            if not self.future.cancel():
+                # 已在工作进程中执行，无法中止，直接结束并忽略结果
+                self.cancelled.emit()
+
+    def on_finished(self, future):
+        if self._cancelled:
+            if future.cancelled():
+                self.cancelled.emit()
+            return
+
+        self.enter_stage(None)
+        error = future.exception()
+        if error is None:
+            self.succeeded.emit(future.result(), self.timings)
+        elif isinstance(error, ImportError):
+            self.failed.emit(f"无法加载本机分析模块: {error}")
+        else:
+            self.failed.emit(getattr(error, 'message', None) or f"本机分析失败: {error}")
+
+
 class HomePage(QWidget):
     def __init__(self):
         super().__init__()
@@ -44,6 +271,22 @@ class HomePage(QWidget):
         self.extra_file = None
         self.setAcceptDrops(True)
 
+        # 选择文件后在后台预览表头 {文件路径: WorkbookPreview 或错误信息}
+        self.file_previews = {}
+        self.file_previewer = FilePreviewer(self)
+        self.file_previewer.previewed.connect(self.on_file_previewed)
+        self.file_previewer.failed.connect(self.on_file_previewed)
+
+        # 后台分析请求；进行中时分析按钮变为取消按钮
+        self.network_manager = None  # 第一次向服务器提交分析时创建
+        self.session_id = None  # 服务器分配的会话标识，之后的分析都使用同一会话
+        self.analysis_request = None
+        self.analysis_header = ""
+        self.stage_lines = {}
+        self.stage_timer = QTimer(self)
+        self.stage_timer.setInterval(200)
+        self.stage_timer.timeout.connect(self.refresh_running_stage)
+
     def create_parameter_section(self, layout):
         """创建参数输入区域"""
         group = QGroupBox("分析参数")
@@ -80,9 +323,25 @@ class HomePage(QWidget):
         date_layout.addWidget(date_label)
         date_layout.addWidget(self.date_input)
 
+        # 分析方式
+        mode_widget = QWidget()
+        mode_layout = QVBoxLayout(mode_widget)
+        mode_layout.setContentsMargins(0, 0, 0, 0)
+
+        mode_label = QLabel("分析方式:")
+        self.mode_input = QComboBox()
+        self.mode_input.addItem("本机分析", EMBEDDED_MODE)
+        self.mode_input.addItem("服务器分析", REMOTE_MODE)
+        self.mode_input.setCurrentIndex(max(0, self.mode_input.findData(ANALYSIS_MODE)))
+        self.mode_input.setMaximumWidth(200)
+
+        mode_layout.addWidget(mode_label)
+        mode_layout.addWidget(self.mode_input)
+
         # 设置等宽布局
         group_layout.addWidget(num_widget)
         group_layout.addWidget(date_widget)
+        group_layout.addWidget(mode_widget)
 
         layout.addWidget(group)
 
@@ -129,7 +388,7 @@ class HomePage(QWidget):
         """创建分析按钮"""
         self.analyze_btn = QPushButton("开始分析")
         self.analyze_btn.setFixedWidth(200)
-        self.analyze_btn.clicked.connect(self.analyze_data)
+        self.analyze_btn.clicked.connect(self.on_analyze_clicked)
         self.analyze_btn.setEnabled(False)
 
         button_layout = QHBoxLayout()
@@ -149,7 +408,13 @@ class HomePage(QWidget):
         self.result_text.setReadOnly(True)
         self.result_text.setPlaceholderText("分析结果将显示在这里...")
 
+        # 逐行结果，异常行高亮，点击表头排序
+        self.result_model = ResultTableModel(self)
+        self.result_table = ResultTableView(self.result_model)
+        self.result_table.hide()
+
         result_layout.addWidget(self.result_text)
+        result_layout.addWidget(self.result_table)
         layout.addWidget(result_group)
 
     def on_date_changed(self, date):
@@ -161,6 +426,8 @@ class HomePage(QWidget):
             self.extra_file = None
             self.extra_file_info.setText("未选择月度文件")
 
+        # 所需的日期列随分析日期变化
+        self.refresh_file_info()
         self.validate_inputs()
 
     def dragEnterEvent(self, event: QDragEnterEvent):
@@ -193,24 +460,38 @@ class HomePage(QWidget):
 
     def handle_main_file_selected(self, file_path):
         self.current_file = file_path
-        file_name = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
-
-        size_str = f"{file_size/1024:.1f} KB" if file_size > 1024 else f"{file_size} 字节"
-        self.file_info.setText(f"已选择: {file_name} ({size_str})")
+        self.file_info.setText(selected_file_text(file_path) + "\n正在读取表头...")
+        self.file_previewer.preview(file_path)
         self.validate_inputs()
 
     def handle_extra_file_selected(self, file_path):
         self.extra_file = file_path
-        file_name = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
-
-        size_str = f"{file_size/1024:.1f} KB" if file_size > 1024 else f"{file_size} 字节"
-        self.extra_file_info.setText(f"已选择: {file_name} ({size_str})")
+        self.extra_file_info.setText(selected_file_text(file_path) + "\n正在读取表头...")
+        # 月度补充文件按序号取前一天气量，不需要合计行
+        self.file_previewer.preview(file_path, scan_totals=False)
         self.validate_inputs()
 
+    def on_file_previewed(self, file_path, preview):
+        self.file_previews[file_path] = preview
+        self.refresh_file_info()
+
+    def refresh_file_info(self):
+        """按表头预览和当前分析日期更新文件说明，检查所需的日期列和合计行"""
+        day = self.date_input.date().day()
+        if self.current_file in self.file_previews:
+            expected_days = (day,) if day == 1 else (day, day - 1)
+            self.file_info.setText(preview_text(self.current_file, self.file_previews[self.current_file],
+                                                expected_days=expected_days))
+        if self.extra_file in self.file_previews:
+            self.extra_file_info.setText(preview_text(self.extra_file, self.file_previews[self.extra_file],
+                                                      check_totals=False))
+
     def validate_inputs(self):
         """验证所有输入是否完整"""
+        if self.analysis_request is not None:
+            # 分析进行中，按钮用于取消
+            return
+
         has_main_file = self.current_file is not None
         selected_date = self.date_input.date()
         is_first_day = selected_date.day() == 1
@@ -221,46 +502,112 @@ class HomePage(QWidget):
         else:
             self.analyze_btn.setEnabled(has_main_file)
 
+    def on_analyze_clicked(self):
+        if self.analysis_request is not None:
+            self.analyze_btn.setEnabled(False)
+            self.analyze_btn.setText("正在取消...")
+            self.analysis_request.cancel()
+        else:
+            self.analyze_data()
+
     def analyze_data(self):
-        """执行分析并在文本框中显示结果"""
-        try:
-            intensity = self.number_input.value()
-            date = self.date_input.date().toString("yyyy-MM-dd")
-            main_file = os.path.basename(self.current_file)
+        """异步提交分析请求，分析过程中在文本框中显示各阶段进度"""
+        intensity = self.number_input.value()
+        date = self.date_input.date().toString("yyyy-MM-dd")
 
-            result_text = f"""=== 数据分析报告 ===
-生成时间: {QDate.currentDate().toString("yyyy-MM-dd")}
+        files = {"main_file": self.current_file}
+        if self.date_input.date().day() == 1 and self.extra_file:
+            files["extra_file"] = self.extra_file
 
+        self.analysis_header = f"""=== 数据分析 ===
 分析参数:
 ├── 最大波动百分比: {intensity}%
 ├── 分析日期: {date}
-├── 主文件: {main_file}
+├── 主文件: {os.path.basename(self.current_file)}
 """
-            if self.date_input.date().day() == 1 and self.extra_file:
-                extra_file = os.path.basename(self.extra_file)
-                result_text += f"└── 月度文件: {extra_file}\n\n"
-            else:
-                result_text += "└── 月度文件: 不需要\n\n"
-
-            result_text += "分析过程:\n"
-            result_text += "├── 正在读取文件数据... ✓\n"
-            result_text += "├── 正在解析数据格式... ✓\n"
-            result_text += "├── 应用分析参数... ✓\n"
-            result_text += "└── 生成分析报告... ✓\n\n"
-
-            result_text += f"分析结果 (最大波动 {intensity}%):\n"
-            result_text += f"├── 数据总量: 1,248 条记录\n"
-            result_text += f"├── 有效数据: 1,195 条 (95.8%)\n"
-            result_text += f"├── 异常数据: 53 条 (4.2%)\n"
-            result_text += f"└── 处理耗时: 0.45 秒\n\n"
-
-            result_text += "建议操作:\n"
-            result_text += "├── 查看详细报告\n"
-            result_text += "├── 导出分析结果\n"
-            result_text += "└── 比较历史数据\n"
-
-            self.result_text.setPlainText(result_text)
-
-        except Exception as e:
-            error_msg = f"分析过程中发生错误:\n\n{str(e)}"
-            self.result_text.setPlainText(error_msg)
+        if "extra_file" in files:
+            self.analysis_header += f"└── 月度文件: {os.path.basename(self.extra_file)}\n\n"
+        else:
+            self.analysis_header += "└── 月度文件: 不需要\n\n"
+        self.stage_lines = {}
+        self.render_progress()
+        self.result_table.hide()
+
+        fields = {"threshold": intensity, "analysis_date": date}
+        if self.mode_input.currentData() == EMBEDDED_MODE:
+            self.analysis_request = EmbeddedAnalysis(fields, files, self)
+        else:
+            if self.network_manager is None:
+                self.network_manager = QNetworkAccessManager(self)
+            self.analysis_request = AnalysisRequest(self.network_manager, fields, files, self, self.session_id)
+        self.analysis_request.stage_changed.connect(self.on_stage_changed)
+        self.analysis_request.upload_progress.connect(self.on_upload_progress)
+        self.analysis_request.succeeded.connect(self.on_analysis_succeeded)
+        self.analysis_request.failed.connect(self.on_analysis_failed)
+        self.analysis_request.cancelled.connect(self.on_analysis_cancelled)
+
+        self.analyze_btn.setText("取消分析")
+        self.stage_timer.start()
+        self.analysis_request.start()
+
+    def render_progress(self, footer=""):
+        """按当前各阶段状态重绘结果文本框"""
+        text = self.analysis_header + "分析过程:\n"
+        lines = list(self.stage_lines.values())
+        for i, line in enumerate(lines):
+            text += ("└── " if i == len(lines) - 1 else "├── ") + line + "\n"
+        self.result_text.setPlainText(text + footer)
+
+    def on_stage_changed(self, stage, status, seconds):
+        if status == "done":
+            self.stage_lines[stage] = f"{stage}... ✓ ({seconds:.2f} 秒)"
+        else:
+            self.stage_lines[stage] = f"正在{stage}..."
+        self.render_progress()
+
+    def on_upload_progress(self, sent, total):
+        stage = AnalysisTask.UPLOAD_STAGE
+        if total > 0 and self.analysis_request.current_stage == stage:
+            self.stage_lines[stage] = f"正在{stage}... {sent * 100 // total}%"
+            self.render_progress()
+
+    def refresh_running_stage(self):
+        """定时刷新正在进行的阶段的已用时间"""
+        request = self.analysis_request
+        if request is not None and request.current_stage not in (None, AnalysisTask.UPLOAD_STAGE):
+            self.stage_lines[request.current_stage] = f"正在{request.current_stage}... ({request.elapsed():.1f} 秒)"
+            self.render_progress()
+
+    def finish_analysis(self):
+        """分析结束（成功、失败或取消）后恢复按钮状态"""
+        self.stage_timer.stop()
+        self.analysis_request.deleteLater()
+        self.analysis_request = None
+        self.analyze_btn.setText("开始分析")
+        self.validate_inputs()
+
+    def on_analysis_succeeded(self, data, timings):
+        if isinstance(self.analysis_request, AnalysisRequest):
+            self.session_id = self.analysis_request.session_id
+        self.finish_analysis()
+
+        total = sum(timings.values())
+        timing_text = "耗时统计:\n"
+        for stage, seconds in timings.items():
+            timing_text += f"├── {stage}: {seconds:.2f} 秒\n"
+        timing_text += f"└── 处理耗时: {total:.2f} 秒\n"
+
+        self.result_text.setPlainText(data["result_text"] + "\n" + timing_text)
+
+        # 本机分析直接返回列数组，服务器返回的是记录列表
+        columns = data.get("columns") or columns_from_records(data.get("data", []))
+        self.result_table.show_columns(columns)
+        self.result_table.setVisible(self.result_model.rowCount() > 0)
+
+    def on_analysis_failed(self, message):
+        self.finish_analysis()
+        self.render_progress(f"\n分析过程中发生错误:\n\n{message}")
+
+    def on_analysis_cancelled(self):
+        self.finish_analysis()
+        self.render_progress("\n分析已取消")
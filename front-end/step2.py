@@ -6,6 +6,7 @@ from PySide6.QtWidgets import (
 )
 from PySide6.QtCore import Qt, QDate
 from PySide6.QtGui import QDragEnterEvent, QDropEvent
+from file_preview import FilePreviewer, selected_file_text, show_reconcile_preview
 import os
 
 class A8Page(QWidget):
@@ -39,6 +40,12 @@ class A8Page(QWidget):
 
         self.current_file = None
         self.extra_file = None
+
+        # 选择文件后在后台预览表头 {文件路径: WorkbookPreview 或错误信息}
+        self.file_previews = {}
+        self.file_previewer = FilePreviewer(self)
+        self.file_previewer.previewed.connect(self.on_file_previewed)
+        self.file_previewer.failed.connect(self.on_file_previewed)
         self.setAcceptDrops(True)
 
     def create_main_file_section(self, layout):
@@ -137,22 +144,22 @@ class A8Page(QWidget):
 
     def handle_main_file_selected(self, file_path):
         self.current_file = file_path
-        file_name = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
-
-        size_str = f"{file_size/1024:.1f} KB" if file_size > 1024 else f"{file_size} 字节"
-        self.file_info.setText(f"已选择: {file_name} ({size_str})")
+        self.file_info.setText(selected_file_text(file_path) + "\n正在读取表头...")
+        self.file_previewer.preview(file_path, scan_totals=False)
         self.validate_inputs()
 
     def handle_extra_file_selected(self, file_path):
         self.extra_file = file_path
-        file_name = os.path.basename(file_path)
-        file_size = os.path.getsize(file_path)
-
-        size_str = f"{file_size/1024:.1f} KB" if file_size > 1024 else f"{file_size} 字节"
-        self.extra_file_info.setText(f"已选择: {file_name} ({size_str})")
+        self.extra_file_info.setText(selected_file_text(file_path) + "\n正在读取表头...")
+        self.file_previewer.preview(file_path, scan_totals=False)
         self.validate_inputs()
 
+    def on_file_previewed(self, file_path, preview):
+        """显示表头预览；对账文件按客户匹配，不要求日期列和合计行"""
+        self.file_previews[file_path] = preview
+        show_reconcile_preview(file_path, preview,
+                               ((self.current_file, self.file_info), (self.extra_file, self.extra_file_info)))
+
     def validate_inputs(self):
         """验证所有输入是否完整"""
         has_main_file = self.current_file is not None
@@ -2,13 +2,94 @@ import os
 import pandas as pd
 import re
 import json
-from flask import Flask, request, jsonify
+import threading
+import time
+import sys
+import uuid
+import io
+import shutil
+import tempfile
+import multiprocessing
+import sqlite3
+import warnings
+import pickle
+import heapq
+import unicodedata
+import math
+import hashlib
+from collections import Counter, defaultdict
+from itertools import groupby
+from operator import itemgetter
+from concurrent.futures import ProcessPoolExecutor, wait
+from flask import Flask, Request, Response, request, jsonify, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import numpy as np
+from openpyxl import load_workbook
 from werkzeug.utils import secure_filename
+from analysis_engine import (
+    DEFAULT_ABNORMAL_THRESHOLD, MemoryLRUCache, workbook_cache, history_key,
+    extract_date_from_column_name, to_numeric_array, compute_changes, nan_to_none,
+    build_change_records, UploadedWorkbook, AnalysisError, customer_rows,
+    customer_previous_values, run_analysis, hash_stream, excel_cell_value,
+    analysis_summary
+)
+
+
+
+class SpooledUploadRequest(Request):
+    """上传文件保存在内存缓冲区中，超过 UPLOAD_SPOOL_MAX_BYTES 时才写入临时文件"""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        max_size = app.config['UPLOAD_SPOOL_MAX_BYTES']
+        return tempfile.SpooledTemporaryFile(max_size=max_size, mode='rb+')
+
+    @property
+    def max_content_length(self):
+        """流式对账的上传文件通常很大，单独使用 RECONCILE_DISPATCH_MAX_CONTENT_LENGTH，其余接口使用 MAX_CONTENT_LENGTH"""
+        if self.endpoint == 'reconcile_dispatch':
+            return app.config['RECONCILE_DISPATCH_MAX_CONTENT_LENGTH']
+        return app.config['MAX_CONTENT_LENGTH']
+
+
+class AnalysisJSONProvider(DefaultJSONProvider):
+    """直接序列化 NumPy / pandas 数据的 JSON 提供器
+
+    NumPy 标量和数组、pandas 缺失值在编码时一次性转换（浮点数组中的 NaN 输出为 null），
+    接口不必再逐个值调用 convert_to_serializable 生成中间副本。
+    其余位置的 NaN 和正负无穷（如 tolist() 得到的浮点数）同样输出为 null，不生成无效的 JSON。
+    中文不转义以减小响应体积，字典键按插入顺序输出。
+    """
+
+    ensure_ascii = False
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        try:
+            return super().dumps(obj, allow_nan=False, **kwargs)
+        except ValueError:
+            # 含有非有限浮点数时才逐值替换后重新编码，正常数据不多遍历一次
+            default = kwargs.pop('default', self.default)
+            return super().dumps(replace_non_finite(obj),
+                                 default=lambda o: replace_non_finite(default(o)), **kwargs)
+
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, (pd.Series, pd.Index)):
+            obj = obj.to_numpy()
+        if isinstance(obj, np.ndarray) and obj.dtype.kind == 'f':
+            return nan_to_none(obj)
+
+        value = convert_to_serializable(obj)
+        if value is obj:
+            return DefaultJSONProvider.default(obj)
+        return value
+
 
 app = Flask(__name__)
+app.json = AnalysisJSONProvider(app)
+app.request_class = SpooledUploadRequest
 CORS(app)  # 允许跨域请求，便于前后端分离开发
 
 # 配置上传文件夹和允许的文件扩展名
@@ -16,38 +97,259 @@ UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB 文件大小限制
+app.config['UPLOAD_SPOOL_MAX_BYTES'] = 8 * 1024 * 1024  # 上传文件超过该大小时才写入临时文件
+app.config['PERSIST_UPLOADS'] = False  # 是否将上传文件按内容哈希保存到上传文件夹
+app.config['WORKBOOK_CACHE_MAX_BYTES'] = 256 * 1024 * 1024  # 已解析工作簿缓存的内存上限
+app.config['RESULT_STORE_MAX_BYTES'] = 512 * 1024 * 1024  # 各会话分析结果的内存上限
+app.config['RESULT_TTL_SECONDS'] = 2 * 60 * 60  # 分析结果空闲超过该时间后清除
+app.config['ANALYSIS_WORKERS'] = os.cpu_count() or 1  # 后台分析任务的进程池大小
+app.config['MAX_PENDING_JOBS'] = 32  # 同时排队或执行中的后台分析任务上限
+app.config['JOB_STORE_MAX_BYTES'] = 64 * 1024 * 1024  # 后台分析任务记录的内存上限
+app.config['JOB_EVENT_INTERVAL'] = 1.0  # 任务状态事件流的检查间隔（秒）
+app.config['MAX_BATCH_ITEMS'] = 31 * 20  # 批量分析一次最多处理的（文件 × 日期）数量
+app.config['DEFAULT_PAGE_SIZE'] = 100  # 分页查询的默认每页记录数
+app.config['MAX_PAGE_SIZE'] = 1000  # 分页查询的每页记录数上限
+# 每日分析结果历史库（SQLite）路径，默认不启用；可通过环境变量 HISTORY_DB_PATH 指定
+app.config['HISTORY_DB_PATH'] = os.environ.get('HISTORY_DB_PATH') or None
+app.config['RECONCILE_RUN_ROWS'] = 200000  # 流式对账时内存中排序的最大行数，超过后排序写入临时文件
+app.config['RECONCILE_DISPATCH_MAX_CONTENT_LENGTH'] = 1024 * 1024 * 1024  # 流式对账的上传大小限制（1GB）
+
+# 客户分析中每个分类默认返回的异常客户数量
+DEFAULT_TOP_K = 10
+
+# 未指定会话标识的查询请求使用的会话（分析请求未指定时分配新的会话标识，不写入该会话）
+DEFAULT_SESSION_ID = 'default'
+
+# 对账时客户编号列和客户名称列可能使用的列名
+CUSTOMER_ID_COLUMN_NAMES = ('客户编号', '用户编号', '客户号', '户号', '客户代码')
+CUSTOMER_NAME_COLUMN_NAMES = ('客户名称', '用户名称', '户名')
+
+# 模糊匹配客户名称时去掉的公司名称后缀（按从长到短排列）
+COMPANY_NAME_SUFFIXES = ('股份有限公司', '有限责任公司', '有限公司', '分公司', '公司', '集团')
+
+# 模糊匹配的默认最低相似度（名称二元组的 Dice 系数）
+FUZZY_MATCH_MIN_SCORE = 0.8
+
+
+class AnalysisSession:
+    """单个会话的分析结果
+
+    同一会话的修改（如更新阈值）需在 lock 内进行，不同会话之间互不影响。
+    """
+
+    def __init__(self, abnormal_threshold=DEFAULT_ABNORMAL_THRESHOLD):
+        self.lock = threading.Lock()
+        self.monitor_data = None
+        self.monitor_index = None  # monitor_data 按变化率绝对值排序的索引
+        self.query_index = None  # monitor_data 的筛选、排序索引
+        self.contribution_index = None  # 合计行变化量的客户贡献分解
+        self.last_month_data = None  # 上个月最后一天的数据
+        self.abnormal_threshold = abnormal_threshold
+
+    def estimated_bytes(self):
+        """粗略估算会话占用的内存，按首条记录的大小推算全部记录"""
+        size = sys.getsizeof(self)
+        if self.monitor_data:
+            sample = self.monitor_data[0]
+            record_size = sys.getsizeof(sample) + sum(sys.getsizeof(v) for v in sample.values())
+            size += record_size * len(self.monitor_data) * 2  # 记录本身加变化率索引
+        if self.last_month_data:
+            size += sys.getsizeof(self.last_month_data) * 2
+        if self.contribution_index is not None:
+            size += self.contribution_index.estimated_bytes()
+        return size
+
+
+# 已解析工作簿缓存（由分析引擎持有，按配置调整上限）和各会话的分析结果
+workbook_cache.max_bytes = app.config['WORKBOOK_CACHE_MAX_BYTES']
+result_store = MemoryLRUCache(app.config['RESULT_STORE_MAX_BYTES'], ttl=app.config['RESULT_TTL_SECONDS'])
+
+
+class HistoryStore:
+    """每日分析结果的本地历史库
+
+    以 SQLite 保存每次分析写入的气量，只追加、不覆盖：每次分析记为一次运行（history_run），
+    记录主文件的来源标识（UploadedWorkbook.source_id）；气量表按 (运行, 日期, 行号) 保存合计行和客户行，
+    999 布局中序号相同的多个合计行也各占一行。查询某一天时取同一来源中最近一次写入该日的运行，
+    按 (来源, 日期) 和 (来源, 序号) 建立索引。每次运行记录内容哈希，同一来源同一分析日期的
+    内容与最近一次运行相同时（重复分析同一文件）不再写入。
+    每个线程使用独立的连接，数据库使用 WAL 模式以支持多进程同时读写。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS history_run (
+                    run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    source TEXT NOT NULL,
+                    analysis_date TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    recorded_at REAL NOT NULL
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_history_run_source ON history_run (source, analysis_date)')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS history_volume (
+                    run_id INTEGER NOT NULL REFERENCES history_run (run_id),
+                    source TEXT NOT NULL,
+                    day TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    row_id TEXT NOT NULL,
+                    is_total INTEGER NOT NULL,
+                    name TEXT,
+                    category TEXT,
+                    volume REAL,
+                    PRIMARY KEY (run_id, day, position)
+                ) WITHOUT ROWID
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_history_volume_day ON history_volume (source, day, run_id)')
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_history_volume_row ON history_volume (source, row_id, day)')
+            self._local.conn = conn
+        return conn
+
+    def latest_content_hash(self, source, analysis_date):
+        """同一来源同一分析日期最近一次运行的内容哈希，没有运行时返回 None"""
+        row = self._connection().execute(
+            'SELECT content_hash FROM history_run WHERE source = ? AND analysis_date = ? '
+            'ORDER BY run_id DESC LIMIT 1', (source, analysis_date)
+        ).fetchone()
+        return row[0] if row else None
+
+    def record(self, source, analysis_date, content_hash, days):
+        """追加一次运行的数据，days 为 {日期: (行号, 序号, 是否合计行, 名称, 分类, 气量) 序列}，返回运行编号"""
+        conn = self._connection()
+        with conn:
+            run_id = conn.execute(
+                'INSERT INTO history_run (source, analysis_date, content_hash, recorded_at) VALUES (?, ?, ?, ?)',
+                (source, analysis_date, content_hash, time.time())
+            ).lastrowid
+            for day, rows in days.items():
+                conn.executemany(
+                    'INSERT INTO history_volume '
+                    '(run_id, source, day, position, row_id, is_total, name, category, volume) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    ((run_id, source, day, position, history_key(row_id), int(is_total), name, category, volume)
+                     for position, row_id, is_total, name, category, volume in rows)
+                )
+        return run_id
+
+    def rows_on(self, source, day):
+        """返回某一来源某一天最近一次写入的 (行号, 序号, 是否合计行, 名称, 分类, 气量) 列表，按行号排序"""
+        cursor = self._connection().execute(
+            'SELECT position, row_id, is_total, name, category, volume FROM history_volume '
+            'WHERE source = ? AND day = ? AND run_id = '
+            '(SELECT MAX(run_id) FROM history_volume WHERE source = ? AND day = ?) ORDER BY position',
+            (source, day, source, day)
+        )
+        return cursor.fetchall()
+
+    def volumes_on(self, source, day):
+        """返回某一来源某一天的气量，totals、customers 分别为合计行和客户行的 {序号: 按行号排列的气量列表}；
+        没有记录时返回 None"""
+        totals = defaultdict(list)
+        customers = defaultdict(list)
+        rows = self.rows_on(source, day)
+        for _, row_id, is_total, _, _, volume in rows:
+            (totals if is_total else customers)[row_id].append(volume)
+        return {'totals': dict(totals), 'customers': dict(customers)} if rows else None
+
+    def series(self, source, row_id, start_day=None, end_day=None):
+        """返回某一行在日期范围内（含两端）的 (日期, 名称, 气量) 列表，每天取最近一次写入的数据"""
+        cursor = self._connection().execute(
+            'SELECT day, name, volume FROM history_volume AS v '
+            'WHERE source = ? AND row_id = ? AND day >= ? AND day <= ? AND run_id = '
+            '(SELECT MAX(run_id) FROM history_volume WHERE source = v.source AND day = v.day) '
+            'ORDER BY day, position',
+            (source, history_key(row_id), start_day or '0000-00-00', end_day or '9999-99-99')
+        )
+        return cursor.fetchall()
+
+    def sources(self):
+        """返回各来源的 (来源, 运行次数, 最早分析日期, 最近分析日期) 列表"""
+        cursor = self._connection().execute(
+            'SELECT source, COUNT(*), MIN(analysis_date), MAX(analysis_date) FROM history_run '
+            'GROUP BY source ORDER BY MAX(run_id) DESC'
+        )
+        return cursor.fetchall()
+
+
+_history_store = None
+_history_store_lock = threading.Lock()
+
+
+def get_history_store():
+    """获取（首次使用时创建）历史库，未配置 HISTORY_DB_PATH 时返回 None"""
+    global _history_store
+    path = app.config['HISTORY_DB_PATH']
+    if not path:
+        return None
+    with _history_store_lock:
+        if _history_store is None or _history_store.path != path:
+            _history_store = HistoryStore(path)
+        return _history_store
 
-# 全局变量存储处理后的数据
-monitor_data = None
-last_month_data = None  # 存储上个月最后一天的数据
 
-# 默认异常阈值（百分比）
-abnormal_threshold = 10
+def workbook_source(file_storage, source_name):
+    """上传主文件的来源标识，用于在历史库中查找同一来源的数据；无法读取表头时返回 None"""
+    try:
+        return UploadedWorkbook(file_storage.stream).source_id(source_name)
+    except Exception:
+        return None
+    finally:
+        file_storage.stream.seek(0)
 
 
-def allowed_file(filename):
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def previous_day_volumes(analysis_date, source):
+    """从历史库获取同一来源在分析日期前一天的气量，未启用历史库或没有记录时返回 None"""
+    history_store = get_history_store()
+    if history_store is None or source is None:
+        return None
+    previous_day = (datetime.strptime(analysis_date, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+    return history_store.volumes_on(source, previous_day)
 
 
-def extract_date_from_column_name(col_name):
-    """从列名中提取日期信息"""
-    if pd.isna(col_name):
-        return None
+def get_session_id(issue=False):
+    """获取请求的会话标识：依次取请求头 X-Session-Id、参数 session_id
+
+    都没有时，issue 为真（产生新结果的分析请求）则分配新的会话标识，随响应返回给客户端，
+    避免不同客户端的结果互相覆盖；否则使用默认会话。
+    """
+    json_body = request.get_json(silent=True) or {}
+    session_id = (request.headers.get('X-Session-Id')
+                  or request.values.get('session_id')
+                  or json_body.get('session_id'))
+    if session_id:
+        return session_id
+    return str(uuid.uuid4()) if issue else DEFAULT_SESSION_ID
+
 
-    col_str = str(col_name)
+def get_session_threshold(session_id):
+    """获取会话当前的异常阈值，会话不存在时返回默认阈值"""
+    session = result_store.get(session_id)
+    return session.abnormal_threshold if session is not None else DEFAULT_ABNORMAL_THRESHOLD
 
-    # 匹配模式：数字+日 或 气量-数字日
-    match = re.search(r'(\d+)日', col_str)
-    if match:
-        return int(match.group(1))
 
-    # 匹配"气量-1日"格式
-    match = re.search(r'气量-(\d+)日', col_str)
-    if match:
-        return int(match.group(1))
+def allowed_file(filename):
+    return '.' in filename and \
+           filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
 
-    return None
+def replace_non_finite(obj):
+    """将字典、列表中的 NaN 和正负无穷浮点数替换为 None"""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key: replace_non_finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [replace_non_finite(value) for value in obj]
+    return obj
 
 
 def convert_to_serializable(obj):
@@ -66,39 +368,202 @@ def convert_to_serializable(obj):
         return obj
 
 
-def find_sequence_column(df):
-    """查找序号列"""
-    for col in df.columns:
-        if str(col).strip() in ['序号', '编号', 'ID']:
-            return col
-    return None
+def compute_month_changes(matrix, threshold):
+    """对 (行 × 天) 气量矩阵一次性计算每对相邻日期列的变化量、变化率和异常标记
+
+    返回的数组形状为 (行数, 天数 - 1)，第 j 列表示第 j + 1 个日期列相对前一列的变化
+    """
+    matrix = np.asarray(matrix, dtype=float)
+    return compute_changes(matrix[:, 1:], matrix[:, :-1], threshold)
 
 
-def find_category_column(df):
-    """查找分类列"""
-    for col in df.columns:
-        if str(col).strip() == '分类':
-            return col
-    return None
+def trailing_window_sums(matrix, window):
+    """用累计和计算每个单元格之前 window 天（不含当天）的有效值个数、和与平方和
 
+    缺失值不计入；返回的三个数组形状与 matrix 相同，代价与单元格数成线性关系。
+    """
+    valid = ~np.isnan(matrix)
+    values = np.where(valid, matrix, 0.0)
+    rows = matrix.shape[0]
+
+    def window_sum(data):
+        # 前面补一列 0 的累计和，cumsum[:, j] 为第 j 天之前所有值的和
+        cumsum = np.concatenate([np.zeros((rows, 1)), np.cumsum(data, axis=1)], axis=1)
+        end = cumsum[:, :-1]
+        start = np.concatenate([np.zeros((rows, window)), cumsum[:, :-1]], axis=1)[:, :matrix.shape[1]]
+        return end - start
 
-@app.route('/api/analyze', methods=['POST'])
-def analyze_data():
-    """分析月用气监控表数据"""
-    global monitor_data, last_month_data, abnormal_threshold
+    return window_sum(valid.astype(float)), window_sum(values), window_sum(values * values)
+
+
+def detect_rolling_zscore(matrix, window=7, min_periods=3):
+    """滚动 z 分数：当天气量相对之前 window 天均值的偏离，以标准差为单位"""
+    count, total, total_sq = trailing_window_sums(matrix, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean * mean, 0.0))
+        scores = (matrix - mean) / std
+    scores[(count < min_periods) | (std == 0)] = np.nan
+    return scores
+
+
+def detect_ewma(matrix, alpha=0.3, min_periods=3):
+    """EWMA 偏离：当天气量相对之前各天指数加权均值的偏离，以指数加权标准差为单位
+
+    按天递推，每一步对所有行向量化计算；缺失值不更新均值和方差。
+    """
+    rows, days = matrix.shape
+    scores = np.full(matrix.shape, np.nan)
+    mean = np.full(rows, np.nan)
+    var = np.zeros(rows)
+    count = np.zeros(rows)
+
+    for j in range(days):
+        values = matrix[:, j]
+        valid = ~np.isnan(values)
+        deviation = values - mean
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = deviation / np.sqrt(var)
+        score[(count < min_periods) | (var == 0)] = np.nan
+        scores[:, j] = score
+
+        first = valid & (count == 0)
+        update = valid & (count > 0)
+        mean[first] = values[first]
+        var[update] = (1 - alpha) * (var[update] + alpha * deviation[update] ** 2)
+        mean[update] = mean[update] + alpha * deviation[update]
+        count[valid] += 1
+
+    return scores
+
+
+def detect_mad(matrix, window=7, min_periods=3):
+    """中位数绝对偏差（MAD）：当天气量相对之前 window 天中位数的稳健 z 分数
+
+    滑动窗口视图上计算中位数，代价为单元格数 × 窗口大小，窗口固定时与单元格数成线性关系。
+    """
+    rows, days = matrix.shape
+    padded = np.concatenate([np.full((rows, window), np.nan), matrix[:, :-1]], axis=1)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis=1)[:, :days]
+    count = (~np.isnan(windows)).sum(axis=2)
+
+    with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+        # 全部缺失的窗口中位数为 NaN，不需要警告
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(windows, axis=2)
+        mad = np.nanmedian(np.abs(windows - median[:, :, None]), axis=2)
+        scores = 0.6745 * (matrix - median) / mad
+    scores[(count < min_periods) | (mad == 0)] = np.nan
+    return scores
+
+
+# 月度矩阵上的统计异常检测方法：名称 -> (检测函数, 默认分数阈值)
+# 检测函数接收 (行 × 天) 气量矩阵，返回同形状的分数矩阵，无法计算的单元格为 NaN
+ANOMALY_DETECTORS = {
+    'zscore': (detect_rolling_zscore, 3.0),
+    'ewma': (detect_ewma, 3.0),
+    'mad': (detect_mad, 3.5)
+}
+
+
+class RecordQueryIndex:
+    """分析结果的查询索引，在保存结果时一次性建立
+
+    为每个可排序字段预先计算排序置换，按合计行所属分组建立位置表，按变化率建立有序数组，
+    查询时只做布尔掩码运算和切片，不再逐条遍历记录。
+    """
+
+    SORT_FIELDS = ('序号', '气量(万立方米)', '前一天气量(万立方米)', '变化量(万立方米)', '变化率(%)')
+
+    def __init__(self, columns, change_rate_index):
+        self.change_rate_index = change_rate_index
+        self.size = len(change_rate_index.records)
+
+        # 字段 -> (排序置换, 非缺失值数量)；缺失值排在最后
+        self._sort_orders = {}
+        for field in self.SORT_FIELDS:
+            values = to_numeric_array(columns[field])
+            order = np.argsort(values, kind='stable')
+            self._sort_orders[field] = (order, int(np.count_nonzero(~np.isnan(values))))
+
+        rate_order, rate_count = self._sort_orders['变化率(%)']
+        self._rate_order = rate_order[:rate_count]
+        self._sorted_rates = np.asarray(columns['变化率(%)'], dtype=float)[self._rate_order]
+
+        # 结果中只有合计行，"分类"列都是"合计"，按名称得到的分组（如"居民合计"属于"居民"）筛选
+        self._category_positions = pd.Series(np.arange(self.size)).groupby(columns['分组']).indices
+
+    def _mask(self, positions):
+        mask = np.zeros(self.size, dtype=bool)
+        mask[positions] = True
+        return mask
+
+    def query(self, abnormal_only=False, category=None, min_rate=None, max_rate=None,
+              sort=None, descending=False, offset=0, limit=None):
+        """返回 (当前页记录的位置数组, 符合条件的记录总数)"""
+        mask = np.ones(self.size, dtype=bool)
+
+        if abnormal_only:
+            mask &= self._mask(self.change_rate_index.abnormal_positions())
+
+        if category is not None:
+            mask &= self._mask(self._category_positions.get(category, np.empty(0, dtype=int)))
+
+        if min_rate is not None or max_rate is not None:
+            low = np.searchsorted(self._sorted_rates, min_rate, side='left') if min_rate is not None else 0
+            high = (np.searchsorted(self._sorted_rates, max_rate, side='right')
+                    if max_rate is not None else len(self._sorted_rates))
+            mask &= self._mask(self._rate_order[low:high])
+
+        if sort is not None:
+            order, count = self._sort_orders[sort]
+            if descending:
+                order = np.concatenate([order[:count][::-1], order[count:]])
+            selected = order[mask[order]]
+        else:
+            selected = np.flatnonzero(mask)
 
+        end = None if limit is None else offset + limit
+        return selected[offset:end], len(selected)
+
+
+def persist_upload(stream, cache_key, extension):
+    """将上传文件以内容哈希命名保存到上传文件夹，内容相同的文件只保存一次"""
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{cache_key}.{extension}")
+    if not os.path.exists(filepath):
+        # 先写入临时文件再重命名，避免并发请求读到写了一半的文件
+        fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'])
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(stream, f)
+        os.replace(tmp_path, filepath)
+        stream.seek(0)
+    return filepath
+
+
+def open_uploaded_workbook(file_storage):
+    """打开上传的Excel文件，只读取表头；数据列通过 load_columns 按需加载"""
+    stream = file_storage.stream
+    cache_key = hash_stream(stream)
+    if app.config['PERSIST_UPLOADS']:
+        persist_upload(stream, cache_key, file_storage.filename.rsplit('.', 1)[1].lower())
+    return UploadedWorkbook(stream, cache_key)
+
+
+def parse_analyze_request(default_threshold):
+    """校验 /api/analyze 请求的文件和参数，返回分析参数字典"""
     # 检查是否有文件部分
     if 'main_file' not in request.files:
-        return jsonify({'error': '没有主文件部分'}), 400
+        raise AnalysisError('没有主文件部分')
 
     main_file = request.files['main_file']
 
     # 检查是否选择了文件
     if main_file.filename == '':
-        return jsonify({'error': '未选择主文件'}), 400
+        raise AnalysisError('未选择主文件')
 
     # 获取参数
-    threshold = request.form.get('threshold', abnormal_threshold)
+    threshold = request.form.get('threshold', default_threshold)
     analysis_date = request.form.get('analysis_date')
 
     try:
@@ -107,271 +572,1529 @@ def analyze_data():
         # 解析日期
         if analysis_date:
             analysis_date_obj = datetime.strptime(analysis_date, '%Y-%m-%d')
-            current_day = analysis_date_obj.day
-            is_first_day = current_day == 1
+            is_first_day = analysis_date_obj.day == 1
         else:
-            return jsonify({'error': '未提供分析日期'}), 400
+            raise AnalysisError('未提供分析日期')
 
     except ValueError:
-        return jsonify({'error': '参数格式错误'}), 400
+        raise AnalysisError('参数格式错误')
+
+    if not allowed_file(main_file.filename):
+        raise AnalysisError('文件类型不允许')
+
+    # 历史库来源名称：请求参数 source 指定，否则为原始文件名（secure_filename 会去掉中文）
+    source_name = (request.form.get('source') or '').strip() or main_file.filename
 
-    # 如果是第一天，检查是否有月度补充文件
+    # 如果是第一天，检查是否有月度补充文件；没有上传时尝试使用历史库中同一来源前一天的数据
+    extra_file = None
+    previous_volumes = None
     if is_first_day:
-        if 'extra_file' not in request.files:
-            return jsonify({'error': '每月1号需要上传月度补充文件'}), 400
+        extra_file = request.files.get('extra_file')
+        if extra_file is None or extra_file.filename == '':
+            previous_volumes = previous_day_volumes(analysis_date, workbook_source(main_file, source_name))
+            if previous_volumes is None:
+                if extra_file is None:
+                    raise AnalysisError('每月1号需要上传月度补充文件')
+                raise AnalysisError('未选择月度补充文件')
+            extra_file = None
+        elif not allowed_file(extra_file.filename):
+            raise AnalysisError('月度补充文件无效')
+
+    return {
+        'main_file': main_file,
+        'extra_file': extra_file,
+        'previous_volumes': previous_volumes,
+        'source_name': source_name,
+        'analysis_date': analysis_date,
+        'abnormal_threshold': abnormal_threshold
+    }
 
-        extra_file = request.files['extra_file']
-        if extra_file.filename == '':
-            return jsonify({'error': '未选择月度补充文件'}), 400
-    else:
-        extra_file = None
 
-    # 保存并处理主文件
-    if main_file and allowed_file(main_file.filename):
-        main_filename = secure_filename(main_file.filename)
-        main_filepath = os.path.join(app.config['UPLOAD_FOLDER'], main_filename)
-        main_file.save(main_filepath)
+def history_content_hash(result):
+    """分析结果中写入历史库的内容（各行的行号、序号、名称、分类和两天的气量）的哈希
+
+    数值数组直接对内存中的字节计算，其余列（可能为 None）对值列表的 repr 计算。
+    """
+    digest = hashlib.sha256(result['analysis_date'].encode('utf-8'))
+    for columns in (result['columns'], result['customers']):
+        for field in ('行号', '序号', '名称', '分类', '气量(万立方米)', '前一天气量(万立方米)'):
+            values = columns[field]
+            if isinstance(values, np.ndarray) and values.dtype.kind in 'biuf':
+                digest.update(values.dtype.str.encode('ascii') + values.tobytes())
+            else:
+                digest.update(repr(values.tolist() if values is not None else None).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def record_history(result):
+    """将分析结果中合计行和客户行当天和前一天的气量作为一次运行追加到历史库
+
+    同一来源同一分析日期的内容与最近一次运行相同时（同一文件当天重复分析）不再写入。
+    """
+    history_store = get_history_store()
+    if history_store is None:
+        return
+
+    content_hash = history_content_hash(result)
+    if history_store.latest_content_hash(result['source'], result['analysis_date']) == content_hash:
+        return
+
+    current_day = datetime.strptime(result['analysis_date'], '%Y-%m-%d')
+    days = {current_day.strftime('%Y-%m-%d'): [], (current_day - timedelta(days=1)).strftime('%Y-%m-%d'): []}
+    for columns, is_total in ((result['columns'], True), (result['customers'], False)):
+        count = len(columns['序号'])
+        row_ids = columns['序号'].tolist()
+        positions = columns['行号'].tolist()
+        names = nan_to_none(columns['名称']) if columns['名称'] is not None else [None] * count
+        categories = nan_to_none(columns['分类']) if columns['分类'] is not None else [None] * count
+        for day, field in zip(days, ('气量(万立方米)', '前一天气量(万立方米)')):
+            days[day].extend(
+                (position, row_id, is_total, name, category, volume)
+                for position, row_id, name, category, volume
+                in zip(positions, row_ids, names, categories, columns[field].tolist())
+                if volume == volume
+            )
+    history_store.record(result['source'], result['analysis_date'], content_hash, days)
 
-        try:
-            # 读取Excel文件
-            df = pd.read_excel(main_filepath)
 
-            # 查找序号列
-            sequence_col = find_sequence_column(df)
-            if sequence_col is None:
-                return jsonify({'error': '未找到"序号"列'}), 400
+def store_analysis_result(session_id, result):
+    """将分析结果保存为会话的当前结果（替换该会话之前的结果），并写入历史库"""
+    record_history(result)
 
-            # 查找分类列
-            category_col = find_category_column(df)
+    previous_session = result_store.get(session_id)
 
-            # 查找包含日期的列
-            date_columns = []
+    session = AnalysisSession(result['abnormal_threshold'])
+    session.monitor_index = result['index']
+    session.monitor_data = result['index'].records
+    session.query_index = RecordQueryIndex(result['columns'], result['index'])
+    session.contribution_index = result['contributions']
+    if result['last_month_data'] is not None:
+        session.last_month_data = result['last_month_data']
+    elif previous_session is not None:
+        session.last_month_data = previous_session.last_month_data
+    result_store.put(session_id, session, session.estimated_bytes())
 
-            for col in df.columns:
-                # 检查是否是日期列
-                if extract_date_from_column_name(col) is not None:
-                    date_columns.append(col)
 
-            if not date_columns:
-                return jsonify({'error': '未找到日期列（格式应为"X日"或"气量-X日"）'}), 400
+def analysis_response(result, session_id):
+    """生成分析接口返回的数据"""
+    return {'message': '数据分析成功', **analysis_summary(result), 'session_id': session_id}
+
+
+@app.route('/api/analyze', methods=['POST'])
+def analyze_data():
+    """分析月用气监控表数据，结果保存在会话中（未指定会话时分配新的会话标识并返回）"""
+    session_id = get_session_id(issue=True)
 
-            # 按日期排序列
-            date_columns_sorted = sorted(
-                date_columns,
-                key=lambda x: extract_date_from_column_name(x) or 0
+    try:
+        params = parse_analyze_request(get_session_threshold(session_id))
+        main_file = params['main_file']
+        extra_file = params['extra_file']
+
+        result = run_analysis(
+            open_uploaded_workbook(main_file),
+            secure_filename(main_file.filename),
+            params['analysis_date'],
+            params['abnormal_threshold'],
+            open_uploaded_workbook(extra_file) if extra_file else None,
+            secure_filename(extra_file.filename) if extra_file else None,
+            params['previous_volumes'],
+            params['source_name']
+        )
+    except AnalysisError as e:
+        return jsonify({'error': e.message}), e.status
+
+    store_analysis_result(session_id, result)
+    return jsonify(analysis_response(result, session_id))
+
+
+class AnalysisJob:
+    """后台分析任务
+
+    执行期间状态由进程池返回的 future 决定；结束后 finish() 记录最终状态和结果响应，
+    并释放 future（其中保存着完整的分析结果），任务记录只保留返回给客户端的部分。
+    """
+
+    FINISHED_STATUSES = ('done', 'failed', 'cancelled')
+
+    def __init__(self, session_id, future):
+        self.job_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.future = future
+        self.outcome = None  # 结束后为 (状态, 错误信息或结果响应)
+        self.submitted_at = time.time()
+        self.finished_at = None
+
+    def result_response(self, result):
+        """工作进程返回的结果转换为返回给客户端的响应"""
+        return analysis_response(result, self.session_id)
+
+    def store_result(self, result):
+        """任务成功时将结果保存为会话的当前结果"""
+        store_analysis_result(self.session_id, result)
+
+    def future_outcome(self, future):
+        """已结束的 future 对应的 (状态, 错误信息或结果响应)"""
+        if future.cancelled():
+            return 'cancelled', None
+        error = future.exception()
+        if error is None:
+            return 'done', self.result_response(future.result())
+        if isinstance(error, AnalysisError):
+            return 'failed', error.message
+        return 'failed', f'处理文件时出错: {str(error)}'
+
+    @property
+    def status(self):
+        future = self.future
+        if future is None:
+            return self.outcome[0]
+        if future.cancelled():
+            return 'cancelled'
+        if not future.done():
+            return 'running' if future.running() else 'pending'
+        return 'failed' if future.exception() is not None else 'done'
+
+    def finish(self):
+        """记录最终状态和结果响应并释放 future，返回任务记录按序列化结果估算的字节数"""
+        self.outcome = self.future_outcome(self.future)
+        self.finished_at = time.time()
+        self.future = None
+        return sys.getsizeof(self) + len(app.json.dumps(self.outcome[1]))
+
+    def to_dict(self, include_result=True):
+        future = self.future
+        if future is None:
+            status, detail = self.outcome
+        else:
+            status = self.status
+            detail = self.future_outcome(future)[1] if status in ('done', 'failed') else None
+
+        data = {
+            'job_id': self.job_id,
+            'status': status,
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at
+        }
+        if status == 'failed':
+            data['error'] = detail
+        elif status == 'done' and include_result:
+            data['result'] = detail
+        return data
+
+
+job_store = MemoryLRUCache(app.config['JOB_STORE_MAX_BYTES'], ttl=app.config['RESULT_TTL_SECONDS'])
+_job_executor = None
+_job_executor_lock = threading.Lock()
+_pending_job_slots = threading.BoundedSemaphore(app.config['MAX_PENDING_JOBS'])
+
+
+def get_job_executor():
+    """获取（首次使用时创建）后台分析进程池"""
+    global _job_executor
+    with _job_executor_lock:
+        if _job_executor is None:
+            # 使用 spawn 启动工作进程，避免在多线程服务进程中 fork
+            _job_executor = ProcessPoolExecutor(
+                max_workers=app.config['ANALYSIS_WORKERS'],
+                mp_context=multiprocessing.get_context('spawn')
             )
+        return _job_executor
 
-            # 获取当前日期的气量列（万立方米）
-            current_col = next((c for c in date_columns_sorted if extract_date_from_column_name(c) == current_day),
-                               None)
-            if not current_col:
-                return jsonify({'error': f'未找到{current_day}日的气量列'}), 400
-
-            # 获取前一天的气量列
-            if is_first_day:
-                # 如果是第一天，需要处理月度补充文件
-                if extra_file and allowed_file(extra_file.filename):
-                    extra_filename = secure_filename(extra_file.filename)
-                    extra_filepath = os.path.join(app.config['UPLOAD_FOLDER'], extra_filename)
-                    extra_file.save(extra_filepath)
-
-                    try:
-                        # 读取月度补充文件
-                        extra_df = pd.read_excel(extra_filepath)
-
-                        # 查找序号列
-                        extra_sequence_col = find_sequence_column(extra_df)
-                        if extra_sequence_col is None:
-                            return jsonify({'error': '月度补充文件中未找到"序号"列'}), 400
-
-                        # 查找分类列
-                        extra_category_col = find_category_column(extra_df)
-
-                        # 查找包含日期的列
-                        extra_date_columns = []
-
-                        for col in extra_df.columns:
-                            # 检查是否是日期列
-                            if extract_date_from_column_name(col) is not None:
-                                extra_date_columns.append(col)
-
-                        if not extra_date_columns:
-                            return jsonify({'error': '月度补充文件中未找到日期列'}), 400
-
-                        # 按日期排序列
-                        extra_date_columns_sorted = sorted(
-                            extra_date_columns,
-                            key=lambda x: extract_date_from_column_name(x) or 0
-                        )
-
-                        # 获取上个月最后一天的数据列（通常是31日）
-                        prev_col = extra_date_columns_sorted[-1] if extra_date_columns_sorted else None
-                        if not prev_col:
-                            return jsonify({'error': '月度补充文件中未找到最后一天的数据列'}), 400
-
-                        # 获取合计行的前一天气量
-                        if extra_category_col and extra_category_col in extra_df.columns:
-                            # 如果有分类列，使用分类列
-                            prev_gas_rows = extra_df[extra_df[extra_category_col] == '合计']
-                        else:
-                            # 如果没有分类列，使用序号列（假设序号为999的是合计行）
-                            prev_gas_rows = extra_df[extra_df[extra_sequence_col] == 999]
-
-                        if prev_gas_rows.empty:
-                            return jsonify({'error': '月度补充文件中未找到"合计"行'}), 400
-
-                        # 存储上个月的数据
-                        last_month_data = {}
-                        for _, row in prev_gas_rows.iterrows():
-                            row_id = row[extra_sequence_col]
-                            last_month_data[row_id] = row[prev_col]
-
-                    except Exception as e:
-                        return jsonify({'error': f'处理月度补充文件时出错: {str(e)}'}), 500
-                else:
-                    return jsonify({'error': '月度补充文件无效'}), 400
-            else:
-                # 如果不是第一天，从主文件中获取前一天的数据列
-                prev_day = current_day - 1
-                prev_col = next((c for c in date_columns_sorted if extract_date_from_column_name(c) == prev_day), None)
 
-                if not prev_col:
-                    return jsonify({'error': f'未找到{prev_day}日的气量列'}), 400
+def run_analysis_job(main_content, main_filename, analysis_date, abnormal_threshold,
+                     extra_content=None, extra_filename=None, previous_volumes=None, source_name=None):
+    """在工作进程中执行分析，参数和返回值都需可被 pickle"""
+    main_workbook = UploadedWorkbook(io.BytesIO(main_content))
+    extra_workbook = UploadedWorkbook(io.BytesIO(extra_content)) if extra_content is not None else None
+    return run_analysis(main_workbook, main_filename, analysis_date, abnormal_threshold,
+                        extra_workbook, extra_filename, previous_volumes, source_name)
+
+
+def on_job_done(job, future):
+    """任务结束后释放排队名额，成功时将结果保存为会话的当前结果
+
+    任务记录随后只保留结果响应，并按其序列化大小重新计入 job_store 的内存占用。
+    """
+    _pending_job_slots.release()
+    if not future.cancelled() and future.exception() is None:
+        job.store_result(future.result())
+    size = job.finish()
+    # 任务记录已过期或被淘汰时不再放回
+    if job_store.get(job.job_id) is job:
+        job_store.put(job.job_id, job, size)
 
-            # 获取合计行
-            if category_col and category_col in df.columns:
-                # 如果有分类列，使用分类列
-                total_rows = df[df[category_col] == '合计']
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """提交后台分析任务，立即返回任务编号和会话标识（未指定会话时分配新的会话标识）"""
+    session_id = get_session_id(issue=True)
+
+    try:
+        params = parse_analyze_request(get_session_threshold(session_id))
+    except AnalysisError as e:
+        return jsonify({'error': e.message}), e.status
+
+    if not _pending_job_slots.acquire(blocking=False):
+        return jsonify({'error': '分析任务过多，请稍后再试'}), 503
+
+    main_file = params['main_file']
+    extra_file = params['extra_file']
+    try:
+        future = get_job_executor().submit(
+            run_analysis_job,
+            main_file.stream.read(),
+            secure_filename(main_file.filename),
+            params['analysis_date'],
+            params['abnormal_threshold'],
+            extra_file.stream.read() if extra_file else None,
+            secure_filename(extra_file.filename) if extra_file else None,
+            params['previous_volumes'],
+            params['source_name']
+        )
+    except Exception as e:
+        _pending_job_slots.release()
+        return jsonify({'error': f'提交分析任务时出错: {str(e)}'}), 500
+
+    job = AnalysisJob(session_id, future)
+    job_store.put(job.job_id, job, sys.getsizeof(job))
+    future.add_done_callback(lambda f: on_job_done(job, f))
+
+    return jsonify({
+        'message': '分析任务已提交',
+        'job_id': job.job_id,
+        'status': job.status,
+        'session_id': session_id
+    }), 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查询后台分析任务的状态，完成后返回分析结果"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': '分析任务不存在或已过期'}), 404
+
+    return jsonify(job.to_dict())
+
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """以 Server-Sent Events 推送任务状态变化，任务结束时推送最终结果"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': '分析任务不存在或已过期'}), 404
+
+    interval = app.config['JOB_EVENT_INTERVAL']
+
+    # 任务结束后 job.future 会被释放，这里保留一份用于等待
+    future = job.future
+
+    def generate():
+        last_status = None
+        while True:
+            status = job.status
+            if status != last_status:
+                event = job.to_dict(include_result=status == 'done')
+                yield f"data: {app.json.dumps(event)}\n\n"
+                last_status = status
+            if status in AnalysisJob.FINISHED_STATUSES:
+                return
+            wait([future], timeout=interval)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
+
+
+@app.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """取消尚未开始执行的后台分析任务"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': '分析任务不存在或已过期'}), 404
+
+    future = job.future
+    if future is None or not future.cancel():
+        return jsonify({'error': '分析任务已开始执行，无法取消', 'status': job.status}), 409
+
+    return jsonify({'message': '分析任务已取消', 'status': job.status})
+
+
+def preload_analysis_columns(workbook):
+    """一次性加载分析可能用到的全部列，之后逐日分析都直接使用缓存"""
+    layout = workbook.layout
+    workbook.load_columns([layout.sequence_col, layout.category_col, layout.name_col] + layout.date_columns)
+
+
+class BatchFileJob(AnalysisJob):
+    """批量分析中一个文件的后台任务，结果为该文件各日期的分析条目，不替换会话的当前结果"""
+
+    def __init__(self, session_id, future, main_filename):
+        super().__init__(session_id, future)
+        self.main_filename = main_filename
+
+    def result_response(self, items):
+        success_count = sum(1 for item in items if item['status'] == 'done')
+        return {
+            'file': self.main_filename,
+            'item_count': len(items),
+            'success_count': success_count,
+            'failure_count': len(items) - success_count,
+            'items': items
+        }
+
+    def store_result(self, result):
+        pass
+
+
+class AnalysisBatch:
+    """一次批量分析的记录：各文件的后台任务编号，以及提交前就失败的文件
+
+    查询时从 job_store 取各任务的当前状态，汇总为所有（文件 × 日期）条目和整批的状态：
+    有任务未结束时为 pending 或 running；全部结束后，所有条目成功为 done，全部失败为 failed，否则为 partial。
+    """
+
+    def __init__(self, session_id, analysis_dates, abnormal_threshold, jobs):
+        self.batch_id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.analysis_dates = analysis_dates
+        self.abnormal_threshold = abnormal_threshold
+        self.jobs = jobs  # 与提交时返回的 jobs 相同：{file, job_id, status} 或 {file, status: failed, error}
+        self.submitted_at = time.time()
+
+    def file_items(self, file, status, error=None):
+        """任务未结束或失败时，该文件每个日期的条目"""
+        items = [{'file': file, 'analysis_date': d, 'status': status} for d in self.analysis_dates]
+        if error is not None:
+            for item in items:
+                item['error'] = error
+        return items
+
+    def to_dict(self):
+        jobs = []
+        items = []
+        for entry in self.jobs:
+            if 'job_id' not in entry:
+                jobs.append(entry)
+                items.extend(self.file_items(entry['file'], 'failed', entry['error']))
+                continue
+
+            job = job_store.get(entry['job_id'])
+            if job is None:
+                data = {'status': 'failed', 'error': '分析任务不存在或已过期'}
+            else:
+                data = job.to_dict()
+            jobs.append({'file': entry['file'], 'job_id': entry['job_id'], 'status': data['status']})
+            if data['status'] == 'done':
+                items.extend(data['result']['items'])
             else:
-                # 如果没有分类列，使用序号列（假设序号为999的是合计行）
-                total_rows = df[df[sequence_col] == 999]
-
-            if total_rows.empty:
-                return jsonify({'error': '未找到"合计"行'}), 400
-
-            # 处理数据
-            processed_data = []
-            abnormal_records = []
-            total_current_gas = 0
-            total_prev_gas = 0
-
-            for _, row in total_rows.iterrows():
-                row_id = row[sequence_col]
-                row_name = row.get('客户名称', f"合计行{row_id}")
-
-                # 获取当前天气量
-                current_gas = row[current_col]
-                current_gas = convert_to_serializable(current_gas)
-                total_current_gas += current_gas if current_gas is not None else 0
-
-                # 获取前一天的气量
-                if is_first_day:
-                    # 如果是第一天，从月度补充文件中获取前一天的气量
-                    prev_gas = last_month_data.get(row_id, 0)
-                else:
-                    # 如果不是第一天，从主文件中获取前一天的气量
-                    prev_gas = row[prev_col] if prev_col in row else 0
-
-                prev_gas = convert_to_serializable(prev_gas)
-                total_prev_gas += prev_gas if prev_gas is not None else 0
-
-                # 计算变化量和变化率
-                change = current_gas - prev_gas if current_gas is not None and prev_gas is not None else None
-                change_rate = (change / prev_gas) * 100 if change is not None and prev_gas != 0 else None
-                is_abnormal = abs(change_rate) > abnormal_threshold if change_rate is not None else False
-
-                # 转换为可序列化的格式
-                change = convert_to_serializable(change)
-                change_rate = convert_to_serializable(change_rate)
-                is_abnormal = convert_to_serializable(is_abnormal)
-
-                record = {
-                    '序号': row_id,
-                    '名称': row_name,
-                    '日期': f"{current_day}日",
-                    '气量(万立方米)': current_gas,
-                    '前一天气量(万立方米)': prev_gas,
-                    '变化量(万立方米)': change,
-                    '变化率(%)': f"{change_rate}%" if change_rate is not None else None,
-                    '异常': is_abnormal
+                items.extend(self.file_items(entry['file'], data['status'], data.get('error')))
+
+        statuses = {job['status'] for job in jobs}
+        success_count = sum(1 for item in items if item['status'] == 'done')
+        if statuses <= {'pending'}:
+            status = 'pending'
+        elif not statuses <= set(AnalysisJob.FINISHED_STATUSES):
+            status = 'running'
+        elif success_count == len(items):
+            status = 'done'
+        elif success_count == 0:
+            status = 'failed'
+        else:
+            status = 'partial'
+
+        return {
+            'batch_id': self.batch_id,
+            'status': status,
+            'submitted_at': self.submitted_at,
+            'abnormal_threshold': self.abnormal_threshold,
+            'analysis_dates': self.analysis_dates,
+            'item_count': len(items),
+            'success_count': success_count,
+            'failure_count': sum(1 for item in items if item['status'] in AnalysisJob.FINISHED_STATUSES) - success_count,
+            'jobs': jobs,
+            'items': items
+        }
+
+
+batch_store = MemoryLRUCache(app.config['JOB_STORE_MAX_BYTES'], ttl=app.config['RESULT_TTL_SECONDS'])
+
+
+def run_batch_file(main_content, main_filename, analysis_dates, abnormal_threshold,
+                   extra_content=None, extra_filename=None, history_volumes=None):
+    """在工作进程中对同一个文件分析多个日期，所有日期共用一次解析
+
+    history_volumes 为 {1号的分析日期: 历史库中前一天的气量}，没有月度补充文件时使用。
+    """
+    main_workbook = UploadedWorkbook(io.BytesIO(main_content))
+    extra_workbook = UploadedWorkbook(io.BytesIO(extra_content)) if extra_content is not None else None
+
+    try:
+        preload_analysis_columns(main_workbook)
+    except Exception:
+        # 文件无法解析时由下面的逐日分析报告具体错误
+        pass
+
+    items = []
+    for analysis_date in analysis_dates:
+        item = {'file': main_filename, 'analysis_date': analysis_date}
+        try:
+            is_first_day = datetime.strptime(analysis_date, '%Y-%m-%d').day == 1
+            previous_volumes = (history_volumes or {}).get(analysis_date)
+            if is_first_day and extra_workbook is None and previous_volumes is None:
+                raise AnalysisError('每月1号需要上传月度补充文件')
+
+            result = run_analysis(main_workbook, main_filename, analysis_date, abnormal_threshold,
+                                  extra_workbook if is_first_day else None, extra_filename,
+                                  previous_volumes if is_first_day else None)
+            item.update({
+                'status': 'done',
+                'abnormal_count': len(result['abnormal_records']),
+                'abnormal_records': result['abnormal_records'],
+                'total_current_gas': result['total_current_gas'],
+                'total_prev_gas': result['total_prev_gas']
+            })
+        except AnalysisError as e:
+            item.update({'status': 'failed', 'error': e.message})
+        items.append(item)
+    return items
+
+
+def parse_batch_dates():
+    """解析批量分析的日期：analysis_date 可重复提交，或用 start_date/end_date 指定日期范围（含两端）"""
+    dates = request.form.getlist('analysis_date')
+    start_date = request.form.get('start_date')
+    end_date = request.form.get('end_date')
+
+    try:
+        dates = [datetime.strptime(d, '%Y-%m-%d') for d in dates]
+        if start_date or end_date:
+            if not (start_date and end_date):
+                raise AnalysisError('日期范围需要同时提供 start_date 和 end_date')
+            start = datetime.strptime(start_date, '%Y-%m-%d')
+            end = datetime.strptime(end_date, '%Y-%m-%d')
+            if start > end:
+                raise AnalysisError('开始日期不能晚于结束日期')
+            if (end - start).days >= app.config['MAX_BATCH_ITEMS']:
+                raise AnalysisError('日期范围过大')
+            dates += [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    except ValueError:
+        raise AnalysisError('参数格式错误')
+
+    if not dates:
+        raise AnalysisError('未提供分析日期')
+
+    return [d.strftime('%Y-%m-%d') for d in sorted(set(dates))]
+
+
+@app.route('/api/analyze_batch', methods=['POST'])
+def analyze_batch():
+    """批量分析多个文件和/或多个日期，每个文件提交为一个后台任务，立即返回任务编号
+
+    每个文件在进程池中只解析一次，同一文件的所有日期在同一个任务中分析；
+    整批的状态和所有条目通过 /api/batches/<batch_id> 查询，单个文件的结果也可以通过 /api/jobs/<job_id> 查询。
+    每个任务占用一个排队名额，名额不足时整批拒绝。
+    """
+    session_id = get_session_id()
+    main_files = [f for f in request.files.getlist('main_file') if f.filename != '']
+    if not main_files:
+        return jsonify({'error': '未选择主文件'}), 400
+
+    try:
+        analysis_dates = parse_batch_dates()
+        abnormal_threshold = float(request.form.get('threshold', get_session_threshold(session_id)))
+    except AnalysisError as e:
+        return jsonify({'error': e.message}), e.status
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+
+    if len(main_files) * len(analysis_dates) > app.config['MAX_BATCH_ITEMS']:
+        return jsonify({'error': '批量分析的文件和日期数量过多'}), 400
+
+    # 月度补充文件对所有文件的1号分析共用
+    extra_file = request.files.get('extra_file')
+    extra_content = None
+    extra_filename = None
+    if extra_file and extra_file.filename != '':
+        if not allowed_file(extra_file.filename):
+            return jsonify({'error': '月度补充文件无效'}), 400
+        extra_content = extra_file.stream.read()
+        extra_filename = secure_filename(extra_file.filename)
+
+    def history_volumes(main_file):
+        """没有月度补充文件时，1号的前一天气量从历史库中该文件来源的数据中获取"""
+        first_days = [d for d in analysis_dates if d.endswith('-01')]
+        if extra_content is not None or not first_days:
+            return {}
+        source = workbook_source(main_file, main_file.filename)
+        volumes = {d: previous_day_volumes(d, source) for d in first_days}
+        return {d: v for d, v in volumes.items() if v is not None}
+
+    # 每个文件一个任务，同一文件的所有日期在同一个工作进程中共用解析结果
+    accepted = []
+    jobs = []
+    for main_file in main_files:
+        main_filename = secure_filename(main_file.filename)
+        if allowed_file(main_file.filename):
+            accepted.append((len(jobs), main_file, main_filename))
+            jobs.append(None)
+        else:
+            jobs.append({'file': main_filename, 'status': 'failed', 'error': '文件类型不允许'})
+
+    acquired = 0
+    while acquired < len(accepted) and _pending_job_slots.acquire(blocking=False):
+        acquired += 1
+    if acquired < len(accepted):
+        for _ in range(acquired):
+            _pending_job_slots.release()
+        return jsonify({'error': '分析任务过多，请稍后再试'}), 503
+
+    for count, (position, main_file, main_filename) in enumerate(accepted):
+        try:
+            future = get_job_executor().submit(
+                run_batch_file, main_file.stream.read(), main_filename, analysis_dates,
+                abnormal_threshold, extra_content, extra_filename, history_volumes(main_file)
+            )
+        except Exception as e:
+            # 未提交的文件归还名额
+            for _ in range(len(accepted) - count):
+                _pending_job_slots.release()
+            for pending_position, _, pending_filename in accepted[count:]:
+                jobs[pending_position] = {
+                    'file': pending_filename, 'status': 'failed', 'error': f'提交分析任务时出错: {str(e)}'
                 }
+            break
 
-                processed_data.append(record)
+        job = BatchFileJob(session_id, future, main_filename)
+        job_store.put(job.job_id, job, sys.getsizeof(job))
+        future.add_done_callback(lambda f, job=job: on_job_done(job, f))
+        jobs[position] = {'file': main_filename, 'job_id': job.job_id, 'status': job.status}
 
-                # 只记录异常数据
-                if is_abnormal:
-                    abnormal_records.append(record)
+    batch = AnalysisBatch(session_id, analysis_dates, abnormal_threshold, jobs)
+    batch_store.put(batch.batch_id, batch, sys.getsizeof(batch) + len(app.json.dumps(jobs)))
 
-            # 存储处理后的数据
-            monitor_data = processed_data
+    return jsonify({
+        'message': '批量分析任务已提交',
+        'batch_id': batch.batch_id,
+        'abnormal_threshold': abnormal_threshold,
+        'analysis_dates': analysis_dates,
+        'jobs': jobs,
+        'session_id': session_id
+    }), 202
 
-            # 转换为可序列化的格式
-            for record in abnormal_records:
-                for key in record:
-                    record[key] = convert_to_serializable(record[key])
 
-            # 生成分析报告
-            result_text = f"""=== 数据分析报告 ===
-生成时间: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+@app.route('/api/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """查询批量分析的整体状态，返回所有文件和日期的分析条目"""
+    batch = batch_store.get(batch_id)
+    if batch is None:
+        return jsonify({'error': '批量分析任务不存在或已过期'}), 404
 
-分析参数:
-├── 异常阈值: {abnormal_threshold}%
-├── 分析日期: {analysis_date}
-├── 主文件: {main_filename}
-"""
+    return jsonify(batch.to_dict())
 
-            if is_first_day and extra_file:
-                result_text += f"└── 月度文件: {extra_filename}\n\n"
-            else:
-                result_text += "└── 月度文件: 不需要\n\n"
-
-            result_text += "分析过程:\n"
-            result_text += "├── 正在读取文件数据... ✓\n"
-            result_text += "├── 正在解析数据格式... ✓\n"
-            result_text += "├── 查找合计行数据... ✓\n"
-            result_text += "├── 计算气量变化... ✓\n"
-            result_text += "└── 生成分析报告... ✓\n\n"
-
-            result_text += f"分析结果 (阈值 {abnormal_threshold}%):\n"
-            result_text += f"├── 当日总气量: {total_current_gas} 万立方米\n"
-            result_text += f"├── 前日总气量: {total_prev_gas} 万立方米\n"
-            result_text += f"├── 总变化量: {total_current_gas - total_prev_gas} 万立方米\n"
-            result_text += f"├── 总变化率: {(total_current_gas - total_prev_gas) / total_prev_gas * 100 if total_prev_gas != 0 else 0}%\n"
-            result_text += f"└── 异常数据数量: {len(abnormal_records)}\n\n"
-
-            if abnormal_records:
-                result_text += "异常数据详情:\n"
-                for record in abnormal_records:
-                    result_text += f"├── {record['名称']}: {record['气量(万立方米)']} → {record['前一天气量(万立方米)']} (变化: {record['变化量(万立方米)']}, 变化率: {record['变化率(%)']})\n"
-                result_text += "\n"
-
-            result_text += "建议操作:\n"
-            result_text += "├── 查看详细报告\n"
-            result_text += "├── 导出分析结果\n"
-            result_text += "└── 调整阈值重新分析\n"
 
-            return jsonify({
-                'message': '数据分析成功',
-                'result_text': result_text,
-                'abnormal_threshold': abnormal_threshold,
-                'abnormal_count': len(abnormal_records),
-                'abnormal_records': abnormal_records,
-                'total_current_gas': total_current_gas,
-                'total_prev_gas': total_prev_gas,
-                'data': monitor_data
+@app.route('/api/analyze_month', methods=['POST'])
+def analyze_month():
+    """一次性分析整月数据，返回所有相邻日期的异常热力图"""
+    if 'main_file' not in request.files:
+        return jsonify({'error': '没有主文件部分'}), 400
+
+    main_file = request.files['main_file']
+    if main_file.filename == '':
+        return jsonify({'error': '未选择主文件'}), 400
+    if not allowed_file(main_file.filename):
+        return jsonify({'error': '文件类型不允许'}), 400
+
+    # scope 为 total 时只分析合计行，为 all 时分析所有行
+    scope = request.form.get('scope', 'total')
+    if scope not in ('total', 'all'):
+        return jsonify({'error': '参数格式错误'}), 400
+
+    # detector 为 change_rate 时按相邻两天变化率判断异常，否则使用 ANOMALY_DETECTORS 中的统计方法
+    detector = request.form.get('detector', 'change_rate')
+    if detector != 'change_rate' and detector not in ANOMALY_DETECTORS:
+        return jsonify({'error': '不支持的检测方法'}), 400
+
+    try:
+        threshold = float(request.form.get('threshold', get_session_threshold(get_session_id())))
+        score_threshold = None
+        if detector != 'change_rate':
+            score_threshold = float(request.form.get('score_threshold', ANOMALY_DETECTORS[detector][1]))
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+
+    try:
+        main_workbook = open_uploaded_workbook(main_file)
+        layout = main_workbook.layout
+
+        sequence_col = layout.sequence_col
+        if sequence_col is None:
+            return jsonify({'error': '未找到"序号"列'}), 400
+
+        date_columns_sorted = layout.date_columns
+        if len(date_columns_sorted) < 2:
+            return jsonify({'error': '至少需要两个日期列（格式应为"X日"或"气量-X日"）'}), 400
+
+        name_col = layout.name_col
+        df = main_workbook.load_columns([sequence_col, layout.category_col, name_col] + date_columns_sorted)
+
+        rows = layout.select_total_rows(df) if scope == 'total' else df
+        if rows.empty:
+            return jsonify({'error': '未找到"合计"行'}), 400
+
+        # (行 × 天) 矩阵上做一次相邻列差分
+        matrix = rows[date_columns_sorted].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+        changes = compute_month_changes(matrix, threshold)
+        if detector == 'change_rate':
+            scores = changes['change_rate']
+            abnormal = changes['abnormal']
+        else:
+            # 第一个日期列之前没有数据，分数矩阵与变化矩阵对齐时去掉
+            scores = ANOMALY_DETECTORS[detector][0](matrix)[:, 1:]
+            abnormal = np.abs(scores) > score_threshold
+        missing = np.isnan(scores)
+
+        # 紧凑热力图：每行一个字符串，1 为异常，0 为正常，- 为无法计算
+        cells = np.where(abnormal, '1', np.where(missing, '-', '0'))
+        heatmap = [''.join(row) for row in cells]
+
+        row_idx, col_idx = np.nonzero(abnormal)
+        days = [extract_date_from_column_name(c) for c in date_columns_sorted[1:]]
+        abnormal_cells = [
+            [int(r), days[c], rate]
+            for r, c, rate in zip(row_idx.tolist(), col_idx.tolist(),
+                                  nan_to_none(np.round(changes['change_rate'][row_idx, col_idx], 2)))
+        ]
+
+        row_ids = rows[sequence_col].to_numpy()
+        row_names = rows[name_col].to_numpy() if name_col else np.array([f"合计行{row_id}" for row_id in row_ids])
+
+        # 异常单元格按日期生成与 /api/analyze 相同结构的记录，并附带检测分数
+        abnormal_records = []
+        for c in np.flatnonzero(abnormal.any(axis=0)).tolist():
+            r = np.flatnonzero(abnormal[:, c])
+            records = build_change_records(
+                row_ids[r], row_names[r], f"{days[c]}日",
+                {key: values[r, c] for key, values in changes.items()}
+            )
+            for record, score in zip(records, np.round(scores[r, c], 4).tolist()):
+                record['异常'] = True
+                record['异常分数'] = score
+            abnormal_records.extend(records)
+
+        row_ids = row_ids.tolist()
+        row_names = row_names.tolist()
+
+        return jsonify({
+            'message': '月度分析成功',
+            'detector': detector,
+            'abnormal_threshold': threshold,
+            'score_threshold': score_threshold,
+            'days': days,
+            'rows': [{'序号': row_id, '名称': name}
+                     for row_id, name in zip(nan_to_none(row_ids), nan_to_none(row_names))],
+            'heatmap': heatmap,
+            'abnormal_count': len(abnormal_cells),
+            'daily_abnormal_counts': abnormal.sum(axis=0),
+            'abnormal_cells': abnormal_cells,
+            'abnormal_records': abnormal_records
+        })
+
+    except Exception as e:
+        return jsonify({'error': f'处理文件时出错: {str(e)}'}), 500
+
+
+def top_k_positions(positions, keys, k):
+    """从 positions 中选出 keys 最大的 k 个位置（按 keys 从大到小），先用 argpartition 部分排序再排序这 k 个"""
+    if len(positions) > k:
+        positions = positions[np.argpartition(-keys[positions], k - 1)[:k]]
+    return positions[np.argsort(-keys[positions], kind='stable')]
+
+
+def run_customer_analysis(main_workbook, analysis_date, abnormal_threshold, top_k=DEFAULT_TOP_K,
+                          extra_workbook=None, previous_volumes=None):
+    """分析所有客户行（合计行以外）的气量变化，按分类汇总并返回每个分类变化率最大的异常客户
+
+    全部按列计算：变化量和变化率一次性算出，分类汇总用 factorize + bincount，
+    每个分类的前 k 个异常客户用部分排序选出，只为这些客户生成记录。
+    每月1号的前一天气量取自月度补充文件最后一个日期列（按序号对应），没有补充文件时取自 previous_volumes。
+    """
+    current_day = datetime.strptime(analysis_date, '%Y-%m-%d').day
+    is_first_day = current_day == 1
+
+    try:
+        layout = main_workbook.layout
+        sequence_col = layout.sequence_col
+        if sequence_col is None:
+            raise AnalysisError('未找到"序号"列')
+
+        category_col = layout.category_col
+        if category_col is None:
+            raise AnalysisError('未找到"分类"列')
+
+        current_col = layout.column_for_day(current_day)
+        if not current_col:
+            raise AnalysisError(f'未找到{current_day}日的气量列')
+
+        prev_col = None
+        if not is_first_day:
+            prev_col = layout.column_for_day(current_day - 1)
+            if not prev_col:
+                raise AnalysisError(f'未找到{current_day - 1}日的气量列')
+
+        df = main_workbook.load_columns([sequence_col, category_col, layout.name_col, current_col, prev_col])
+
+        customers = customer_rows(layout, df)
+        if customers.empty:
+            raise AnalysisError('未找到客户数据')
+
+        row_id_series = customers[sequence_col]
+        if prev_col is not None:
+            prev_values = to_numeric_array(customers[prev_col])
+        else:
+            prev_values = customer_previous_values(row_id_series, extra_workbook, previous_volumes)
+
+        changes = compute_changes(to_numeric_array(customers[current_col]), prev_values, abnormal_threshold)
+
+        # 按分类汇总
+        codes, categories = pd.factorize(customers[category_col], use_na_sentinel=False)
+        category_count = len(categories)
+        abnormal = changes['abnormal']
+        customer_counts = np.bincount(codes, minlength=category_count)
+        abnormal_counts = np.bincount(codes, weights=abnormal, minlength=category_count).astype(int)
+        current_sums = np.bincount(codes, weights=np.nan_to_num(changes['current']), minlength=category_count)
+        prev_sums = np.bincount(codes, weights=np.nan_to_num(changes['previous']), minlength=category_count)
+
+        # 异常客户按分类分组（稳定排序保持原始顺序），每组部分排序取变化率绝对值最大的 k 个
+        abnormal_positions = np.flatnonzero(abnormal)
+        abnormal_positions = abnormal_positions[np.argsort(codes[abnormal_positions], kind='stable')]
+        groups = np.split(abnormal_positions, np.cumsum(abnormal_counts)[:-1])
+        abs_rates = np.abs(np.nan_to_num(changes['change_rate']))
+
+        row_ids = row_id_series.to_numpy()
+        if layout.name_col:
+            row_names = customers[layout.name_col].to_numpy()
+        else:
+            row_names = np.array([f"客户{row_id}" for row_id in row_ids], dtype=object)
+
+        category_results = []
+        for c, category in enumerate(nan_to_none(list(categories))):
+            selected = top_k_positions(groups[c], abs_rates, top_k)
+            top_records = build_change_records(
+                row_ids[selected], row_names[selected], f"{current_day}日",
+                {key: values[selected] for key, values in changes.items()}
+            )
+            prev_sum = float(prev_sums[c])
+            change_rate = (current_sums[c] - prev_sum) / prev_sum * 100 if prev_sum != 0 else None
+            category_results.append({
+                '分类': category,
+                '客户数量': int(customer_counts[c]),
+                '气量(万立方米)': float(current_sums[c]),
+                '前一天气量(万立方米)': prev_sum,
+                '变化量(万立方米)': float(current_sums[c] - prev_sum),
+                '变化率(%)': f"{change_rate}%" if change_rate is not None else None,
+                '异常数量': int(abnormal_counts[c]),
+                'top_abnormal_records': top_records
             })
 
+        return {
+            'analysis_date': analysis_date,
+            'abnormal_threshold': abnormal_threshold,
+            'customer_count': len(customers),
+            'abnormal_count': int(abnormal_counts.sum()),
+            'categories': category_results
+        }
+
+    except AnalysisError:
+        raise
+    except Exception as e:
+        raise AnalysisError(f'处理文件时出错: {str(e)}', 500)
+
+
+@app.route('/api/analyze_customers', methods=['POST'])
+def analyze_customers():
+    """分析所有客户行的气量变化，按分类汇总并返回每个分类的前 top_k 个异常客户"""
+    session_id = get_session_id()
+
+    try:
+        params = parse_analyze_request(get_session_threshold(session_id))
+        top_k = int(request.form.get('top_k', DEFAULT_TOP_K))
+        if top_k <= 0:
+            raise AnalysisError('参数格式错误')
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+    except AnalysisError as e:
+        return jsonify({'error': e.message}), e.status
+
+    extra_file = params['extra_file']
+    try:
+        result = run_customer_analysis(
+            open_uploaded_workbook(params['main_file']),
+            params['analysis_date'],
+            params['abnormal_threshold'],
+            top_k,
+            open_uploaded_workbook(extra_file) if extra_file else None,
+            params['previous_volumes']
+        )
+    except AnalysisError as e:
+        return jsonify({'error': e.message}), e.status
+
+    return jsonify({'message': '客户分析成功', **result})
+
+
+def find_named_column(columns, names):
+    """按候选列名（依次优先）查找列"""
+    stripped = {str(col).strip(): col for col in reversed(columns)}
+    return next((stripped[name] for name in names if name in stripped), None)
+
+
+def normalize_customer_names(values):
+    """对账用的客户名称：全角半角统一（NFKC），去掉所有空白"""
+    return values.astype('string').str.normalize('NFKC').str.replace(r'\s+', '', regex=True)
+
+
+def normalize_customer_name(value):
+    """单个客户名称的 normalize_customer_names"""
+    return re.sub(r'\s+', '', unicodedata.normalize('NFKC', str(value)))
+
+
+def canonical_customer_name(name):
+    """模糊匹配用的客户名称：在 normalize_customer_name 的基础上去掉标点符号和公司名称后缀"""
+    name = re.sub(r'[^\w]', '', normalize_customer_name(name))
+    for suffix in COMPANY_NAME_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def name_bigrams(name):
+    """名称的二元组多重集（Counter），单字名称为该字本身；重复的二元组分别计数，"1000"与"10000"不会视为相同"""
+    if len(name) < 2:
+        return Counter([name] if name else [])
+    return Counter(name[i:i + 2] for i in range(len(name) - 1))
+
+
+def bigram_dice(grams, other):
+    """两个二元组多重集的 Dice 系数"""
+    return 2 * sum((grams & other).values()) / (sum(grams.values()) + sum(other.values()))
+
+
+class CustomerNameIndex:
+    """客户名称的二元组倒排索引
+
+    按规范化后的名称建立"二元组 -> 名称编号"的倒排表，查询时不与全部名称逐一比较：
+    相似度（二元组的 Dice 系数）不低于 t 的名称至少共享 ceil(t / (2 - t) * n) 个二元组（n 为查询名称的二元组数），
+    因此只需取查询名称中最少见的 n - 该数量 + 1 个二元组的倒排表作为候选（前缀过滤），
+    常见的二元组（如"燃气"）通常不必展开；候选再按完整的二元组计算相似度。
+    指定 allowed 且其中的名称比要展开的倒排表更少时，直接逐个计算 allowed 中名称的相似度。
+    """
+
+    def __init__(self, keys):
+        self.keys = list(dict.fromkeys(key for key in keys if key))  # 建立索引的名称（已 normalize_customer_name）
+        self._ids = {key: i for i, key in enumerate(self.keys)}
+        self._canonical = [canonical_customer_name(key) for key in self.keys]
+        postings = defaultdict(list)
+        for i, name in enumerate(self._canonical):
+            for gram in name_bigrams(name):
+                postings[gram].append(i)
+        self._postings = dict(postings)
+
+    def candidates(self, name, min_score=FUZZY_MATCH_MIN_SCORE, allowed=None):
+        """返回相似度不低于 min_score 的 (名称, 相似度) 列表，按相似度从高到低；allowed 限定可返回的名称"""
+        grams = name_bigrams(canonical_customer_name(name))
+        if not grams:
+            return []
+
+        # 前缀过滤：二元组（含重复）按倒排表长度从短到长排列，只展开前面的二元组
+        ordered = sorted(grams.elements(), key=lambda gram: len(self._postings.get(gram, ())))
+        required = max(1, math.ceil(min_score / (2 - min_score) * len(ordered)))
+        prefix = set(ordered[:len(ordered) - required + 1])
+
+        if allowed is not None and len(allowed) < sum(len(self._postings.get(gram, ())) for gram in prefix):
+            candidate_ids = {self._ids[key] for key in allowed if key in self._ids}
+        else:
+            candidate_ids = set()
+            for gram in prefix:
+                candidate_ids.update(self._postings.get(gram, ()))
+
+        scores = {}
+        for i in candidate_ids:
+            score = bigram_dice(grams, name_bigrams(self._canonical[i]))
+            if score >= min_score:
+                scores[i] = score
+
+        results = [(self.keys[i], score) for i, score in scores.items()
+                   if allowed is None or self.keys[i] in allowed]
+        return sorted(results, key=lambda item: -item[1])
+
+    def estimated_bytes(self):
+        return sum(sys.getsizeof(key) for key in self.keys) * 2 + \
+            sum(len(posting) for posting in self._postings.values()) * 40 + sys.getsizeof(self._postings)
+
+
+def get_name_index(workbook, name_col):
+    """获取工作簿客户名称列的倒排索引，按文件内容哈希缓存，同一文件再次对账时直接复用"""
+    cache_key = ('name_index', workbook.cache_key, name_col)
+    index = workbook_cache.get(cache_key)
+    if index is None:
+        names = workbook.load_columns([name_col])[name_col].dropna()
+        index = CustomerNameIndex(normalize_customer_names(names).tolist())
+        workbook_cache.put(cache_key, index, index.estimated_bytes())
+    return index
+
+
+def match_customer_names(index, names, allowed, min_score=FUZZY_MATCH_MIN_SCORE):
+    """为 names 中的每个名称在索引中找最相似的名称（只在 allowed 中选），一对一贪心匹配
+
+    返回 (查询名称, 匹配名称, 相似度) 列表；候选对按相似度从高到低依次接受，
+    已被匹配的名称不再参与后续匹配。
+    """
+    pairs = []
+    for name in names:
+        for key, score in index.candidates(name, min_score, allowed):
+            pairs.append((score, name, key))
+    pairs.sort(key=lambda pair: -pair[0])
+
+    matched_names, matched_keys, matches = set(), set(), []
+    for score, name, key in pairs:
+        if name not in matched_names and key not in matched_keys:
+            matched_names.add(name)
+            matched_keys.add(key)
+            matches.append((name, key, score))
+    return matches
+
+
+def reconcile_columns(layout, key, day=None):
+    """确定对账字段和所需的列，返回 (对账字段, 客户编号列, 客户名称列, 气量列)
+
+    key 为 auto 时有客户编号列则按编号对账，否则按名称；
+    气量列为指定日期（day）的日期列，未指定时取第一个列名包含"气量"的非日期列。
+    """
+    id_col = find_named_column(layout.columns, CUSTOMER_ID_COLUMN_NAMES)
+    name_col = find_named_column(layout.columns, CUSTOMER_NAME_COLUMN_NAMES)
+    if key == 'auto':
+        key = 'id' if id_col is not None else 'name'
+    if key == 'id' and id_col is None:
+        raise AnalysisError('未找到"客户编号"列')
+    if key == 'name' and name_col is None:
+        raise AnalysisError('未找到"客户名称"列')
+
+    if day is not None:
+        volume_col = layout.column_for_day(day)
+        if not volume_col:
+            raise AnalysisError(f'未找到{day}日的气量列')
+    else:
+        date_columns = set(layout.date_columns)
+        volume_col = next((col for col in layout.columns if '气量' in str(col) and col not in date_columns), None)
+        if volume_col is None:
+            raise AnalysisError('未找到气量列')
+
+    return key, id_col, name_col, volume_col
+
+
+def normalize_customer_ids(values):
+    """客户编号统一转为去掉首尾空白的字符串
+
+    编号列含空单元格时 pandas 读出的是浮点数，整数值的浮点编号按 history_key 的规则去掉小数部分，
+    使 1001.0 与另一侧的 1001 或 "1001" 相同。
+    """
+    return values.map(history_key, na_action='ignore').astype('string').str.strip()
+
+
+def load_reconcile_frame(workbook, key, day=None):
+    """读取对账所需的列，返回按对账键汇总后的 DataFrame（列为 key、客户编号、客户名称、气量）
+
+    分类为"合计"的行和对账键为空的行不参与对账，同一对账键的多行气量相加。
+    """
+    layout = workbook.layout
+    key, id_col, name_col, volume_col = reconcile_columns(layout, key, day)
+
+    df = workbook.load_columns([id_col, name_col, layout.category_col, volume_col])
+    if layout.category_col:
+        df = df[df[layout.category_col] != '合计']
+
+    frame = pd.DataFrame({
+        '客户编号': normalize_customer_ids(df[id_col]) if id_col is not None else pd.NA,
+        '客户名称': df[name_col] if name_col is not None else pd.NA,
+        '气量': to_numeric_array(df[volume_col])
+    })
+    frame['key'] = frame['客户编号'] if key == 'id' else normalize_customer_names(frame['客户名称'])
+    frame = frame[frame['key'].notna() & (frame['key'] != '')]
+
+    grouped = frame.groupby('key', sort=False)
+    result = grouped[['客户编号', '客户名称']].first()
+    # min_count=1：全部缺失时汇总结果仍为缺失，而不是0
+    result['气量'] = grouped['气量'].sum(min_count=1)
+    result['行数'] = grouped.size()
+    return result, key
+
+
+def reconcile_records(frame, positions):
+    """根据对账结果中的位置生成记录列表"""
+    rows = frame.iloc[positions]
+    return [
+        {'客户编号': customer_id, '客户名称': name, 'A8气量': a8, '营销系统气量': marketing, '差异': difference}
+        for customer_id, name, a8, marketing, difference in zip(
+            nan_to_none(rows['客户编号'].tolist()), nan_to_none(rows['客户名称'].tolist()),
+            nan_to_none(rows['气量_a8'].tolist()), nan_to_none(rows['气量_marketing'].tolist()),
+            nan_to_none(rows['差异'].tolist())
+        )
+    ]
+
+
+def apply_fuzzy_matches(merged, a8_workbook, day, min_score):
+    """用客户名称模糊匹配连接结果中只在一侧出现的客户，匹配上的两行合并为一行
+
+    在A8推送表客户名称的倒排索引中为每个缺失客户查找相似名称，候选只限于多余客户；
+    返回 (合并后的连接结果, 匹配列表)。
+    """
+    side = merged['_merge']
+    missing = merged[side == 'right_only']
+    extra = merged[side == 'left_only']
+    if missing.empty or extra.empty:
+        return merged, []
+
+    index = get_name_index(a8_workbook, reconcile_columns(a8_workbook.layout, 'name', day)[2])
+    extra_labels = {}
+    for label, name in zip(extra.index, extra['客户名称_a8']):
+        if not pd.isna(name):
+            extra_labels.setdefault(normalize_customer_name(name), label)
+    missing_labels = {}
+    for label, name in zip(missing.index, missing['客户名称_marketing']):
+        if not pd.isna(name):
+            missing_labels.setdefault(normalize_customer_name(name), label)
+
+    matches = match_customer_names(index, list(missing_labels), extra_labels, min_score)
+    if not matches:
+        return merged, []
+
+    missing_index = [missing_labels[name] for name, _, _ in matches]
+    extra_index = [extra_labels[key] for _, key, _ in matches]
+    fuzzy_matches = [
+        {'营销系统名称': marketing_name, 'A8名称': a8_name, '相似度': round(score, 4)}
+        for marketing_name, a8_name, (_, _, score) in zip(
+            merged.loc[missing_index, '客户名称_marketing'].tolist(),
+            merged.loc[extra_index, '客户名称_a8'].tolist(), matches)
+    ]
+
+    merged = merged.copy()
+    for column in ('客户编号_a8', '客户名称_a8', '气量_a8'):
+        merged.loc[missing_index, column] = merged.loc[extra_index, column].to_numpy()
+    merged.loc[missing_index, '_merge'] = 'both'
+    merged = merged.drop(index=extra_index)
+    merged['差异'] = merged['气量_a8'] - merged['气量_marketing']
+    return merged, fuzzy_matches
+
+
+def run_reconciliation(a8_workbook, marketing_workbook, key='auto', day=None, tolerance=0.0, limit=None,
+                       fuzzy=False, min_score=FUZZY_MATCH_MIN_SCORE):
+    """A8系统推送表与营销系统数据对账
+
+    两个文件分别按对账键（客户编号或客户名称）汇总后做一次哈希连接（pandas merge），
+    按列判断缺失（营销系统有而A8没有）、多余（A8有而营销系统没有）和气量不一致的客户，
+    只为返回的前 limit 条记录生成字典；不一致记录按差异绝对值从大到小排列。
+    fuzzy 为真时，缺失客户和多余客户再按客户名称模糊匹配，相似度不低于 min_score 的视为同一客户。
+    """
+    try:
+        a8, a8_key = load_reconcile_frame(a8_workbook, key, day)
+        # 营销系统数据使用与A8推送表相同的对账字段
+        marketing, _ = load_reconcile_frame(marketing_workbook, a8_key, day)
+
+        merged = a8.merge(marketing, how='outer', left_index=True, right_index=True,
+                          suffixes=('_a8', '_marketing'), indicator=True)
+        merged['客户编号'] = merged['客户编号_marketing'].fillna(merged['客户编号_a8'])
+        merged['客户名称'] = merged['客户名称_marketing'].fillna(merged['客户名称_a8'])
+        merged['差异'] = merged['气量_a8'] - merged['气量_marketing']
+
+        fuzzy_matches = []
+        if fuzzy:
+            merged, fuzzy_matches = apply_fuzzy_matches(merged, a8_workbook, day, min_score)
+
+        side = merged['_merge'].to_numpy()
+        difference = merged['差异'].to_numpy(dtype=float)
+        both = side == 'both'
+        a8_missing = np.isnan(merged['气量_a8'].to_numpy(dtype=float))
+        marketing_missing = np.isnan(merged['气量_marketing'].to_numpy(dtype=float))
+
+        missing_positions = np.flatnonzero(side == 'right_only')
+        extra_positions = np.flatnonzero(side == 'left_only')
+        # 一边有气量另一边为空也算不一致
+        mismatched = both & ((np.abs(difference) > tolerance) | (a8_missing != marketing_missing))
+        mismatched_positions = np.flatnonzero(mismatched)
+        mismatched_positions = mismatched_positions[
+            np.argsort(-np.abs(np.nan_to_num(difference[mismatched_positions], nan=np.inf)), kind='stable')
+        ]
+
+        return {
+            'key': a8_key,
+            'tolerance': tolerance,
+            'a8_count': len(a8),
+            'marketing_count': len(marketing),
+            'matched_count': int(both.sum() - len(mismatched_positions)),
+            'missing_count': len(missing_positions),
+            'extra_count': len(extra_positions),
+            'mismatched_count': len(mismatched_positions),
+            'a8_duplicate_count': int((a8['行数'] > 1).sum()),
+            'marketing_duplicate_count': int((marketing['行数'] > 1).sum()),
+            'a8_total': float(np.nansum(merged['气量_a8'].to_numpy(dtype=float))),
+            'marketing_total': float(np.nansum(merged['气量_marketing'].to_numpy(dtype=float))),
+            'missing': reconcile_records(merged, missing_positions[:limit]),
+            'extra': reconcile_records(merged, extra_positions[:limit]),
+            'mismatched': reconcile_records(merged, mismatched_positions[:limit]),
+            'fuzzy_match_count': len(fuzzy_matches),
+            'fuzzy_matches': fuzzy_matches[:limit]
+        }
+
+    except AnalysisError:
+        raise
+    except Exception as e:
+        raise AnalysisError(f'处理文件时出错: {str(e)}', 500)
+
+
+def iter_sheet_rows(source, data_start_row, positions):
+    """逐行读取 xlsx 第一个工作表的数据区，只返回指定列位置的单元格值（跳过空行），内存占用与文件大小无关"""
+    book = load_workbook(source, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = book.worksheets[0]
+        sheet.reset_dimensions()
+        for row in sheet.iter_rows(min_row=data_start_row + 1, values_only=True):
+            values = tuple(excel_cell_value(row[p]) if p < len(row) else '' for p in positions)
+            if any(value != '' for value in values):
+                yield values
+    finally:
+        book.close()
+
+
+def cell_number(value):
+    """单元格值转换为浮点数，无法转换时为 NaN"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    try:
+        return float(str(value).strip())
+    except ValueError:
+        return np.nan
+
+
+def reconcile_sort_key(key_value):
+    """对账键的排序键：纯数字的编号按数值排序（998 < 999 < 1000），排在其余按字符串排序的键之前
+
+    数值相同而写法不同的编号（如 "001" 和 "1"）仍是不同的键，按字符串区分。
+    """
+    if key_value.isascii() and key_value.isdigit():
+        return 0, int(key_value), key_value
+    return 1, 0, key_value
+
+
+def iter_reconcile_records(workbook, key, day=None):
+    """逐行读取工作簿中的对账记录 (排序键, 客户编号, 客户名称, 气量)，规则与 load_reconcile_frame 相同
+
+    第一项为 reconcile_sort_key 转换后的对账键，排序、有序性检查、合并和归并连接都按它比较。
+    """
+    layout = workbook.layout
+    key, id_col, name_col, volume_col = reconcile_columns(layout, key, day)
+    columns = [id_col, name_col, layout.category_col, volume_col]
+    positions = [layout.positions[col] for col in columns if col is not None]
+    index = {col: i for i, col in enumerate(col for col in columns if col is not None)}
+
+    def cell(values, col):
+        if col is None or values[index[col]] == '':
+            return None
+        return values[index[col]]
+
+    for values in iter_sheet_rows(workbook._source(), layout.data_start_row, positions):
+        if layout.category_col and cell(values, layout.category_col) == '合计':
+            continue
+        customer_id = cell(values, id_col)
+        name = cell(values, name_col)
+        if customer_id is not None:
+            customer_id = history_key(customer_id).strip()
+        if key == 'id':
+            key_value = customer_id
+        else:
+            key_value = normalize_customer_name(name) if name is not None else None
+        if key_value:
+            yield reconcile_sort_key(key_value), customer_id, name, cell_number(values[index[volume_col]])
+
+
+def spill_sorted_run(records):
+    """将一批记录按对账键排序后分块写入临时文件，返回读取位置已回到开头的文件"""
+    records.sort(key=itemgetter(0))
+    run = tempfile.TemporaryFile()
+    for start in range(0, len(records), 4096):
+        pickle.dump(records[start:start + 4096], run, protocol=pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def iter_sorted_run(run):
+    """逐块读回 spill_sorted_run 写入的记录，读完后关闭临时文件"""
+    try:
+        while True:
+            yield from pickle.load(run)
+    except EOFError:
+        run.close()
+
+
+def external_sort(records, run_rows, source):
+    """外部排序：每 run_rows 条记录排序后写入临时文件，最后多路归并
+
+    生成进度事件，生成器结束时返回按对账键有序的记录迭代器（用 yield from 取得）；
+    记录不超过 run_rows 条时直接在内存中排序。
+    """
+    runs = []
+    buffer = []
+    count = 0
+    for record in records:
+        buffer.append(record)
+        count += 1
+        if len(buffer) >= run_rows:
+            runs.append(spill_sorted_run(buffer))
+            buffer = []
+            yield {'type': 'progress', 'source': source, 'rows': count, 'runs': len(runs)}
+
+    buffer.sort(key=itemgetter(0))
+    yield {'type': 'progress', 'source': source, 'rows': count, 'runs': len(runs), 'done': True}
+    if not runs:
+        return iter(buffer)
+    return heapq.merge(*(iter_sorted_run(run) for run in runs), buffer, key=itemgetter(0))
+
+
+def check_sorted(records, source):
+    """原样返回记录，同时确认记录已按对账键升序排列"""
+    previous = None
+    for record in records:
+        if previous is not None and record[0] < previous:
+            raise AnalysisError(f'{source}文件未按对账字段排序')
+        previous = record[0]
+        yield record
+
+
+def aggregate_sorted(records):
+    """合并有序记录中对账键相同的相邻记录，气量相加（全部缺失时仍为缺失）"""
+    for key_value, group in groupby(records, key=itemgetter(0)):
+        _, customer_id, name, volume = next(group)
+        for record in group:
+            if record[3] == record[3]:
+                volume = record[3] if volume != volume else volume + record[3]
+        yield key_value, customer_id, name, volume
+
+
+def merge_join(left, right):
+    """两路有序记录的归并连接，生成 (左记录或 None, 右记录或 None)"""
+    left_record = next(left, None)
+    right_record = next(right, None)
+    while left_record is not None or right_record is not None:
+        if right_record is None or (left_record is not None and left_record[0] < right_record[0]):
+            yield left_record, None
+            left_record = next(left, None)
+        elif left_record is None or right_record[0] < left_record[0]:
+            yield None, right_record
+            right_record = next(right, None)
+        else:
+            yield left_record, right_record
+            left_record = next(left, None)
+            right_record = next(right, None)
+
+
+def stream_reconciliation(a8_workbook, dispatch_workbook, key='auto', day=None, tolerance=0.0,
+                          presorted=False, run_rows=None, fuzzy=False, min_score=FUZZY_MATCH_MIN_SCORE):
+    """A8系统推送表与生产调度出库数据的流式对账，逐条生成事件字典
+
+    两个文件逐行读取，各自外部排序（超过 run_rows 行的部分排序后写入临时文件）后归并连接，
+    内存占用只与 run_rows 有关。presorted 为真时两个文件须已按对账字段升序排列
+    （纯数字的编号按数值，其余按字符串，见 reconcile_sort_key），不再排序，读到第一行就开始输出对账结果。
+    事件类型：progress（读取进度）、missing（出库数据有而A8没有）、extra（A8有而出库数据没有）、
+    mismatched（气量不一致）以及最后的 summary。
+    fuzzy 为真时，在归并结束后对已输出的缺失和多余客户按名称模糊匹配，以 fuzzy_match 事件输出配对结果。
+    """
+    run_rows = run_rows or app.config['RECONCILE_RUN_ROWS']
+    a8_key = reconcile_columns(a8_workbook.layout, key, day)[0]
+    # 出库数据使用与A8推送表相同的对账字段
+    reconcile_columns(dispatch_workbook.layout, a8_key, day)
+
+    a8_records = iter_reconcile_records(a8_workbook, a8_key, day)
+    dispatch_records = iter_reconcile_records(dispatch_workbook, a8_key, day)
+    if presorted:
+        a8_sorted = check_sorted(a8_records, 'A8推送表')
+        dispatch_sorted = check_sorted(dispatch_records, '出库数据')
+    else:
+        a8_sorted = yield from external_sort(a8_records, run_rows, 'a8')
+        dispatch_sorted = yield from external_sort(dispatch_records, run_rows, 'dispatch')
+
+    counts = {'matched': 0, 'missing': 0, 'extra': 0, 'mismatched': 0, 'fuzzy_match': 0}
+    unmatched = {'missing': {}, 'extra': {}}  # 模糊匹配用：规范化名称 -> 记录
+    for a8_record, dispatch_record in merge_join(aggregate_sorted(a8_sorted), aggregate_sorted(dispatch_sorted)):
+        a8_volume = a8_record[3] if a8_record else None
+        dispatch_volume = dispatch_record[3] if dispatch_record else None
+        if a8_record is None:
+            kind = 'missing'
+        elif dispatch_record is None:
+            kind = 'extra'
+        elif (a8_volume != a8_volume) != (dispatch_volume != dispatch_volume) or \
+                abs(a8_volume - dispatch_volume) > tolerance:
+            kind = 'mismatched'
+        else:
+            counts['matched'] += 1
+            continue
+
+        counts[kind] += 1
+        if fuzzy and kind != 'mismatched':
+            record = a8_record or dispatch_record
+            if record[2] is not None:
+                unmatched[kind].setdefault(normalize_customer_name(record[2]), record)
+        reference = dispatch_record or a8_record
+        difference = a8_volume - dispatch_volume if a8_record and dispatch_record else None
+        yield {
+            'type': kind,
+            'record': {
+                '客户编号': reference[1],
+                '客户名称': reference[2],
+                'A8气量': nan_to_none([a8_volume])[0],
+                '出库气量': nan_to_none([dispatch_volume])[0],
+                '差异': nan_to_none([difference])[0]
+            }
+        }
+
+    if unmatched['missing'] and unmatched['extra']:
+        index = CustomerNameIndex(list(unmatched['extra']))
+        for name, key_name, score in match_customer_names(index, list(unmatched['missing']),
+                                                           unmatched['extra'], min_score):
+            dispatch_record, a8_record = unmatched['missing'][name], unmatched['extra'][key_name]
+            a8_volume, dispatch_volume = a8_record[3], dispatch_record[3]
+            counts['fuzzy_match'] += 1
+            yield {
+                'type': 'fuzzy_match',
+                'record': {
+                    '客户编号': dispatch_record[1],
+                    '客户名称': dispatch_record[2],
+                    'A8客户编号': a8_record[1],
+                    'A8名称': a8_record[2],
+                    '相似度': round(score, 4),
+                    'A8气量': nan_to_none([a8_volume])[0],
+                    '出库气量': nan_to_none([dispatch_volume])[0],
+                    '差异': nan_to_none([a8_volume - dispatch_volume])[0]
+                }
+            }
+
+    yield {'type': 'summary', 'key': a8_key, 'tolerance': tolerance,
+           **{f'{kind}_count': count for kind, count in counts.items()}}
+
+
+@app.route('/api/reconcile_dispatch', methods=['POST'])
+def reconcile_dispatch():
+    """生产调度出库数据（dispatch_file）与A8系统推送表（a8_file）的流式对账
+
+    参数与 /api/reconcile 相同（没有 limit），另有 presorted（1 表示两个文件已按对账字段排序）。
+    fuzzy 为 1 时在最后输出缺失和多余客户按名称模糊匹配的结果（fuzzy_match 事件）。
+    结果以换行分隔的 JSON（NDJSON）逐条返回，最后一行为 summary，出错时为 error。
+    """
+    for field in ('a8_file', 'dispatch_file'):
+        if field not in request.files or request.files[field].filename == '':
+            return jsonify({'error': '未选择A8系统推送表' if field == 'a8_file' else '未选择出库数据文件'}), 400
+        if not request.files[field].filename.lower().endswith('.xlsx'):
+            return jsonify({'error': '流式对账只支持xlsx文件'}), 400
+
+    key = request.form.get('key', 'auto')
+    if key not in ('auto', 'id', 'name'):
+        return jsonify({'error': '参数格式错误'}), 400
+
+    try:
+        day = request.form.get('day')
+        day = int(day) if day else None
+        tolerance = float(request.form.get('tolerance', 0))
+        if tolerance < 0:
+            raise ValueError('tolerance')
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+    presorted = request.form.get('presorted', '').lower() in ('1', 'true')
+    fuzzy = request.form.get('fuzzy', '').lower() in ('1', 'true')
+    try:
+        min_score = float(request.form.get('min_score', FUZZY_MATCH_MIN_SCORE))
+        if not 0 < min_score <= 1:
+            raise ValueError('min_score')
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+
+    # 请求结束时上传文件会被关闭，而响应在请求结束后才逐步生成，因此先复制到独立的临时文件
+    streams = []
+    for field in ('a8_file', 'dispatch_file'):
+        stream = tempfile.TemporaryFile()
+        shutil.copyfileobj(request.files[field].stream, stream)
+        stream.seek(0)
+        streams.append(stream)
+
+    try:
+        a8_workbook, dispatch_workbook = (UploadedWorkbook(stream) for stream in streams)
+        # 在开始输出前确认两个文件都能找到对账所需的列
+        a8_key = reconcile_columns(a8_workbook.layout, key, day)[0]
+        reconcile_columns(dispatch_workbook.layout, a8_key, day)
+    except Exception as e:
+        for stream in streams:
+            stream.close()
+        if isinstance(e, AnalysisError):
+            return jsonify({'error': e.message}), e.status
+        return jsonify({'error': f'处理文件时出错: {str(e)}'}), 500
+
+    def generate():
+        try:
+            for event in stream_reconciliation(a8_workbook, dispatch_workbook, key, day, tolerance, presorted,
+                                               fuzzy=fuzzy, min_score=min_score):
+                yield app.json.dumps(event) + '\n'
+        except AnalysisError as e:
+            yield app.json.dumps({'type': 'error', 'error': e.message}) + '\n'
         except Exception as e:
-            return jsonify({'error': f'处理文件时出错: {str(e)}'}), 500
+            yield app.json.dumps({'type': 'error', 'error': f'处理文件时出错: {str(e)}'}) + '\n'
+        finally:
+            for stream in streams:
+                stream.close()
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/api/reconcile', methods=['POST'])
+def reconcile():
+    """A8系统推送表（a8_file）与营销系统数据（marketing_file）对账
+
+    可选参数：key（id、name 或 auto）、day（按X日的气量列对账）、tolerance（允许的气量差异）、
+    limit（每类最多返回的记录数）、fuzzy（1 表示按客户名称模糊匹配缺失和多余客户）、
+    min_score（模糊匹配的最低相似度，大于0且不超过1）。
+    """
+    for field in ('a8_file', 'marketing_file'):
+        if field not in request.files or request.files[field].filename == '':
+            return jsonify({'error': '未选择A8系统推送表' if field == 'a8_file' else '未选择营销系统数据文件'}), 400
+        if not allowed_file(request.files[field].filename):
+            return jsonify({'error': '文件类型不允许'}), 400
+
+    key = request.form.get('key', 'auto')
+    if key not in ('auto', 'id', 'name'):
+        return jsonify({'error': '参数格式错误'}), 400
+
+    try:
+        day = request.form.get('day')
+        day = int(day) if day else None
+        tolerance = float(request.form.get('tolerance', 0))
+        limit = int(request.form.get('limit', app.config['MAX_PAGE_SIZE']))
+        min_score = float(request.form.get('min_score', FUZZY_MATCH_MIN_SCORE))
+        if tolerance < 0 or limit < 0 or not 0 < min_score <= 1:
+            raise ValueError('tolerance/limit/min_score')
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+    fuzzy = request.form.get('fuzzy', '').lower() in ('1', 'true')
+
+    try:
+        result = run_reconciliation(
+            open_uploaded_workbook(request.files['a8_file']),
+            open_uploaded_workbook(request.files['marketing_file']),
+            key, day, tolerance, limit, fuzzy, min_score
+        )
+    except AnalysisError as e:
+        return jsonify({'error': e.message}), e.status
 
-    return jsonify({'error': '文件类型不允许'}), 400
+    return jsonify({'message': '对账完成', **result})
 
 
 @app.route('/api/update_threshold', methods=['POST'])
 def update_threshold():
     """更新异常检测阈值"""
-    global abnormal_threshold, monitor_data
-
+    session_id = get_session_id()
     new_threshold = request.json.get('threshold')
 
     if new_threshold is None:
@@ -379,25 +2102,21 @@ def update_threshold():
 
     try:
         abnormal_threshold = float(new_threshold)
+    except ValueError:
+        return jsonify({'error': '阈值参数格式错误'}), 400
+
+    session = result_store.get(session_id)
+    if session is None:
+        # 还没有分析结果时只记录阈值，供下次分析使用
+        session = AnalysisSession(abnormal_threshold)
+        result_store.put(session_id, session, session.estimated_bytes())
 
-        # 如果已经有监控数据，重新计算异常
-        if monitor_data is not None:
-            # 重新计算异常
-            for record in monitor_data:
-                if record['变化量(万立方米)'] is not None and record['前一天气量(万立方米)'] is not None:
-                    change_rate = (record['变化量(万立方米)'] / record['前一天气量(万立方米)']) * 100 if record[
-                                                                                             '前一天气量(万立方米)'] != 0 else float(
-                        'inf')
-                    record['异常'] = abs(change_rate) > abnormal_threshold
-                    record['变化率(%)'] = f"{change_rate}%"
-
-            # 获取异常数据
-            abnormal_records = [record for record in monitor_data if record['异常']]
-
-            # 转换为可序列化的格式
-            for record in abnormal_records:
-                for key in record:
-                    record[key] = convert_to_serializable(record[key])
+    with session.lock:
+        session.abnormal_threshold = abnormal_threshold
+
+        # 如果已经有监控数据，通过变化率索引直接得到新阈值下的异常数据
+        if session.monitor_index is not None:
+            abnormal_records = session.monitor_index.set_threshold(abnormal_threshold)
 
             return jsonify({
                 'message': '阈值更新成功',
@@ -411,43 +2130,210 @@ def update_threshold():
                 'abnormal_threshold': abnormal_threshold
             })
 
-    except ValueError:
-        return jsonify({'error': '阈值参数格式错误'}), 400
+
+# get_data 支持的分页、筛选、排序和字段选择参数
+QUERY_PARAMS = ('offset', 'limit', 'abnormal', 'category', 'min_rate', 'max_rate', 'sort', 'fields')
+
+
+def parse_query_args(args):
+    """解析 get_data 的查询参数，格式错误时抛出 ValueError"""
+    offset = int(args.get('offset', 0))
+    limit = int(args.get('limit', app.config['DEFAULT_PAGE_SIZE']))
+    if offset < 0 or limit <= 0:
+        raise ValueError('offset/limit')
+
+    sort = args.get('sort')
+    descending = False
+    if sort:
+        descending = sort.startswith('-')
+        sort = sort.lstrip('-')
+        if sort not in RecordQueryIndex.SORT_FIELDS:
+            raise ValueError('sort')
+    else:
+        sort = None
+
+    min_rate = args.get('min_rate')
+    max_rate = args.get('max_rate')
+    fields = args.get('fields')
+
+    return {
+        'abnormal_only': args.get('abnormal', '').lower() in ('1', 'true', 'yes'),
+        'category': args.get('category') or None,
+        'min_rate': float(min_rate) if min_rate else None,
+        'max_rate': float(max_rate) if max_rate else None,
+        'sort': sort,
+        'descending': descending,
+        'offset': offset,
+        'limit': min(limit, app.config['MAX_PAGE_SIZE']),
+        'fields': [f for f in fields.split(',') if f] if fields else None
+    }
 
 
 @app.route('/api/get_data', methods=['GET'])
 def get_data():
-    """获取当前存储的数据"""
-    # 转换为可序列化的格式
-    monitor_data_serializable = []
-    if monitor_data:
-        for record in monitor_data:
-            serializable_record = {}
-            for key, value in record.items():
-                serializable_record[key] = convert_to_serializable(value)
-            monitor_data_serializable.append(serializable_record)
+    """获取当前会话存储的数据
+
+    不带查询参数时返回全部数据；带 offset/limit、abnormal、category（合计行所属分组，如"居民"）、
+    min_rate/max_rate、sort（字段名，前缀"-"表示降序）或 fields（逗号分隔）时分页返回。
+    """
+    session = result_store.get(get_session_id())
+    if session is None:
+        session = AnalysisSession()
+
+    if not any(param in request.args for param in QUERY_PARAMS):
+        with session.lock:
+            # 记录在生成时已是可序列化的格式，直接交给 JSON 提供器编码，不再复制
+            return jsonify({
+                'monitor_data': session.monitor_data or [],
+                'last_month_data': session.last_month_data,
+                'abnormal_threshold': session.abnormal_threshold
+            })
+
+    try:
+        query = parse_query_args(request.args)
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+
+    with session.lock:
+        if session.query_index is None:
+            page, total = [], 0
+        else:
+            positions, total = session.query_index.query(
+                abnormal_only=query['abnormal_only'],
+                category=query['category'],
+                min_rate=query['min_rate'],
+                max_rate=query['max_rate'],
+                sort=query['sort'],
+                descending=query['descending'],
+                offset=query['offset'],
+                limit=query['limit']
+            )
+            page = [session.monitor_data[i] for i in positions.tolist()]
+
+        if query['fields']:
+            page = [{field: record[field] for field in query['fields'] if field in record} for record in page]
+
+        next_offset = query['offset'] + query['limit']
+        return jsonify({
+            'monitor_data': page,
+            'total': total,
+            'offset': query['offset'],
+            'limit': query['limit'],
+            'next_offset': next_offset if next_offset < total else None,
+            'last_month_data': session.last_month_data,
+            'abnormal_threshold': session.abnormal_threshold
+        })
+
+
+@app.route('/api/contributions', methods=['GET'])
+def get_contributions():
+    """查询当前会话中某个合计行的变化量由哪些客户构成，按贡献大小排序
+
+    合计行用 position（在分析结果 data 中的位置，从0开始）或序号 row_id 指定；
+    999 布局中多个合计行的序号相同，此时需要用 position。
+    """
+    row_id = request.args.get('row_id')
+    position = request.args.get('position')
+    if not row_id and position is None:
+        return jsonify({'error': '未提供 row_id 或 position 参数'}), 400
+
+    try:
+        limit = int(request.args.get('limit', app.config['DEFAULT_PAGE_SIZE']))
+        if limit <= 0:
+            raise ValueError('limit')
+        position = int(position) if position is not None else None
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+
+    session = result_store.get(get_session_id())
+    if session is None or session.contribution_index is None:
+        return jsonify({'error': '没有分析结果'}), 404
+
+    with session.lock:
+        if position is None:
+            matches = [i for i, record in enumerate(session.monitor_data)
+                       if history_key(record['序号']) == history_key(row_id)]
+            if len(matches) > 1:
+                return jsonify({'error': '该序号对应多个合计行，请用 position 指定'}), 400
+            position = matches[0] if matches else None
+        if position is None or not 0 <= position < len(session.monitor_data):
+            return jsonify({'error': '未找到该合计行'}), 404
+
+        total = session.monitor_data[position]
+        total_change = total['变化量(万立方米)']
+        try:
+            records, explained, customer_count = session.contribution_index.contributions(
+                position, total_change, limit)
+        except AnalysisError as e:
+            return jsonify({'error': e.message}), e.status
+
+        return jsonify({
+            'position': position,
+            'total': total,
+            'customer_count': customer_count,
+            'explained_change': explained,
+            'unexplained_change': total_change - explained if total_change is not None else None,
+            'contributions': records
+        })
+
+
+@app.route('/api/history', methods=['GET'])
+def get_history():
+    """查询历史库
+
+    source 为分析结果中返回的来源标识：按 row_id 查询某一行在 start_date 至 end_date 间的气量，
+    或按 date 查询某一天的全部数据；不带参数时列出历史库中的各个来源。
+    """
+    history_store = get_history_store()
+    if history_store is None:
+        return jsonify({'error': '未启用历史数据'}), 404
+
+    source = request.args.get('source')
+    row_id = request.args.get('row_id')
+    day = request.args.get('date')
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+
+    try:
+        for value in (day, start_date, end_date):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return jsonify({'error': '参数格式错误'}), 400
+
+    if not (row_id or day):
+        return jsonify({
+            'sources': [{'source': s, 'run_count': count, 'first_date': first, 'last_date': last}
+                        for s, count, first, last in history_store.sources()]
+        })
+
+    if not source:
+        return jsonify({'error': '需要提供 source 参数'}), 400
+
+    if row_id:
+        return jsonify({
+            'source': source,
+            'row_id': row_id,
+            'history': [{'日期': d, '名称': name, '气量(万立方米)': volume}
+                        for d, name, volume in history_store.series(source, row_id, start_date, end_date)]
+        })
 
     return jsonify({
-        'monitor_data': monitor_data_serializable,
-        'last_month_data': convert_to_serializable(last_month_data),
-        'abnormal_threshold': abnormal_threshold
+        'source': source,
+        'date': day,
+        'history': [{'行号': position, '序号': r, '合计行': bool(is_total), '名称': name, '分类': category,
+                     '气量(万立方米)': volume}
+                    for position, r, is_total, name, category, volume in history_store.rows_on(source, day)]
     })
 
 
 @app.route('/api/clear_data', methods=['POST'])
 def clear_data():
-    """清除所有数据"""
-    global monitor_data, last_month_data
-
-    monitor_data = None
-    last_month_data = None
+    """清除当前会话的所有数据"""
+    result_store.pop(get_session_id())
 
     return jsonify({'message': '所有数据已清除'})
 
 
 if __name__ == '__main__':
-    # 确保上传文件夹存在
-    if not os.path.exists(UPLOAD_FOLDER):
-        os.makedirs(UPLOAD_FOLDER)
-
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,98 @@
+# test_header.py
+import io
+import os
+import sys
+
+from openpyxl import Workbook
+
+# workbook_preview.py 位于仓库根目录，即 tests 的上一级
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from analysis_engine import UploadedWorkbook
+from workbook_preview import HEADER_SCAN_ROWS, locate_header, preview_workbook
+
+
+def test_two_row_header_with_merged_group_label_is_merged():
+    rows = [
+        ['3月用气监控表', None, None, None, None, None],
+        ['序号', '分类', '客户名称', '气量', None, None],
+        [None, None, None, '1日', '2日', '3日'],
+        [1, '居民', '甲公司', 10, 11, 12],
+    ]
+    names, data_start_row = locate_header(rows)
+    assert names == ['序号', '分类', '客户名称', '气量-1日', '气量-2日', '气量-3日']
+    assert data_start_row == 3
+
+
+def test_two_row_header_with_blank_upper_cells_is_merged():
+    rows = [
+        ['序号', '客户名称', None, None],
+        [None, None, '1日', '2日'],
+        [1, '甲公司', 10, 11],
+    ]
+    names, data_start_row = locate_header(rows)
+    assert names == ['序号', '客户名称', '客户名称-1日', '客户名称-2日']
+    assert data_start_row == 2
+
+
+def test_data_row_with_date_text_is_not_merged():
+    rows = [
+        ['序号', '客户编号', '客户名称', '推送日期', '气量'],
+        [1, 1001, '甲公司', '1月3日', 10],
+        [2, 1002, '乙公司', '1月3日', 20.5],
+    ]
+    names, data_start_row = locate_header(rows)
+    assert names == rows[0]
+    assert data_start_row == 1
+
+
+def test_text_row_with_dates_under_single_column_headers_is_not_merged():
+    rows = [
+        ['序号', '客户名称', '推送日期'],
+        ['A1', '甲公司', '1月3日'],
+    ]
+    assert locate_header(rows) == (rows[0], 1)
+
+
+def test_caller_can_choose_header_row_count():
+    rows = [
+        ['序号', '客户名称', '推送日期'],
+        ['A1', '甲公司', '1月3日'],
+        ['A2', '乙公司', '1月4日'],
+    ]
+    assert locate_header(rows, header_rows=2) == (['序号-A1', '客户名称-甲公司', '推送日期-1月3日'], 2)
+
+    rows = [
+        ['序号', '客户名称', '气量', None],
+        [None, None, '1日', '2日'],
+    ]
+    assert locate_header(rows, header_rows=1) == (rows[0], 1)
+
+
+def preview_and_engine_layouts(tmp_path, rows):
+    book = Workbook()
+    sheet = book.active
+    for row in rows:
+        sheet.append(row)
+    path = tmp_path / 'monitor.xlsx'
+    book.save(path)
+
+    preview = preview_workbook(str(path))
+    with open(path, 'rb') as f:
+        layout = UploadedWorkbook(io.BytesIO(f.read())).layout
+    return (preview.columns, preview.data_start_row), (layout.columns, layout.data_start_row)
+
+
+def test_preview_and_analysis_scan_the_same_header_rows(tmp_path):
+    # 表头在扫描范围之外：预览与分析都不应找到它
+    title_rows = [[f'说明{i}'] for i in range(HEADER_SCAN_ROWS)]
+    rows = title_rows + [['序号', '客户名称', '1日'], [1, '甲公司', 10]]
+    preview_layout, engine_layout = preview_and_engine_layouts(tmp_path, rows)
+    assert preview_layout == engine_layout
+
+    # 扫描范围之后的数据行比表头宽
+    rows = [['序号', '客户名称', '1日']] + [[i, f'客户{i}', i] for i in range(HEADER_SCAN_ROWS)] + [[99, '客户', 1, '备注']]
+    preview_layout, engine_layout = preview_and_engine_layouts(tmp_path, rows)
+    assert preview_layout == engine_layout == (('序号', '客户名称', '1日'), 1)
@@ -0,0 +1,93 @@
+# test_history.py
+import io
+import os
+import sqlite3
+import sys
+
+import pytest
+from openpyxl import Workbook
+
+# marketing.py 位于仓库根目录，即 tests 的上一级
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+import marketing
+
+
+def workbook_bytes(days, rows):
+    """生成月度监控表，rows 为 (序号, 分类, 客户名称, 各日期的气量)"""
+    book = Workbook()
+    sheet = book.active
+    sheet.append(['序号', '分类', '客户名称'] + [f'{day}日' for day in days])
+    for row_id, category, name, volumes in rows:
+        sheet.append([row_id, category, name] + list(volumes))
+    stream = io.BytesIO()
+    book.save(stream)
+    return stream.getvalue()
+
+
+def month_end_workbook(customer_volume, total_volume):
+    """1月的监控表，只有30日、31日两列"""
+    return workbook_bytes((30, 31), [
+        (1, '居民', '甲公司', (customer_volume, customer_volume)),
+        (900, '合计', '居民合计', (total_volume, total_volume)),
+    ])
+
+
+def month_start_workbook():
+    """2月的监控表，只有1日、2日两列"""
+    return workbook_bytes((1, 2), [
+        (1, '居民', '甲公司', (50, 52)),
+        (900, '合计', '居民合计', (50, 52)),
+    ])
+
+
+@pytest.fixture
+def client(tmp_path):
+    previous_path = marketing.app.config['HISTORY_DB_PATH']
+    marketing.app.config['HISTORY_DB_PATH'] = str(tmp_path / 'history.db')
+    try:
+        yield marketing.app.test_client()
+    finally:
+        marketing.app.config['HISTORY_DB_PATH'] = previous_path
+
+
+def analyze(client, content, filename, analysis_date, session_id):
+    response = client.post('/api/analyze', data={
+        'main_file': (io.BytesIO(content), filename),
+        'analysis_date': analysis_date
+    }, content_type='multipart/form-data', headers={'X-Session-Id': session_id})
+    return response.status_code, response.get_json()
+
+
+def test_same_layout_workbooks_keep_separate_history(client):
+    assert analyze(client, month_end_workbook(45, 100), 'regionA_2025-01.xlsx', '2025-01-31', 'a')[0] == 200
+    assert analyze(client, month_end_workbook(15030, 100000), 'regionB_2025-01.xlsx', '2025-01-31', 'b')[0] == 200
+
+    status, result = analyze(client, month_start_workbook(), 'regionA_2025-02.xlsx', '2025-02-01', 'a')
+    assert status == 200
+    assert [r['前一天气量(万立方米)'] for r in result['data']] == [100]
+    contributions = client.get('/api/contributions?position=0', headers={'X-Session-Id': 'a'}).get_json()
+    assert [r['前一天气量(万立方米)'] for r in contributions['contributions']] == [45]
+
+    status, result = analyze(client, month_start_workbook(), 'regionB_2025-02.xlsx', '2025-02-01', 'b')
+    assert status == 200
+    assert [r['前一天气量(万立方米)'] for r in result['data']] == [100000]
+
+
+def test_workbook_without_history_of_its_own_needs_extra_file(client):
+    assert analyze(client, month_end_workbook(45, 100), 'regionA.xlsx', '2025-01-31', 'a')[0] == 200
+
+    status, result = analyze(client, month_start_workbook(), 'regionC.xlsx', '2025-02-01', 'c')
+    assert status == 400
+    assert result['error'] == '每月1号需要上传月度补充文件'
+
+
+def test_repeated_analysis_does_not_append_duplicate_runs(client):
+    for _ in range(3):
+        assert analyze(client, month_end_workbook(45, 100), 'regionA.xlsx', '2025-01-31', 'a')[0] == 200
+    assert analyze(client, month_end_workbook(46, 101), 'regionA.xlsx', '2025-01-31', 'a')[0] == 200
+
+    with sqlite3.connect(marketing.app.config['HISTORY_DB_PATH']) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM history_run').fetchone()[0] == 2
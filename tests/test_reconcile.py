@@ -0,0 +1,89 @@
+# test_reconcile.py
+import io
+import os
+import sys
+
+from openpyxl import Workbook
+
+# marketing.py 位于仓库根目录，即 tests 的上一级
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from marketing import UploadedWorkbook, app, load_reconcile_frame, run_reconciliation, stream_reconciliation
+
+
+def make_workbook(rows):
+    """生成只有一个工作表的 xlsx 工作簿，rows 为 (客户编号, 客户名称, 气量)"""
+    book = Workbook()
+    sheet = book.active
+    sheet.append(['客户编号', '客户名称', '气量'])
+    for row in rows:
+        sheet.append(list(row))
+    stream = io.BytesIO()
+    book.save(stream)
+    stream.seek(0)
+    return UploadedWorkbook(stream)
+
+
+# A8 推送表的编号列有空单元格，pandas 读出为浮点数（1001.0）；营销系统的编号是文本
+A8_ROWS = [(1001, '甲公司', 10.0), (None, '无编号客户', 3.0), (1002, '乙公司', 20.0), (1004, '丁公司', 7.0)]
+MARKETING_ROWS = [('1001', '甲公司', 10.0), ('1002', '乙公司', 25.0), (' 1003 ', '丙公司', 5.0)]
+
+
+def test_integral_float_ids_match_integer_ids():
+    frame, key = load_reconcile_frame(make_workbook(A8_ROWS), 'id')
+
+    assert key == 'id'
+    assert list(frame.index) == ['1001', '1002', '1004']
+    assert list(frame['客户编号']) == ['1001', '1002', '1004']
+
+
+def test_reconciliation_with_mixed_id_types():
+    result = run_reconciliation(make_workbook(A8_ROWS), make_workbook(MARKETING_ROWS))
+
+    assert result['key'] == 'id'
+    assert result['matched_count'] == 1
+    assert [r['客户编号'] for r in result['mismatched']] == ['1002']
+    assert [r['客户编号'] for r in result['missing']] == ['1003']
+    assert [r['客户编号'] for r in result['extra']] == ['1004']
+
+
+def test_stream_reconciliation_with_mixed_id_types():
+    events = list(stream_reconciliation(make_workbook(A8_ROWS), make_workbook(MARKETING_ROWS)))
+    records = {kind: [e['record']['客户编号'] for e in events if e['type'] == kind]
+               for kind in ('missing', 'extra', 'mismatched')}
+
+    assert records == {'missing': ['1003'], 'extra': ['1004'], 'mismatched': ['1002']}
+    assert events[-1]['matched_count'] == 1
+
+
+# 按编号数值排序（而不是按字符串排序）的文件，编号长度不同
+NUMERIC_SORTED_A8_ROWS = [(998, '甲公司', 10.0), (999, '乙公司', 20.0), (1000, '丙公司', 5.0), (1001, '丁公司', 7.0)]
+NUMERIC_SORTED_DISPATCH_ROWS = [(998, '甲公司', 10.0), (1000, '丙公司', 6.0), (1001, '丁公司', 7.0), (1002, '戊公司', 1.0)]
+
+
+def test_presorted_stream_reconciliation_accepts_numerically_sorted_ids():
+    for presorted, run_rows in ((True, None), (False, 2)):
+        events = list(stream_reconciliation(make_workbook(NUMERIC_SORTED_A8_ROWS),
+                                            make_workbook(NUMERIC_SORTED_DISPATCH_ROWS),
+                                            presorted=presorted, run_rows=run_rows))
+        records = {kind: [e['record']['客户编号'] for e in events if e['type'] == kind]
+                   for kind in ('missing', 'extra', 'mismatched')}
+
+        assert records == {'missing': ['1002'], 'extra': ['999'], 'mismatched': ['1000']}
+        assert events[-1]['matched_count'] == 2
+
+
+def test_min_score_out_of_range_is_rejected():
+    client = app.test_client()
+    for path, other_field in (('/api/reconcile', 'marketing_file'), ('/api/reconcile_dispatch', 'dispatch_file')):
+        for min_score in ('0', '-0.5', '1.01', '2', 'nan'):
+            response = client.post(path, data={
+                'a8_file': (io.BytesIO(b''), 'a8.xlsx'),
+                other_field: (io.BytesIO(b''), 'other.xlsx'),
+                'fuzzy': '1',
+                'min_score': min_score
+            }, content_type='multipart/form-data')
+            assert response.status_code == 400
+            assert response.get_json() == {'error': '参数格式错误'}
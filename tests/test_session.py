@@ -0,0 +1,45 @@
+# test_session.py
+import io
+import os
+import sys
+
+from openpyxl import Workbook
+
+# marketing.py 位于仓库根目录，即 tests 的上一级
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+import marketing
+
+
+def monitor_workbook():
+    book = Workbook()
+    sheet = book.active
+    sheet.append(['序号', '分类', '客户名称', '1日', '2日'])
+    sheet.append([1, '居民', '甲公司', 10, 12])
+    sheet.append([900, '合计', '居民合计', 10, 12])
+    stream = io.BytesIO()
+    book.save(stream)
+    return stream.getvalue()
+
+
+def analyze(client, headers=None):
+    return client.post('/api/analyze', data={
+        'main_file': (io.BytesIO(monitor_workbook()), 'monitor.xlsx'),
+        'analysis_date': '2025-01-02'
+    }, content_type='multipart/form-data', headers=headers or {}).get_json()
+
+
+def test_analysis_without_session_gets_its_own_session():
+    client = marketing.app.test_client()
+    first = analyze(client)['session_id']
+    second = analyze(client)['session_id']
+
+    assert first != second
+    assert marketing.DEFAULT_SESSION_ID not in (first, second)
+    assert analyze(client, {'X-Session-Id': first})['session_id'] == first
+
+    data = client.get('/api/get_data', headers={'X-Session-Id': first}).get_json()
+    assert [r['名称'] for r in data['monitor_data']] == ['居民合计']
+    assert client.get('/api/get_data').get_json()['monitor_data'] == []
@@ -0,0 +1,94 @@
+# test_sheet_scan.py
+import io
+import os
+import sys
+import zipfile
+
+import pytest
+from openpyxl import Workbook
+
+# analysis_engine.py 位于仓库根目录，即 tests 的上一级
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from analysis_engine import UnsupportedSheet, read_raw_columns, read_raw_columns_openpyxl, scan_raw_columns
+
+MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+POSITIONS = [0, 1, 2]
+
+
+def shared_string_workbook():
+    """openpyxl 保存的工作簿，字符串写入共享字符串表"""
+    book = Workbook()
+    sheet = book.active
+    sheet.append(['序号', '客户名称', '1日'])
+    sheet.append([1, '甲公司', 10.5])
+    sheet.append([2, '乙公司 & 丙', 3])
+    sheet.append([3, None, '#N/A'])
+    sheet.append([None, None, None])
+    stream = io.BytesIO()
+    book.save(stream)
+    return stream.getvalue()
+
+
+def replace_sheet(sheet_xml):
+    """用给定的工作表 XML 替换 shared_string_workbook 的第一个工作表"""
+    source = zipfile.ZipFile(io.BytesIO(shared_string_workbook()))
+    stream = io.BytesIO()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as target:
+        for info in source.infolist():
+            data = source.read(info.filename)
+            if info.filename == 'xl/worksheets/sheet1.xml':
+                data = sheet_xml.encode('utf-8')
+            target.writestr(info, data)
+    return stream.getvalue()
+
+
+def sheet_xml(rows, prefix=''):
+    """rows 为每行单元格 XML（不含前缀）的列表，prefix 非空时所有元素带命名空间前缀"""
+    p = f'{prefix}:' if prefix else ''
+    xmlns = f'xmlns:{prefix}="{MAIN_NS}"' if prefix else f'xmlns="{MAIN_NS}"'
+    body = ''.join(
+        f'<{p}row r="{index}">' + ''.join(cell.replace('<', f'<{p}').replace(f'<{p}/', f'</{p}') for cell in cells) + f'</{p}row>'
+        for index, cells in enumerate(rows, 1)
+    )
+    return f'<?xml version="1.0" encoding="UTF-8"?><{p}worksheet {xmlns}><{p}sheetData>{body}</{p}sheetData></{p}worksheet>'
+
+
+INLINE_ROWS = [
+    ['<c r="A1" t="inlineStr"><is><t>序号</t></is></c>', '<c r="B1" t="inlineStr"><is><t>客户名称</t></is></c>',
+     '<c r="C1" t="inlineStr"><is><t>1日</t></is></c>'],
+    ['<c r="A2"><v>1</v></c>', '<c r="B2" t="inlineStr"><is><r><t>甲</t></r><r><t xml:space="preserve">公司 </t></r></is></c>',
+     '<c r="C2"><v>10.5</v></c>'],
+    ['<c r="A3"><v>2</v></c>', '<c r="B3" t="inlineStr"><is><t>乙 &amp; 丙</t></is></c>', '<c r="C3" t="e"><v>#DIV/0!</v></c>'],
+]
+
+FORMULA_ROWS = [
+    INLINE_ROWS[0],
+    ['<c r="A2"><v>1</v></c>', '<c r="B2" t="str"><f>"甲"&amp;"公司"</f><v>甲公司</v></c>',
+     '<c r="C2"><f>A2*2.5</f><v>2.5</v></c>'],
+    ['<c r="A3"><v>2</v></c>', '<c r="B3" t="b"><f>A3&gt;1</f><v>1</v></c>', '<c r="C3"><f>A3*2</f><v></v></c>'],
+]
+
+
+@pytest.mark.parametrize('content', [
+    pytest.param(shared_string_workbook(), id='shared-strings'),
+    pytest.param(replace_sheet(sheet_xml(INLINE_ROWS)), id='inline-strings'),
+    pytest.param(replace_sheet(sheet_xml(FORMULA_ROWS)), id='formulas'),
+])
+def test_scan_matches_openpyxl(content):
+    for data_start_row in (0, 1):
+        expected = read_raw_columns_openpyxl(io.BytesIO(content), data_start_row, POSITIONS)
+        assert any(value != '' for column in expected.values() for value in column)
+        assert scan_raw_columns(io.BytesIO(content), data_start_row, POSITIONS) == expected
+
+
+def test_prefixed_namespace_sheet_falls_back_to_openpyxl():
+    content = replace_sheet(sheet_xml(INLINE_ROWS, prefix='x'))
+    with pytest.raises(UnsupportedSheet):
+        scan_raw_columns(io.BytesIO(content), 1, POSITIONS)
+
+    expected = read_raw_columns_openpyxl(io.BytesIO(content), 1, POSITIONS)
+    assert expected[1] == ['甲公司 ', '乙 & 丙']
+    assert read_raw_columns(io.BytesIO(content), 1, POSITIONS) == expected
@@ -0,0 +1,370 @@
+"""工作簿表头预览
+
+选择文件后立即在后台执行：直接读取 xlsx 压缩包中第一个工作表的 XML，只解析开头少量行，
+得到表头布局（序号、分类、名称和日期列）；不依赖 pandas，大文件也只需读取开头的一小段。
+表头识别规则与分析引擎一致，分析引擎也从本模块导入这些规则。
+"""
+import numbers
+import posixpath
+import re
+import time
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+# 序号列可能使用的列名
+SEQUENCE_COLUMN_NAMES = ('序号', '编号', 'ID')
+
+# 日期列名的匹配模式：数字+日 或 气量-数字日
+DATE_COLUMN_PATTERNS = (re.compile(r'(\d+)日'), re.compile(r'气量-(\d+)日'))
+
+# 定位表头时查看的行数（用于跳过标题行和识别两行表头），分析引擎读取表头时使用同一行数
+HEADER_SCAN_ROWS = 10
+
+# 预览读取的行数：包含表头扫描范围，并看到开头若干数据行
+PREVIEW_ROWS = 30
+
+# 扫描合计行时每次解压的字节数
+TOTAL_SCAN_CHUNK_SIZE = 1024 * 1024
+
+MAIN_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+PACKAGE_RELATIONSHIP_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+
+# 单元格内容恰好为"合计"：共享字符串或内联字符串的 <t>，公式结果的 <v>
+TOTAL_CELL_PATTERN = re.compile('>合计</(?:t|v)>'.encode('utf-8'))
+
+
+def column_day(name):
+    """从列名中提取日期（几日），不是日期列时返回 None"""
+    if name is None:
+        return None
+
+    col_str = str(name)
+
+    for pattern in DATE_COLUMN_PATTERNS:
+        match = pattern.search(col_str)
+        if match:
+            return int(match.group(1))
+
+    return None
+
+
+def merge_header_rows(upper, lower):
+    """合并两行表头：上一行的合并单元格向右填充，与下一行组合为"上-下"格式的列名
+
+    例如上一行为"气量"（横向合并）、下一行为"1日"时得到"气量-1日"；
+    下一行为空（纵向合并，如"序号"）时直接使用上一行的列名。
+    """
+    merged = []
+    current_top = None
+    for top, bottom in zip(upper, lower):
+        if top is not None:
+            current_top = top
+        if bottom is None:
+            merged.append(current_top)
+        elif current_top is None:
+            merged.append(bottom)
+        else:
+            merged.append(f"{current_top}-{bottom}")
+    return merged
+
+
+def normalize_column_names(names):
+    """与 pandas 读取表头的方式保持一致：空列名记为 Unnamed: 位置，重复列名追加 .1、.2 等后缀"""
+    seen = {}
+    result = []
+    for i, name in enumerate(names):
+        if name is None:
+            name = f"Unnamed: {i}"
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        result.append(name)
+    return tuple(result)
+
+
+def is_sub_header_row(upper, lower):
+    """下一行是否为两行表头的第二行：没有数值单元格，且有日期单元格
+
+    每个日期单元格上方须为空（纵向或横向合并的一部分）或横向合并的分组标题（右侧单元格为空，如"气量"），
+    否则下一行是普通数据行，如表头"推送日期"下方的"1月3日"。
+    """
+    has_date = False
+    for i, value in enumerate(lower):
+        if value is None:
+            continue
+        if isinstance(value, numbers.Number):
+            return False
+        if column_day(value) is None:
+            continue
+        has_date = True
+        top = upper[i] if i < len(upper) else None
+        if top is not None and not (i + 1 < len(upper) and upper[i + 1] is None):
+            return False
+    return has_date
+
+
+def locate_header(rows, header_rows=None):
+    """在工作表开头若干行（空单元格为 None）中定位表头，返回 (列名列表, 数据起始行)
+
+    只查看开头 HEADER_SCAN_ROWS 行，列数按这些行中最后一个非空单元格所在的列计算；
+    表头行为第一行包含序号列名的行，之前的行视为标题行跳过；
+    header_rows 为 None 时自动判断：表头行本身没有日期列、下一行符合 is_sub_header_row 时按两行表头合并。
+    header_rows 为 1 或 2 时由调用方指定表头行数。
+    """
+    def has_date_cell(row):
+        return any(column_day(value) is not None for value in row if value is not None)
+
+    rows = rows[:HEADER_SCAN_ROWS]
+    width = max((i + 1 for row in rows for i, value in enumerate(row) if value is not None), default=0)
+    rows = [list(row[:width]) + [None] * (width - len(row)) for row in rows]
+
+    header_row = next(
+        (i for i, row in enumerate(rows)
+         if any(str(value).strip() in SEQUENCE_COLUMN_NAMES for value in row if value is not None)),
+        0
+    )
+    names = rows[header_row]
+    header_row_count = 1
+
+    next_row = header_row + 1
+    if header_rows is None:
+        merge = next_row < len(rows) and not has_date_cell(names) and is_sub_header_row(names, rows[next_row])
+    else:
+        merge = header_rows == 2 and next_row < len(rows)
+    if merge:
+        names = merge_header_rows(names, rows[next_row])
+        header_row_count = 2
+
+    return names, header_row + header_row_count
+
+
+class WorkbookPreview:
+    """工作簿预览：表头布局和开头的数据行
+
+    total_row 表示是否存在合计行：True 为已找到，False 为确认不存在，None 为尚未确认
+    （开头几行中没有合计行时，由 scan_total_row 扫描整个工作表确认）。
+    """
+
+    def __init__(self, path, columns, data_start_row, sample_rows):
+        self.path = path
+        self.columns = columns  # 按位置排列的列名
+        self.data_start_row = data_start_row  # 第一行数据在工作表中的行号（从0开始）
+        self.sample_rows = sample_rows  # 表头之后读取到的数据行
+        self.elapsed = 0.0  # 预览耗时（秒）
+
+        stripped = [str(c).strip() for c in columns]
+        self.sequence_col = next((c for c, s in zip(columns, stripped) if s in SEQUENCE_COLUMN_NAMES), None)
+        self.category_col = next((c for c, s in zip(columns, stripped) if s == '分类'), None)
+        self.name_col = '客户名称' if '客户名称' in columns else None
+
+        # 同一天有多列时取第一列
+        self.day_columns = {}
+        for col in columns:
+            day = column_day(col)
+            if day is not None:
+                self.day_columns.setdefault(day, col)
+
+        self.total_row = True if self.sample_total_rows() else None
+
+    def column_values(self, col):
+        position = self.columns.index(col)
+        return [row[position] if position < len(row) else None for row in self.sample_rows]
+
+    def sample_total_rows(self):
+        """开头数据行中的合计行数量：有分类列时按分类为"合计"，否则按序号为999"""
+        if self.category_col is not None:
+            return sum(value == '合计' for value in self.column_values(self.category_col))
+        if self.sequence_col is not None:
+            return sum(value == 999 for value in self.column_values(self.sequence_col))
+        return 0
+
+
+def first_sheet_path(archive):
+    """工作簿中第一个工作表在压缩包内的路径"""
+    with archive.open('xl/workbook.xml') as f:
+        sheet = next(elem for _, elem in iterparse(f) if elem.tag == f'{MAIN_NS}sheet')
+    relation_id = sheet.get(f'{RELATIONSHIP_NS}id')
+
+    with archive.open('xl/_rels/workbook.xml.rels') as f:
+        target = next(elem.get('Target') for _, elem in iterparse(f)
+                      if elem.tag == f'{PACKAGE_RELATIONSHIP_NS}Relationship' and elem.get('Id') == relation_id)
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join('xl', target))
+
+
+def column_position(reference):
+    """单元格引用（如 "AB12"）对应的列位置（从0开始）"""
+    position = 0
+    for char in reference:
+        if not char.isalpha():
+            break
+        position = position * 26 + ord(char.upper()) - 64
+    return position - 1
+
+
+def cell_number(text):
+    """数值单元格：整数值转为 int，与读取 Excel 时的规则一致"""
+    value = float(text)
+    return int(value) if value.is_integer() else value
+
+
+def string_item_text(elem):
+    """字符串项（共享字符串 <si> 或内联字符串 <is>）的文本：富文本由多段 <r><t> 组成，忽略注音 <rPh>"""
+    parts = []
+    for child in elem:
+        if child.tag == f'{MAIN_NS}t':
+            parts.append(child.text or '')
+        elif child.tag == f'{MAIN_NS}r':
+            parts.extend(t.text or '' for t in child.iter(f'{MAIN_NS}t'))
+    return ''.join(parts)
+
+
+def read_sheet_rows(archive, sheet_path, row_limit):
+    """流式读取工作表开头 row_limit 行，读够即停止
+
+    返回 (行列表, 共享字符串引用)；共享字符串单元格先记为 (索引,) 占位，之后统一替换。
+    没有单元格的行记为空列表，保证行号与工作表一致。
+    """
+    rows = []
+    shared_indexes = set()
+    with archive.open(sheet_path) as f:
+        for _, elem in iterparse(f):
+            if elem.tag != f'{MAIN_NS}row':
+                continue
+
+            row_number = int(elem.get('r', len(rows) + 1))
+            if row_number > row_limit:
+                break
+            while len(rows) < row_number - 1:
+                rows.append([])
+
+            row = []
+            for cell in elem.iter(f'{MAIN_NS}c'):
+                reference = cell.get('r')
+                position = column_position(reference) if reference else len(row)
+                while len(row) < position:
+                    row.append(None)
+
+                cell_type = cell.get('t', 'n')
+                value_elem = cell.find(f'{MAIN_NS}v')
+                text = value_elem.text if value_elem is not None else None
+                if cell_type == 'inlineStr':
+                    inline = cell.find(f'{MAIN_NS}is')
+                    value = string_item_text(inline) if inline is not None else None
+                elif text is None or cell_type == 'e':
+                    value = None
+                elif cell_type == 's':
+                    value = (int(text),)
+                    shared_indexes.add(value[0])
+                elif cell_type == 'b':
+                    value = text == '1'
+                elif cell_type == 'n':
+                    value = cell_number(text)
+                else:
+                    value = text
+                row.append(value)
+            rows.append(row)
+            elem.clear()
+    return rows, shared_indexes
+
+
+def read_shared_strings(archive, indexes):
+    """只读取共享字符串表中用到的前若干项，读到最大索引即停止"""
+    strings = {}
+    if not indexes or 'xl/sharedStrings.xml' not in archive.NameToInfo:
+        return strings
+
+    last_index = max(indexes)
+    position = 0
+    with archive.open('xl/sharedStrings.xml') as f:
+        for _, elem in iterparse(f):
+            if elem.tag != f'{MAIN_NS}si':
+                continue
+            if position in indexes:
+                strings[position] = string_item_text(elem)
+            elem.clear()
+            if position >= last_index:
+                break
+            position += 1
+    return strings
+
+
+def read_string_table(archive):
+    """读取完整的共享字符串表，按索引排列"""
+    strings = []
+    if 'xl/sharedStrings.xml' not in archive.NameToInfo:
+        return strings
+
+    with archive.open('xl/sharedStrings.xml') as f:
+        for _, elem in iterparse(f):
+            if elem.tag == f'{MAIN_NS}si':
+                strings.append(string_item_text(elem))
+                elem.clear()
+    return strings
+
+
+def preview_workbook(path, row_limit=PREVIEW_ROWS):
+    """读取 xlsx 文件的表头和开头的数据行，返回 WorkbookPreview
+
+    不是 xlsx 文件（如 xls）时抛出 ValueError。
+    """
+    start = time.perf_counter()
+    if not zipfile.is_zipfile(path):
+        raise ValueError('只能预览 xlsx 文件，表头将在分析时检查')
+
+    with zipfile.ZipFile(path) as archive:
+        rows, shared_indexes = read_sheet_rows(archive, first_sheet_path(archive), row_limit)
+        strings = read_shared_strings(archive, shared_indexes)
+
+    if not rows:
+        raise ValueError('工作表为空')
+
+    # 与按表格读取时一样，各行补齐到相同的列数
+    width = max(len(row) for row in rows)
+    rows = [[strings.get(value[0]) if isinstance(value, tuple) else value for value in row] + [None] * (width - len(row))
+            for row in rows]
+
+    names, data_start_row = locate_header(rows)
+    preview = WorkbookPreview(path, normalize_column_names(names), data_start_row, rows[data_start_row:])
+    preview.elapsed = time.perf_counter() - start
+    return preview
+
+
+def stream_contains(stream, pattern, chunk_size=TOTAL_SCAN_CHUNK_SIZE):
+    """按块扫描解压后的数据流，判断是否包含 pattern；相邻块保留重叠部分避免跨块漏检"""
+    overlap = 64
+    tail = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return False
+        data = tail + chunk
+        if pattern.search(data):
+            return True
+        tail = data[-overlap:]
+
+
+def scan_total_row(preview):
+    """开头几行中没有合计行时，扫描整个工作表确认是否存在分类为"合计"的单元格
+
+    只做字节匹配，不解析 XML：先查共享字符串表，再查工作表中的内联字符串和公式结果。
+    没有分类列（按序号999识别合计行）时无法按文本判断，保持未确认。
+    """
+    if preview.total_row is not None or preview.category_col is None:
+        return preview.total_row
+
+    with zipfile.ZipFile(preview.path) as archive:
+        found = False
+        if 'xl/sharedStrings.xml' in archive.NameToInfo:
+            with archive.open('xl/sharedStrings.xml') as f:
+                found = stream_contains(f, TOTAL_CELL_PATTERN)
+        if not found:
+            with archive.open(first_sheet_path(archive)) as f:
+                found = stream_contains(f, TOTAL_CELL_PATTERN)
+
+    preview.total_row = found
+    return found